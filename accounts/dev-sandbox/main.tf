@@ -75,6 +75,7 @@ resource "aws_iam_role_policy" "lambda_policy" {
         Effect = "Allow"
         Action = [
           "ec2:DescribeInstances",
+          "ec2:DescribeInstanceTypes",
           "ec2:DescribeInstanceStatus",
           "ec2:StopInstances",
           "ec2:DescribeTags"
@@ -88,6 +89,20 @@ resource "aws_iam_role_policy" "lambda_policy" {
           "cloudwatch:GetMetricData"
         ]
         Resource = "*"
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "sts:AssumeRole"
+        ]
+        Resource = "arn:aws:iam::*:role/${var.cross_account_role_name}"
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "lambda:InvokeFunction"
+        ]
+        Resource = "arn:aws:lambda:${var.target_region}:${var.target_account_id}:function:ec2-auto-shutdown"
       }
     ]
   })
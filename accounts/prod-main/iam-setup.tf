@@ -61,8 +61,13 @@ resource "aws_iam_role" "cross_account_role" {
     Statement = [
       {
         Effect = "Allow"
+        # The automation role, and the hub Lambda's execution role, which assumes
+        # this role directly in hub mode (HUB_MODE=true)
         Principal = {
-          AWS = "arn:aws:iam::${local.automation_account_id}:role/EC2ShutdownAutomationRole"
+          AWS = [
+            "arn:aws:iam::${local.automation_account_id}:role/EC2ShutdownAutomationRole",
+            "arn:aws:iam::${local.automation_account_id}:role/ec2-shutdown-lambda-role"
+          ]
         }
         Action = "sts:AssumeRole"
         Condition = {
@@ -91,6 +96,7 @@ resource "aws_iam_role_policy" "cross_account_policy" {
         Effect = "Allow"
         Action = [
           "ec2:DescribeInstances",
+          "ec2:DescribeInstanceTypes",
           "ec2:DescribeInstanceStatus",
           "ec2:StopInstances",
           "ec2:DescribeTags",
@@ -0,0 +1,99 @@
+"""
+Measure cold-start cost of the Lambda module in fresh interpreter processes
+
+Reports module import time (from python -X importtime), the heaviest imports,
+and the latency of the first and second lambda_handler calls against a small
+synthetic fleet.
+
+Usage: python lambda/bench/bench_coldstart.py [--runs 5] [--top 8]
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCH_DIR, '..', 'src')
+
+# Runs in a fresh interpreter so nothing is already imported or cached
+FIRST_INVOCATION = """
+import json, logging, sys, time
+started = time.perf_counter()
+import ec2_shutdown
+imported = time.perf_counter()
+from fake_aws import FakeCloudWatch, FakeEC2, make_fleet
+logging.getLogger().setLevel(logging.WARNING)
+instances, cpu_values = make_fleet(200, busy_ratio=0.5)
+fakes = (FakeEC2(instances), FakeCloudWatch([], cpu_values=cpu_values))
+ec2_shutdown.get_target_clients = lambda target: fakes
+ec2_shutdown.DRY_RUN = True
+timings = {'import_ms': (imported - started) * 1000}
+for name in ('first_invocation_ms', 'second_invocation_ms'):
+    invoke_started = time.perf_counter()
+    ec2_shutdown.lambda_handler({}, None)
+    timings[name] = (time.perf_counter() - invoke_started) * 1000
+print(json.dumps(timings))
+"""
+
+
+def environment():
+    env = dict(os.environ)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    env['PYTHONPATH'] = os.pathsep.join([SRC_DIR, BENCH_DIR])
+    return env
+
+
+def import_profile():
+    """Cumulative import time in microseconds per module, from -X importtime"""
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ec2_shutdown'],
+        env=environment(), capture_output=True, text=True, check=True
+    )
+    profile = []
+    for line in completed.stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)', line)
+        if match:
+            profile.append((match.group(4), int(match.group(2)), len(match.group(3))))
+    return profile
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=8, help='number of heaviest top-level imports to list')
+    args = parser.parse_args()
+
+    runs = []
+    for _ in range(args.runs):
+        completed = subprocess.run(
+            [sys.executable, '-c', FIRST_INVOCATION],
+            env=environment(), capture_output=True, text=True, check=True
+        )
+        runs.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    for name in ('import_ms', 'first_invocation_ms', 'second_invocation_ms'):
+        values = [run[name] for run in runs]
+        print(f"{name:>22}: median {statistics.median(values):8.1f}  min {min(values):8.1f}  max {max(values):8.1f}")
+
+    profile = import_profile()
+    total = next(cumulative for module, cumulative, _ in profile if module == 'ec2_shutdown')
+    print(f"\n-X importtime ec2_shutdown: {total / 1000:.1f} ms cumulative; heaviest direct imports:")
+    # -X importtime lists children before their parent, so the direct imports of
+    # ec2_shutdown are the depth-3 entries since the previous top-level import
+    direct = []
+    for module, cumulative, depth in profile:
+        if depth == 1 and module == 'ec2_shutdown':
+            break
+        if depth == 1:
+            direct = []
+        elif depth == 3:
+            direct.append((module, cumulative))
+    for module, cumulative in sorted(direct, key=lambda item: -item[1])[:args.top]:
+        print(f"  {module:<40} {cumulative / 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""
+Compare the thread pool engine with the asyncio engine against a local async HTTP stand-in
+
+Starts an aiohttp server in a subprocess that answers EC2 DescribeInstances and
+StopInstances (query protocol) and CloudWatch GetMetricData (JSON protocol, as
+chosen by recent botocore releases, including the metric math expressions of
+the metric_math evaluation engine) with a fixed latency per request. Every
+region serves the same synthetic fleet. Each execution engine runs
+lambda_handler end to end with each evaluation engine over real
+botocore/aiobotocore clients pointed at it through AWS_ENDPOINT_URL, and all
+must reach the same decisions; exits non-zero otherwise. Prints each run's API
+calls, retries and bytes received and its phase times from invocation_metrics.
+
+Usage: python lambda/bench/bench_engines.py [--sizes 1000,10000,50000] [--regions 4] [--latency-ms 20]
+       [--evaluation-engines python,metric_math]
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+REGIONS = ['us-east-1', 'us-west-2', 'eu-west-1', 'eu-central-1', 'ap-southeast-2', 'ap-northeast-1', 'sa-east-1', 'ca-central-1']
+PAGE_SIZE = 1000
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve(port, size, latency_ms, busy_ratio=0.5, excluded_ratio=0.05):
+    """Run the stand-in; size instances per region, every busy_ratio-th one busy"""
+    import asyncio
+    from aiohttp import web
+    from fake_aws import _evaluate_expression
+
+    launch_time = (datetime.now(timezone.utc) - timedelta(hours=24)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    busy_every = int(1 / busy_ratio) if busy_ratio else 0
+    excluded_every = int(1 / excluded_ratio) if excluded_ratio else 0
+    busy = set()
+
+    items = []
+    for index in range(size):
+        instance_id = f"i-{index:017x}"
+        tags = f"<item><key>Name</key><value>bench-{index}</value></item>"
+        if excluded_every and index % excluded_every == 0:
+            tags += "<item><key>Shutdown</key><value>No</value></item>"
+        if busy_every and index % busy_every == 0:
+            busy.add(instance_id)
+        items.append(
+            f"<item><reservationId>r-{index:017x}</reservationId><instancesSet><item>"
+            f"<instanceId>{instance_id}</instanceId><instanceType>t3.micro</instanceType>"
+            f"<launchTime>{launch_time}</launchTime>"
+            f"<instanceState><code>16</code><name>running</name></instanceState>"
+            f"<monitoring><state>disabled</state></monitoring><tagSet>{tags}</tagSet>"
+            f"</item></instancesSet></item>"
+        )
+
+    # DescribeInstances pages are prebuilt; the next token is the page number
+    pages = []
+    for page_start in range(0, max(size, 1), PAGE_SIZE):
+        next_page = page_start // PAGE_SIZE + 1
+        next_token = f"<nextToken>{next_page}</nextToken>" if page_start + PAGE_SIZE < size else ''
+        pages.append((
+            '<DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">'
+            f"<requestId>bench</requestId><reservationSet>{''.join(items[page_start:page_start + PAGE_SIZE])}</reservationSet>"
+            f"{next_token}</DescribeInstancesResponse>"
+        ).encode())
+
+    def get_metric_data(request):
+        end = int(request['EndTime']) // 300 * 300
+        start = float(request['StartTime'])
+        timestamps = [
+            datetime.fromtimestamp(end - 300 * step, timezone.utc)
+            for step in range(35, -1, -1) if end - 300 * step >= start
+        ]
+        series = {}
+        for query in request['MetricDataQueries']:
+            if 'MetricStat' not in query:
+                continue
+            metric = query['MetricStat']['Metric']
+            instance_id = metric['Dimensions'][0]['Value']
+            value = 0.0
+            if metric['MetricName'] == 'CPUUtilization':
+                value = 50.0 if instance_id in busy else 0.5
+            if query['MetricStat']['Period'] > 300:
+                series[query['Id']] = (timestamps[:1], [float(len(timestamps))])
+            else:
+                series[query['Id']] = (timestamps, [value] * len(timestamps))
+
+        results = []
+        for query in request['MetricDataQueries']:
+            if not query.get('ReturnData', True):
+                continue
+            if 'Expression' in query:
+                query_timestamps, values = _evaluate_expression(query['Expression'], series)
+            else:
+                query_timestamps, values = series[query['Id']]
+            results.append({
+                'Id': query['Id'], 'Label': query['Id'], 'StatusCode': 'Complete',
+                'Timestamps': [timestamp.timestamp() for timestamp in query_timestamps], 'Values': values
+            })
+        return json.dumps({'MetricDataResults': results}).encode()
+
+    def stop_instances(form):
+        instance_ids = [values[0] for key, values in form.items() if key.startswith('InstanceId.')]
+        items = ''.join(
+            f"<item><instanceId>{instance_id}</instanceId>"
+            f"<currentState><code>64</code><name>stopping</name></currentState>"
+            f"<previousState><code>16</code><name>running</name></previousState></item>"
+            for instance_id in instance_ids
+        )
+        return (
+            '<StopInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">'
+            f"<requestId>bench</requestId><instancesSet>{items}</instancesSet></StopInstancesResponse>"
+        ).encode()
+
+    async def handle(request):
+        body = await request.read()
+        await asyncio.sleep(latency_ms / 1000)
+        if request.headers.get('X-Amz-Target', '').endswith('.GetMetricData'):
+            return web.Response(body=get_metric_data(json.loads(body)), content_type='application/x-amz-json-1.0')
+        form = parse_qs(body.decode())
+        action = form.get('Action', [''])[0]
+        if action == 'DescribeInstances':
+            page = int(form.get('NextToken', ['0'])[0])
+            return web.Response(body=pages[page], content_type='text/xml')
+        if action == 'StopInstances':
+            return web.Response(body=stop_instances(form), content_type='text/xml')
+        return web.Response(status=400, text=f"Unsupported action {action}")
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post('/', handle)
+    web.run_app(app, host='127.0.0.1', port=port, print=None, access_log=None)
+
+
+def start_stand_in(port, size, latency_ms):
+    process = subprocess.Popen([
+        sys.executable, __file__, '--serve', '--port', str(port),
+        '--size', str(size), '--latency-ms', str(latency_ms)
+    ])
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('stand-in did not start')
+
+
+def decisions(body):
+    """What an engine decided, independent of result order across regions"""
+    return (
+        body['total_instances_evaluated'],
+        tuple(sorted((result['region'], result['instance_id'], result['status']) for result in body['shutdown_results'])),
+        tuple(sorted((record['region'], record['instance_id']) for record in body['skipped_instances'])),
+        tuple(sorted((record['region'], record['instance_id'], record['signal']) for record in body['active_instances']))
+    )
+
+
+def metrics_summary(snapshot):
+    """API calls, retries and kilobytes received per operation, and seconds per phase, of the last invocation"""
+    operations = '  '.join(
+        f"{operation}={counters['calls']}/{counters['retries']}r/{counters['bytes_received'] / 1024:.0f}KB"
+        for operation, counters in sorted(snapshot['operations'].items())
+    )
+    phases = ' '.join(f"{phase}={seconds:.2f}s" for phase, seconds in sorted(snapshot['phases'].items()))
+    return f"{operations}  phases: {phases}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1000,10000,50000', help='comma-separated total instances across regions')
+    parser.add_argument('--regions', type=int, default=4, help='regions the fleet is split across (at most 8)')
+    parser.add_argument('--latency-ms', type=float, default=20, help='stand-in latency per request')
+    parser.add_argument('--evaluation-engines', default='python,metric_math', help='comma-separated EVALUATION_ENGINE values')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.port, args.size, args.latency_ms)
+        return
+
+    port = free_port()
+    os.environ['AWS_ENDPOINT_URL'] = f"http://127.0.0.1:{port}"
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['AWS_ACCESS_KEY_ID'] = 'bench'
+    os.environ['AWS_SECRET_ACCESS_KEY'] = 'bench'
+    os.environ.pop('AWS_SESSION_TOKEN', None)
+
+    import ec2_shutdown
+
+    logging.getLogger().setLevel(logging.WARNING)
+    # Measure the engines, not the client-side rate limits
+    ec2_shutdown.rate_limiter = None
+    ec2_shutdown.DRY_RUN = False
+    regions = REGIONS[:args.regions]
+
+    print(f"{len(regions)} regions, {args.latency_ms:.0f} ms per request, "
+          f"MAX_REGION_WORKERS={ec2_shutdown.MAX_REGION_WORKERS}, ASYNC_MAX_CONCURRENCY={ec2_shutdown.ASYNC_MAX_CONCURRENCY}")
+    mismatches = 0
+    for size in [int(size) for size in args.sizes.split(',')]:
+        process = start_stand_in(port, size // len(regions), args.latency_ms)
+        try:
+            outcomes = {}
+            for evaluation in args.evaluation_engines.split(','):
+                ec2_shutdown.EVALUATION_ENGINE = evaluation
+                for engine in ('threads', 'asyncio'):
+                    ec2_shutdown.EXECUTION_ENGINE = engine
+                    started = time.perf_counter()
+                    response = ec2_shutdown.lambda_handler({'regions': regions}, None)
+                    elapsed = time.perf_counter() - started
+                    if response['statusCode'] != 200:
+                        raise RuntimeError(f"{engine} engine failed: {response['body']}")
+                    body = response['body']
+                    outcomes[engine, evaluation] = decisions(body)
+                    print(f"{size:>8} instances  {engine:<8} {evaluation:<12} {elapsed:>8.2f}s  "
+                          f"shutdown={body['instances_shutdown']:<6} skipped={body['instances_skipped']}")
+                    print(f"{'':>20}{metrics_summary(ec2_shutdown.invocation_metrics.snapshot())}")
+        finally:
+            process.terminate()
+            process.wait()
+
+        if len(set(outcomes.values())) > 1:
+            mismatches += 1
+            print(f"{size:>8} instances  MISMATCH between engines")
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
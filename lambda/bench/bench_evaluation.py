@@ -0,0 +1,144 @@
+"""
+Compare per-instance idle evaluation with the vectorized NumPy engine and metric math summaries
+
+Generates random CPU series with gaps, jitter, threshold-boundary values and
+recent launches, checks that every engine reaches the same decision for every
+instance, and times them. The python and vectorized times include adding one
+GetMetricData response to their series, as get_instance_metrics does: datapoint
+dicts for python, CPUSeries lists turned into arrays for vectorized.
+lambda/tests/test_idle_matrix.py checks the same decisions under pytest. For
+metric math, the fake CloudWatch holds the same untrimmed series and computes
+the summaries from the expressions the Lambda builds; they are compared with
+is_instance_idle on the datapoints get_instance_metrics fetches from it, which
+is what find_idle_instances passes to the python engine. The metric math time
+includes building the requests and the fake's evaluation. Exits non-zero on any
+mismatch.
+
+Usage: python lambda/bench/bench_evaluation.py [--sizes 500,5000,20000] [--seed 7] [--runs 3]
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import ec2_shutdown  # noqa: E402
+import idle_matrix  # noqa: E402
+from fake_aws import FakeCloudWatch, random_cpu_fleet  # noqa: E402
+from instance_record import InstanceRecord  # noqa: E402
+
+idle_window = ec2_shutdown.idle_window
+
+
+def random_fleet(size, rng):
+    """Random instances and the CPU series their GetMetricData results hold, see random_cpu_fleet"""
+    launch_times, cpu_series = random_cpu_fleet(size, rng, hours=ec2_shutdown.IDLE_DURATION_HOURS)
+    instance_index = {
+        instance_id: InstanceRecord(instance_id, 't3.micro', launch_time)
+        for instance_id, launch_time in launch_times.items()
+    }
+    return instance_index, cpu_series
+
+
+def metric_data_response(cpu_series):
+    """Query IDs and one GetMetricData response holding every instance's CPU series"""
+    query_ids = {f"m{index}_0": (instance_id, 'CPUUtilization') for index, instance_id in enumerate(cpu_series)}
+    results = [
+        {'Id': query_id, 'Timestamps': cpu_series[instance_id][0], 'Values': cpu_series[instance_id][1]}
+        for query_id, (instance_id, _) in query_ids.items()
+    ]
+    return query_ids, {'MetricDataResults': results}
+
+
+def best_of(runs, evaluate):
+    """Lowest time of runs calls to evaluate, and its result"""
+    best = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = evaluate()
+        seconds = time.perf_counter() - started
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def collect(cpu_metrics, query_ids, response):
+    """Add the response to empty per-instance series, as get_instance_metrics does"""
+    ec2_shutdown.add_metric_results(cpu_metrics, {instance_id: {} for instance_id in cpu_metrics}, query_ids, response)
+    return cpu_metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', default='500,5000,20000')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--runs', type=int, default=3, help='python and vectorized times are the lowest of this many runs')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+    rng = random.Random(args.seed)
+    mismatches = 0
+
+    print(f"{'instances':>10} {'idle':>6} {'python_s':>10} {'vectorized_s':>13} {'metric_math_s':>14} {'mismatches':>11}")
+    for size in [int(value) for value in args.sizes.split(',')]:
+        instance_index, cpu_series = random_fleet(size, rng)
+        instance_ids = list(instance_index)
+        query_ids, response = metric_data_response(cpu_series)
+
+        def evaluate_python():
+            cpu_metrics = collect({instance_id: [] for instance_id in instance_ids}, query_ids, response)
+            return {
+                instance_id: ec2_shutdown.is_instance_idle(instance_id, cpu_metrics[instance_id], instance_index)
+                for instance_id in instance_ids
+            }
+
+        def evaluate_vectorized():
+            series = collect({instance_id: idle_matrix.CPUSeries() for instance_id in instance_ids}, query_ids, response)
+            return idle_matrix.evaluate_idle_matrix(
+                instance_ids, series, instance_index, ec2_shutdown.CPU_THRESHOLD,
+                ec2_shutdown.IDLE_DURATION_HOURS, ec2_shutdown.METRIC_GAP_SECONDS,
+                ec2_shutdown.MAX_TOTAL_GAP_SECONDS
+            )
+
+        python_seconds, expected = best_of(args.runs, evaluate_python)
+        vectorized_seconds, actual = best_of(args.runs, evaluate_vectorized)
+
+        # The python engine's decisions on what it fetches from the same fake, in the
+        # same idle window even if a period boundary passes between the two queries
+        window = idle_window()
+        ec2_shutdown.idle_window = lambda: window
+        cloudwatch = FakeCloudWatch(instance_ids, cpu_datapoints={
+            instance_id: list(zip(timestamps, values)) for instance_id, (timestamps, values) in cpu_series.items()
+        })
+        fetched, _ = ec2_shutdown.get_instance_metrics(cloudwatch, instance_ids, signals={})
+        fetched_expected = {
+            instance_id: ec2_shutdown.is_instance_idle(instance_id, list(fetched[instance_id]), instance_index)
+            for instance_id in instance_ids
+        }
+
+        started = time.perf_counter()
+        summaries, _ = ec2_shutdown.get_metric_summaries(cloudwatch, instance_ids, signals={})
+        summarized = {
+            instance_id: ec2_shutdown.is_summary_idle(instance_id, summaries[instance_id], instance_index)
+            for instance_id in instance_ids
+        }
+        metric_math_seconds = time.perf_counter() - started
+
+        differing = [instance_id for instance_id in instance_ids if expected[instance_id] != actual[instance_id]]
+        differing_math = [instance_id for instance_id in instance_ids if fetched_expected[instance_id] != summarized[instance_id]]
+        mismatches += len(differing) + len(differing_math)
+        print(f"{size:>10} {sum(expected.values()):>6} {python_seconds:>10.3f} {vectorized_seconds:>13.3f} "
+              f"{metric_math_seconds:>14.3f} {len(differing) + len(differing_math):>11}")
+        for instance_id in differing[:5]:
+            print(f"  mismatch {instance_id}: python={expected[instance_id]} vectorized={actual[instance_id]}")
+        for instance_id in differing_math[:5]:
+            print(f"  mismatch {instance_id}: python={fetched_expected[instance_id]} metric_math={summarized[instance_id]}")
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Run lambda_handler end to end against a synthetic fleet and report AWS API calls per operation
+
+lambda/tests/test_handler_calls.py checks under pytest that each region is
+listed by one paginated DescribeInstances walk, with no per-instance
+DescribeInstances or GetMetricStatistics calls.
+
+Usage: python lambda/bench/bench_handler.py [--sizes 100,1000,5000] [--latency-ms 1] [--regions 1]
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import ec2_shutdown  # noqa: E402
+from fake_aws import FakeCloudWatch, FakeEC2, make_fleet  # noqa: E402
+
+
+def run(size, latency_ms, busy_ratio, region_count=1):
+    """Run the handler once with size instances in each of region_count fake regions"""
+    regions = [f"fake-region-{index}" for index in range(region_count)]
+    fakes = {}
+    for region in regions:
+        instances, cpu_values = make_fleet(size, busy_ratio=busy_ratio, excluded_ratio=0.05)
+        fakes[region] = (
+            FakeEC2(instances, latency_ms=latency_ms),
+            FakeCloudWatch([], hours=ec2_shutdown.IDLE_DURATION_HOURS, latency_ms=latency_ms, cpu_values=cpu_values)
+        )
+    ec2_shutdown.get_target_clients = lambda target: fakes[target['region']]
+
+    started = time.perf_counter()
+    response = ec2_shutdown.lambda_handler({'regions': regions}, None)
+    elapsed = time.perf_counter() - started
+
+    if response['statusCode'] != 200:
+        raise RuntimeError(response['body'])
+
+    calls = Counter()
+    for ec2, cloudwatch in fakes.values():
+        calls.update(ec2.calls)
+        calls.update(cloudwatch.calls)
+    return response['body'], calls, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', default='100,1000,5000')
+    parser.add_argument('--latency-ms', type=float, default=1.0, help='simulated round-trip latency per API call')
+    parser.add_argument('--busy-ratio', type=float, default=0.5, help='fraction of instances with high CPU')
+    parser.add_argument('--regions', type=int, default=1, help='number of fake regions, each with the full fleet size')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    ec2_shutdown.DRY_RUN = True
+
+    for size in [int(value) for value in args.sizes.split(',')]:
+        body, calls, elapsed = run(size, args.latency_ms, args.busy_ratio, args.regions)
+        call_summary = ', '.join(f"{operation}={count}" for operation, count in sorted(calls.items()))
+        print(f"{size:>8} instances  {elapsed:>8.3f}s  shutdown={body['instances_shutdown']:<6} "
+              f"skipped={body['instances_skipped']:<6} {call_summary}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Compare full DescribeInstances discovery with the event-fed instance inventory
+
+Runs lambda_handler against a fake region whose fleet holds --size instances,
+of which --running-ratio are running. The first run discovers everything,
+reconciles a SQLite inventory and stops the idle instances. Those stops, and
+--changes other instances stopping and starting, reach inventory_handler as
+state-change events; one idle instance is tagged Shutdown=No without any
+event. The next run, from the inventory, must reach the same decisions as a
+full discovery of the changed fleet; exits non-zero otherwise.
+
+Usage: python lambda/bench/bench_inventory.py [--size 20000] [--running-ratio 0.3] [--latency-ms 1]
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import ec2_shutdown  # noqa: E402
+from fake_aws import FakeCloudWatch, FakeEC2, make_fleet  # noqa: E402
+from inventory_store import SQLiteInventoryStore  # noqa: E402
+
+REGION = 'fake-region-0'
+
+
+def state_change_event(instance_id, state):
+    return {
+        'source': 'aws.ec2',
+        'detail-type': 'EC2 Instance State-change Notification',
+        'account': '123456789012',
+        'region': REGION,
+        'time': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'detail': {'instance-id': instance_id, 'state': state}
+    }
+
+
+def run(ec2, cloudwatch, inventory):
+    """Run the handler once; returns its decisions, DescribeInstances calls and time"""
+    ec2_shutdown.inventory_store = inventory
+    ec2.calls.clear()
+    started = time.perf_counter()
+    response = ec2_shutdown.lambda_handler({'regions': [REGION]}, None)
+    elapsed = time.perf_counter() - started
+    if response['statusCode'] != 200:
+        raise RuntimeError(response['body'])
+    body = response['body']
+    decisions = (
+        body['total_instances_evaluated'],
+        sorted(result['instance_id'] for result in body['shutdown_results']),
+        sorted((record['instance_id'], record['reason']) for record in body['skipped_instances'])
+    )
+    return decisions, ec2.calls['DescribeInstances'], elapsed
+
+
+def change_state(instance, state):
+    """Change an instance's state in the fake fleet and deliver the event"""
+    instance['State'] = {'Code': 16 if state == 'running' else 80, 'Name': state}
+    ec2_shutdown.inventory_handler(state_change_event(instance['InstanceId'], state), None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size', type=int, default=20000)
+    parser.add_argument('--running-ratio', type=float, default=0.3, help='fraction of the fleet that is running')
+    parser.add_argument('--changes', type=int, default=200, help='instances that stop, and that start, between runs')
+    parser.add_argument('--latency-ms', type=float, default=1.0, help='simulated round-trip latency per API call')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    ec2_shutdown.DRY_RUN = False
+
+    instances, cpu_values = make_fleet(args.size, busy_ratio=0.5, excluded_ratio=0.05)
+    running_every = max(1, round(1 / args.running_ratio))
+    for index, instance in enumerate(instances):
+        if index % running_every:
+            instance['State'] = {'Code': 80, 'Name': 'stopped'}
+    ec2 = FakeEC2(instances, latency_ms=args.latency_ms)
+    cloudwatch = FakeCloudWatch([], hours=ec2_shutdown.IDLE_DURATION_HOURS, latency_ms=args.latency_ms, cpu_values=cpu_values)
+    ec2_shutdown.get_target_clients = lambda target: (ec2, cloudwatch)
+
+    with tempfile.TemporaryDirectory() as directory:
+        inventory = SQLiteInventoryStore(os.path.join(directory, 'inventory.db'))
+        first_decisions, full_calls, full_seconds = run(ec2, cloudwatch, inventory)
+        print(f"full discovery + reconcile  {full_seconds:>7.3f}s  DescribeInstances={full_calls}")
+
+        # The first run's stops and other state changes, each delivered as an event
+        by_id = {instance['InstanceId']: instance for instance in instances}
+        stopped_ids = set(first_decisions[1])
+        running = [instance for instance in instances if instance['State']['Name'] == 'running' and instance['InstanceId'] not in stopped_ids]
+        stopped = [instance for instance in instances if instance['State']['Name'] == 'stopped']
+        changes = [(by_id[instance_id], 'stopped') for instance_id in sorted(stopped_ids)]
+        changes += [(instance, 'stopped') for instance in running[:args.changes]]
+        changes += [(instance, 'running') for instance in stopped[:args.changes]]
+        started = time.perf_counter()
+        for instance, state in changes:
+            change_state(instance, state)
+        events_seconds = time.perf_counter() - started
+        print(f"{len(changes)} state-change events        {events_seconds:>7.3f}s  "
+              f"({events_seconds * 1000 / max(1, len(changes)):.2f} ms each)")
+
+        # Drift no event reports: an idle instance that just started is excluded by tag
+        drifted = next(
+            instance for instance in stopped[:args.changes]
+            if cpu_values[instance['InstanceId']] < ec2_shutdown.CPU_THRESHOLD
+            and not any(tag['Key'] == 'Shutdown' for tag in instance['Tags'])
+        )
+        drifted['Tags'].append({'Key': 'Shutdown', 'Value': 'No'})
+
+        inventory_decisions, inventory_calls, inventory_seconds = run(ec2, cloudwatch, inventory)
+        print(f"inventory                   {inventory_seconds:>7.3f}s  DescribeInstances={inventory_calls}")
+
+    full_decisions, full_calls, full_seconds = run(ec2, cloudwatch, None)
+    print(f"full discovery              {full_seconds:>7.3f}s  DescribeInstances={full_calls}")
+
+    if inventory_decisions != full_decisions:
+        print("MISMATCH between inventory and full discovery")
+        sys.exit(1)
+    print(f"same decisions: {full_decisions[0]} evaluated, {len(full_decisions[1])} shut down, {len(full_decisions[2])} skipped")
+
+
+if __name__ == '__main__':
+    main()
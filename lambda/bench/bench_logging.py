@@ -0,0 +1,131 @@
+"""
+Compare handler CPU time and log volume with per-instance text logging and with sampled JSON logging
+
+Runs lambda_handler in dry run against a fake region of --size instances with
+no simulated latency. CPU time spent inside the fakes is subtracted, so what
+is reported is the handler's own CPU time. Records go to an in-memory stream
+through the formatter of each LOG_FORMAT. For each configuration, prints the
+lowest handler CPU time of --runs runs and the lines and bytes logged.
+'logging off' raises the level to WARNING as a floor. Every configuration
+must log the same outcome counts; exits non-zero otherwise.
+
+Usage: python lambda/bench/bench_logging.py [--size 20000] [--runs 3] [--sample-rate 0.01]
+"""
+import argparse
+import io
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import ec2_shutdown  # noqa: E402
+from fake_aws import FakeCloudWatch, FakeEC2, FakePaginator, generate_fleet  # noqa: E402
+from structured_logging import JsonFormatter  # noqa: E402
+
+REGION = 'fake-region-0'
+
+
+class CountingStream(io.TextIOBase):
+    """Discards what is written, counting lines and bytes"""
+
+    def __init__(self):
+        self.lines = 0
+        self.bytes = 0
+
+    def write(self, text):
+        self.lines += text.count('\n')
+        self.bytes += len(text)
+        return len(text)
+
+
+class CPUTimedClient:
+    """Wraps a fake client, adding the CPU time of every call to a shared total"""
+
+    def __init__(self, client, totals):
+        self.client = client
+        self.totals = totals
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+
+        def call(**kwargs):
+            started = time.process_time()
+            try:
+                return method(**kwargs)
+            finally:
+                self.totals['fake'] += time.process_time() - started
+        return call
+
+    def get_paginator(self, operation_name):
+        return FakePaginator(getattr(self, operation_name))
+
+
+def run(formatter, level, sample_rate, runs, totals):
+    """Lowest handler CPU time over runs, and the lines and bytes logged by one run"""
+    root = logging.getLogger()
+    best = None
+    for _ in range(runs):
+        stream = CountingStream()
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(formatter)
+        root.handlers = [handler]
+        root.setLevel(level)
+        ec2_shutdown.decision_log.sample_rate = sample_rate
+
+        totals['fake'] = 0.0
+        started = time.process_time()
+        response = ec2_shutdown.lambda_handler({'regions': [REGION]}, None)
+        cpu = time.process_time() - started - totals['fake']
+        if response['statusCode'] != 200:
+            raise RuntimeError(response['body'])
+        if best is None or cpu < best[0]:
+            best = (cpu, stream.lines, stream.bytes, ec2_shutdown.decision_log.summary())
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size', type=int, default=20000)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--sample-rate', type=float, default=0.01, help='LOG_SAMPLE_RATE of the sampled configurations')
+    args = parser.parse_args()
+
+    ec2_shutdown.DRY_RUN = True
+    ec2_shutdown.rate_limiter = None
+    instances, cpu_values, cpu_datapoints = generate_fleet(
+        args.size, idle_ratio=0.5, gap_ratio=0.1, hours=ec2_shutdown.IDLE_DURATION_HOURS
+    )
+    ec2 = FakeEC2(instances)
+    cloudwatch = FakeCloudWatch([], hours=ec2_shutdown.IDLE_DURATION_HOURS, cpu_values=cpu_values, cpu_datapoints=cpu_datapoints)
+    totals = {}
+    clients = (CPUTimedClient(ec2, totals), CPUTimedClient(cloudwatch, totals))
+    ec2_shutdown.get_target_clients = lambda target: clients
+
+    text = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    configurations = [
+        ('text, every instance', text, logging.INFO, 1.0),
+        ('json, every instance', JsonFormatter(), logging.INFO, 1.0),
+        (f"text, sample {args.sample_rate:g}", text, logging.INFO, args.sample_rate),
+        (f"json, sample {args.sample_rate:g}", JsonFormatter(), logging.INFO, args.sample_rate),
+        ('logging off', text, logging.WARNING, 1.0)
+    ]
+
+    results = [(label, run(formatter, level, rate, args.runs, totals)) for label, formatter, level, rate in configurations]
+    sys.stdout.flush()
+    print(f"{args.size} instances")
+    print(f"{'configuration':<24} {'cpu_s':>8} {'lines':>8} {'log_kb':>9}")
+    for label, (cpu, lines, size, _) in results:
+        print(f"{label:<24} {cpu:>8.3f} {lines:>8} {size / 1024:>9.0f}")
+
+    counts = {tuple(sorted(summary.items())) for _, (_, _, _, summary) in results}
+    if len(counts) > 1:
+        print("MISMATCH between outcome counts")
+        sys.exit(1)
+    print(f"outcomes: {dict(counts.pop())}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Measure peak RSS of discovery with raw DescribeInstances dicts vs compact instance records
+
+Each mode runs in a fresh interpreter. Discovery is fed 1000-instance pages of
+full DescribeInstances entries (network interfaces, block device mappings,
+security groups, tags, ...) built one page at a time, as botocore would parse
+them, and indexes every instance for the run the way process_region does.
+'dicts' keeps the raw entries as the pipeline did before instance records,
+'records' goes through page_instances. Reports RSS after imports, peak RSS,
+and the difference per instance.
+
+Usage: python lambda/bench/bench_memory.py [--size 100000]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCH_DIR, '..', 'src')
+PAGE_SIZE = 1000
+
+# Runs in a fresh interpreter so each mode starts from the same baseline
+DISCOVERY = """
+import json, logging, resource, sys
+from datetime import datetime, timedelta, timezone
+import ec2_shutdown
+from fake_aws import describe_instance_entry
+
+def raw_page_instances(page):
+    return [instance for reservation in page['Reservations'] for instance in reservation['Instances']]
+
+def raw_should_skip(instance):
+    tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+    return tags.get('Shutdown', '').lower() == 'no'
+
+logging.getLogger().setLevel(logging.WARNING)
+mode, size, page_size = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+launch_time = datetime.now(timezone.utc) - timedelta(hours=24)
+baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+instance_index = {}
+skipped = 0
+for page_start in range(0, size, page_size):
+    page = {'Reservations': [
+        {'ReservationId': f"r-{index:017x}", 'OwnerId': '123456789012', 'Groups': [],
+         'Instances': [describe_instance_entry(index, launch_time)]}
+        for index in range(page_start, min(size, page_start + page_size))
+    ]}
+    if mode == 'dicts':
+        for instance in raw_page_instances(page):
+            instance_index[instance['InstanceId']] = instance
+            skipped += raw_should_skip(instance)
+    else:
+        for instance in ec2_shutdown.page_instances(page):
+            instance_index[instance.instance_id] = instance
+            skipped += ec2_shutdown.should_skip_instance(instance) is not None
+    del page
+
+peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({'instances': len(instance_index), 'baseline_kb': baseline_kb, 'peak_kb': peak_kb}))
+"""
+
+
+def measure(mode, size):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([SRC_DIR, BENCH_DIR]))
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    output = subprocess.run(
+        [sys.executable, '-c', DISCOVERY, mode, str(size), str(PAGE_SIZE)],
+        env=env, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size', type=int, default=100000, help='instances in the synthetic fleet')
+    args = parser.parse_args()
+
+    print(f"{'mode':>8} {'instances':>10} {'baseline_mb':>12} {'peak_mb':>9} {'growth_mb':>10} {'bytes/instance':>15}")
+    for mode in ('dicts', 'records'):
+        result = measure(mode, args.size)
+        growth_kb = result['peak_kb'] - result['baseline_kb']
+        print(f"{mode:>8} {result['instances']:>10} {result['baseline_kb'] / 1024:>12.1f} {result['peak_kb'] / 1024:>9.1f} "
+              f"{growth_kb / 1024:>10.1f} {growth_kb * 1024 / max(1, result['instances']):>15.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Benchmark CPU metric retrieval: one GetMetricStatistics per instance vs batched GetMetricData
+
+Usage: python lambda/bench/bench_metrics.py [--sizes 100,1000,5000,20000] [--latency-ms 2]
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import ec2_shutdown  # noqa: E402
+from fake_aws import FakeCloudWatch  # noqa: E402
+
+
+def fetch_per_instance(cloudwatch, instance_ids):
+    """Baseline: the original one-request-per-instance GetMetricStatistics loop"""
+    end_time = datetime.utcnow()
+    start_time = end_time - timedelta(hours=ec2_shutdown.IDLE_DURATION_HOURS)
+    metrics = {}
+    for instance_id in instance_ids:
+        response = cloudwatch.get_metric_statistics(
+            Namespace='AWS/EC2',
+            MetricName='CPUUtilization',
+            Dimensions=[{'Name': 'InstanceId', 'Value': instance_id}],
+            StartTime=start_time,
+            EndTime=end_time,
+            Period=300,
+            Statistics=['Average']
+        )
+        metrics[instance_id] = response['Datapoints']
+    return metrics
+
+
+def fetch_batched(cloudwatch, instance_ids):
+    # CPU only, to compare like for like with GetMetricStatistics
+    return ec2_shutdown.get_instance_metrics(cloudwatch, instance_ids, signals={})[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', default='100,1000,5000,20000')
+    parser.add_argument('--latency-ms', type=float, default=2.0, help='simulated round-trip latency per API call')
+    args = parser.parse_args()
+
+    print(f"{'instances':>10} {'strategy':>20} {'api_calls':>10} {'seconds':>10} {'datapoints':>12}")
+    for size in [int(value) for value in args.sizes.split(',')]:
+        instance_ids = [f"i-{index:017x}" for index in range(size)]
+        for name, fetch in (('GetMetricStatistics', fetch_per_instance), ('GetMetricData', fetch_batched)):
+            cloudwatch = FakeCloudWatch(instance_ids, hours=ec2_shutdown.IDLE_DURATION_HOURS, latency_ms=args.latency_ms)
+            started = time.perf_counter()
+            metrics = fetch(cloudwatch, instance_ids)
+            elapsed = time.perf_counter() - started
+            datapoints = sum(len(series) for series in metrics.values())
+            print(f"{size:>10} {name:>20} {sum(cloudwatch.calls.values()):>10} {elapsed:>10.3f} {datapoints:>12}")
+
+
+if __name__ == '__main__':
+    main()
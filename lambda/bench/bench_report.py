@@ -0,0 +1,119 @@
+"""
+Compare response size and peak memory with records in the response and with a report sink
+
+Runs lambda_handler in dry run against fake regions holding --size instances in
+total, with no simulated latency: once keeping every record in the response,
+then with a file report sink in a temporary directory for each REPORT_FORMAT
+that can be written here (Parquet needs pyarrow). For each configuration,
+prints the time and peak traced memory (both inflated by tracemalloc), the
+memory still held when the handler returns, the JSON size of the response
+and the size of the report files. Discovered instances are indexed per target
+either way, so the peak falls by less than the records' share of it. Every
+report must hold the same records as the response; exits non-zero otherwise.
+
+Usage: python lambda/bench/bench_report.py [--size 20000] [--regions 2] [--chunk-records 10000]
+"""
+import argparse
+import glob
+import importlib.util
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import ec2_shutdown  # noqa: E402
+from fake_aws import FakeCloudWatch, FakeEC2, make_fleet  # noqa: E402
+from report_sink import REPORT_KINDS, FileReportSink  # noqa: E402
+
+
+def response_records(body):
+    """Every record of a response as (kind, region, instance ID)"""
+    return sorted(
+        (kind, record['region'], record['instance_id'])
+        for kind in REPORT_KINDS for record in body[kind] if kind != 'monitoring_enabled'
+    )
+
+
+def report_records(location, report_format):
+    """Every record of the report parts in a directory as (kind, region, instance ID)"""
+    rows = []
+    for path in glob.glob(os.path.join(location, f"*.{report_format}")):
+        if report_format == 'parquet':
+            import pyarrow.parquet
+            rows.extend(pyarrow.parquet.read_table(path).to_pylist())
+        else:
+            with open(path) as f:
+                rows.extend(json.loads(line) for line in f)
+    return sorted(
+        (row['record_type'], row['region'], row['instance_id'])
+        for row in rows if row['record_type'] != 'monitoring_enabled'
+    )
+
+
+def run(regions):
+    """Seconds, peak traced bytes, bytes still held by the response, and response body of one invocation"""
+    tracemalloc.start()
+    started = time.perf_counter()
+    response = ec2_shutdown.lambda_handler({'regions': regions}, None)
+    seconds = time.perf_counter() - started
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if response['statusCode'] != 200:
+        raise RuntimeError(response['body'])
+    return seconds, peak, held, response['body']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size', type=int, default=20000, help='instances across all regions')
+    parser.add_argument('--regions', type=int, default=2)
+    parser.add_argument('--chunk-records', type=int, default=10000, help='REPORT_CHUNK_RECORDS of the report sinks')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    ec2_shutdown.DRY_RUN = True
+    ec2_shutdown.rate_limiter = None
+
+    regions = [f"fake-region-{index}" for index in range(args.regions)]
+    clients = {}
+    for region in regions:
+        instances, cpu_values = make_fleet(args.size // args.regions, busy_ratio=0.5, excluded_ratio=0.05)
+        clients[region] = (FakeEC2(instances), FakeCloudWatch([], hours=ec2_shutdown.IDLE_DURATION_HOURS, cpu_values=cpu_values))
+    ec2_shutdown.get_target_clients = lambda target: clients[target['region']]
+
+    print(f"{args.size} instances in {args.regions} regions")
+    print(f"{'configuration':<18} {'seconds':>8} {'peak_mb':>8} {'held_mb':>8} {'response_kb':>12} {'report_kb':>10}")
+
+    ec2_shutdown.report_sink = None
+    seconds, peak, held, body = run(regions)
+    expected = response_records(body)
+    print(f"{'response body':<18} {seconds:>8.2f} {peak / 2**20:>8.1f} {held / 2**20:>8.1f} "
+          f"{len(json.dumps(body)) / 1024:>12.1f} {'':>10}")
+
+    formats = ['ndjson'] + (['parquet'] if importlib.util.find_spec('pyarrow') else [])
+    mismatches = 0
+    for report_format in formats:
+        with tempfile.TemporaryDirectory() as directory:
+            ec2_shutdown.report_sink = FileReportSink(directory, report_format, args.chunk_records)
+            seconds, peak, held, body = run(regions)
+            location = body['report_location']
+            report_size = sum(os.path.getsize(path) for path in glob.glob(os.path.join(location, '*')))
+            print(f"{'sink, ' + report_format:<18} {seconds:>8.2f} {peak / 2**20:>8.1f} {held / 2**20:>8.1f} "
+                  f"{len(json.dumps(body)) / 1024:>12.1f} {report_size / 1024:>10.0f}")
+            if report_records(location, report_format) != expected:
+                mismatches += 1
+                print(f"MISMATCH between the {report_format} report and the response records")
+    if 'parquet' not in formats:
+        print("pyarrow is not installed, parquet skipped")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Compare evaluating every running instance with the per-instance evaluation schedule
+
+Runs lambda_handler in dry run against a fake region of --size instances, half
+of them busy and every tenth launched an hour ago, with each evaluation engine:
+once without a schedule store, then twice with an empty SQLite schedule. The
+first scheduled run queries everything not still in its launch buffer and
+records when each active instance can next be idle; the second only queries
+instances that are due. Every run must reach the same decisions; exits
+non-zero otherwise.
+
+Usage: python lambda/bench/bench_schedule.py [--size 20000] [--latency-ms 1] [--evaluation-engines python,metric_math]
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import ec2_shutdown  # noqa: E402
+from fake_aws import FakeCloudWatch, FakeEC2, make_fleet  # noqa: E402
+from state_store import SCHEDULE_FIELDS, SQLiteStateStore  # noqa: E402
+
+REGION = 'fake-region-0'
+
+
+def run(ec2, cloudwatch):
+    """Run the handler once; returns its decisions, the number of scheduled instances, calls and time"""
+    cloudwatch.calls.clear()
+    cloudwatch.datapoints_returned = 0
+    started = time.perf_counter()
+    response = ec2_shutdown.lambda_handler({'regions': [REGION]}, None)
+    elapsed = time.perf_counter() - started
+    if response['statusCode'] != 200:
+        raise RuntimeError(response['body'])
+    body = response['body']
+    decisions = (
+        body['total_instances_evaluated'],
+        tuple(sorted(result['instance_id'] for result in body['shutdown_results'])),
+        tuple(sorted(record['instance_id'] for record in body['skipped_instances'])),
+        tuple(sorted((record['instance_id'], record['signal']) for record in body['active_instances']))
+    )
+    scheduled = sum(1 for record in body['active_instances'] if 'next_check' in record)
+    return decisions, scheduled, cloudwatch.calls['GetMetricData'], cloudwatch.datapoints_returned, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size', type=int, default=20000)
+    parser.add_argument('--latency-ms', type=float, default=1.0, help='simulated round-trip latency per API call')
+    parser.add_argument('--evaluation-engines', default='python,metric_math', help='comma-separated EVALUATION_ENGINE values')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    ec2_shutdown.DRY_RUN = True
+
+    instances, cpu_values = make_fleet(args.size, busy_ratio=0.5, excluded_ratio=0.05)
+    recent_launch = datetime.now(timezone.utc) - timedelta(hours=1)
+    for index, instance in enumerate(instances):
+        if index % 10 == 3:
+            instance['LaunchTime'] = recent_launch
+    ec2 = FakeEC2(instances, latency_ms=args.latency_ms)
+    cloudwatch = FakeCloudWatch([], hours=ec2_shutdown.IDLE_DURATION_HOURS, latency_ms=args.latency_ms, cpu_values=cpu_values)
+    ec2_shutdown.get_target_clients = lambda target: (ec2, cloudwatch)
+
+    print(f"{'engine':<12} {'run':<12} {'seconds':>8} {'GetMetricData':>14} {'datapoints':>11} {'scheduled':>10}")
+    mismatches = 0
+    for evaluation in args.evaluation_engines.split(','):
+        ec2_shutdown.EVALUATION_ENGINE = evaluation
+        with tempfile.TemporaryDirectory() as directory:
+            outcomes = []
+            for label, store in (
+                ('unscheduled', None),
+                ('first', SQLiteStateStore(os.path.join(directory, 'schedule.db'), SCHEDULE_FIELDS, 'evaluation_schedule')),
+                ('second', 'keep')
+            ):
+                if store != 'keep':
+                    ec2_shutdown.schedule_store = store
+                decisions, scheduled, calls, datapoints, elapsed = run(ec2, cloudwatch)
+                outcomes.append(decisions)
+                print(f"{evaluation:<12} {label:<12} {elapsed:>8.3f} {calls:>14} {datapoints:>11} {scheduled:>10}")
+            ec2_shutdown.schedule_store = None
+
+        if len(set(outcomes)) > 1:
+            mismatches += 1
+            print(f"{evaluation:<12} MISMATCH between scheduled and unscheduled runs")
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Compare a single run with a coordinator, parallel shard workers and the aggregated report
+
+Runs lambda_handler in dry run against fake regions holding --size instances in
+total: once as a single run, then with an in-memory work queue and a file
+checkpoint store. The coordinator invocation queues shards of
+--shard-size instance IDs, --workers threads each invoke the handler with one
+SQS-shaped message at a time, as concurrent Lambda workers would, and an
+{'aggregate_run_id': ...} invocation returns the merged report. Both must reach
+the same decisions; exits non-zero otherwise.
+
+Usage: python lambda/bench/bench_sharding.py [--size 20000] [--regions 2] [--shard-size 1000] [--workers 8] [--latency-ms 5]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import ec2_shutdown  # noqa: E402
+from checkpoint_store import FileCheckpointStore  # noqa: E402
+from fake_aws import FakeCloudWatch, FakeEC2, make_fleet  # noqa: E402
+from work_queue import MemoryWorkQueue  # noqa: E402
+
+
+def decisions(body):
+    """What a run decided, independent of result order"""
+    return (
+        body['total_instances_evaluated'],
+        tuple(sorted((result['region'], result['instance_id']) for result in body['shutdown_results'])),
+        tuple(sorted((record['region'], record['instance_id']) for record in body['skipped_instances'])),
+        tuple(sorted((record['region'], record['instance_id'], record['signal']) for record in body['active_instances']))
+    )
+
+
+def worker(queue, index):
+    """Invoke the handler with one queued shard at a time until the queue is empty"""
+    handled = 0
+    while True:
+        messages = queue.receive(1)
+        if not messages:
+            return handled
+        event = {'Records': [
+            {'messageId': f"worker-{index}-{handled}", 'eventSource': 'aws:sqs', 'body': json.dumps(message)}
+            for message in messages
+        ]}
+        response = ec2_shutdown.lambda_handler(event, None)
+        if response['batchItemFailures']:
+            raise RuntimeError(f"Shard failed: {response['batchItemFailures']}")
+        handled += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size', type=int, default=20000, help='instances across all regions')
+    parser.add_argument('--regions', type=int, default=2)
+    parser.add_argument('--shard-size', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=8, help='concurrent worker invocations')
+    parser.add_argument('--latency-ms', type=float, default=5.0, help='simulated round-trip latency per API call')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    ec2_shutdown.DRY_RUN = True
+    ec2_shutdown.WORK_QUEUE_SHARD_SIZE = args.shard_size
+
+    regions = [f"fake-region-{index}" for index in range(args.regions)]
+    clients = {}
+    for region in regions:
+        instances, cpu_values = make_fleet(args.size // args.regions, busy_ratio=0.5, excluded_ratio=0.05)
+        clients[region] = (
+            FakeEC2(instances, latency_ms=args.latency_ms),
+            FakeCloudWatch([], hours=ec2_shutdown.IDLE_DURATION_HOURS, latency_ms=args.latency_ms, cpu_values=cpu_values)
+        )
+    ec2_shutdown.get_target_clients = lambda target: clients[target['region']]
+
+    started = time.perf_counter()
+    single = ec2_shutdown.lambda_handler({'regions': regions}, None)
+    single_seconds = time.perf_counter() - started
+    print(f"single run                  {single_seconds:>8.2f}s")
+
+    with tempfile.TemporaryDirectory() as directory:
+        queue = MemoryWorkQueue()
+        ec2_shutdown.work_queue = queue
+        ec2_shutdown.checkpoint_store = FileCheckpointStore(directory)
+
+        started = time.perf_counter()
+        coordinated = ec2_shutdown.lambda_handler({'regions': regions}, None)
+        coordinator_seconds = time.perf_counter() - started
+        run_id = coordinated['body']['run_id']
+        print(f"coordinator                 {coordinator_seconds:>8.2f}s  {coordinated['body']['shards']} shards")
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            handled = list(executor.map(lambda index: worker(queue, index), range(args.workers)))
+        workers_seconds = time.perf_counter() - started
+        print(f"{args.workers} workers                   {workers_seconds:>8.2f}s  shards per worker {handled}")
+
+        ec2_shutdown.work_queue = None
+        aggregated = ec2_shutdown.lambda_handler({'aggregate_run_id': run_id}, None)
+
+    if aggregated['statusCode'] != 200 or decisions(aggregated['body']) != decisions(single['body']):
+        print("MISMATCH between the single run and the sharded run")
+        sys.exit(1)
+    print(f"same decisions: {aggregated['body']['total_instances_evaluated']} evaluated, "
+          f"{aggregated['body']['instances_shutdown']} shut down, {aggregated['body']['instances_skipped']} skipped")
+
+
+if __name__ == '__main__':
+    main()
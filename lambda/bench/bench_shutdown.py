@@ -0,0 +1,106 @@
+"""
+Compare the stop and hibernate shutdown strategies on a fleet with hibernation-configured instances
+
+Runs lambda_handler against fake regions holding --size idle instances in
+total, --hibernation-ratio of them launched with hibernation configured on one
+of four instance types, one of which does not support hibernation; one in a
+hundred of those fails to hibernate and must be stopped instead. Runs once with
+SHUTDOWN_STRATEGY=stop, then twice with 'hibernate' from an empty instance
+type cache: the first describes each type once across all regions, the second
+describes none. For each run, prints the time and the StopInstances and
+DescribeInstanceTypes calls, and how many instances were hibernated and
+stopped. Every instance must be shut down once, and exactly the capable ones
+hibernated; exits non-zero otherwise.
+
+Usage: python lambda/bench/bench_shutdown.py [--size 20000] [--regions 4] [--hibernation-ratio 0.25] [--latency-ms 5]
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import ec2_shutdown  # noqa: E402
+from fake_aws import HIBERNATION_INSTANCE_TYPES, FakeCloudWatch, FakeEC2, make_fleet  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size', type=int, default=20000, help='instances across all regions')
+    parser.add_argument('--regions', type=int, default=4)
+    parser.add_argument('--hibernation-ratio', type=float, default=0.25)
+    parser.add_argument('--latency-ms', type=float, default=5.0, help='simulated round-trip latency per API call')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    ec2_shutdown.DRY_RUN = False
+    ec2_shutdown.rate_limiter = None
+
+    regions = [f"fake-region-{index}" for index in range(args.regions)]
+    fleets = {}
+    expected_hibernated = set()
+    for region in regions:
+        instances, cpu_values = make_fleet(args.size // args.regions, hibernation_ratio=args.hibernation_ratio)
+        # Instance IDs repeat across regions, so each region's are made unique
+        for instance in instances:
+            instance['InstanceId'] = f"{instance['InstanceId']}-{region[-1]}"
+        cpu_values = {f"{instance_id}-{region[-1]}": value for instance_id, value in cpu_values.items()}
+        configured = [
+            instance['InstanceId'] for instance in instances
+            if instance.get('HibernationOptions', {}).get('Configured')
+            and instance['InstanceType'] in HIBERNATION_INSTANCE_TYPES
+        ]
+        hibernate_errors = {instance_id: 'UnsupportedHibernationConfiguration' for instance_id in configured[::100]}
+        expected_hibernated.update(set(configured) - set(hibernate_errors))
+        fleets[region] = (instances, cpu_values, hibernate_errors)
+
+    print(f"{args.size} idle instances in {args.regions} regions, {args.latency_ms:.0f} ms per call, "
+          f"{len(expected_hibernated)} can hibernate")
+    print(f"{'run':<22} {'seconds':>8} {'stop_calls':>11} {'type_calls':>11} {'hibernated':>11} {'stopped':>8}")
+
+    ec2_shutdown._hibernation_support.clear()
+    failures = 0
+    for label, strategy in (('stop', 'stop'), ('hibernate, cold cache', 'hibernate'), ('hibernate, warm cache', 'hibernate')):
+        ec2_shutdown.SHUTDOWN_STRATEGY = strategy
+        clients = {
+            region: (
+                FakeEC2(instances, latency_ms=args.latency_ms, hibernate_errors=hibernate_errors),
+                FakeCloudWatch([], hours=ec2_shutdown.IDLE_DURATION_HOURS, cpu_values=cpu_values)
+            )
+            for region, (instances, cpu_values, hibernate_errors) in fleets.items()
+        }
+        ec2_shutdown.get_target_clients = lambda target: clients[target['region']]
+
+        started = time.perf_counter()
+        response = ec2_shutdown.lambda_handler({'regions': regions}, None)
+        seconds = time.perf_counter() - started
+        if response['statusCode'] != 200:
+            raise RuntimeError(response['body'])
+
+        fakes = [ec2 for ec2, _ in clients.values()]
+        hibernated = [instance_id for ec2 in fakes for instance_id in ec2.hibernated]
+        stopped = [instance_id for ec2 in fakes for instance_id in ec2.stopped]
+        stop_calls = sum(ec2.calls['StopInstances'] for ec2 in fakes)
+        type_calls = sum(ec2.calls['DescribeInstanceTypes'] for ec2 in fakes)
+        print(f"{label:<22} {seconds:>8.2f} {stop_calls:>11} {type_calls:>11} {len(hibernated):>11} {len(stopped):>8}")
+
+        shut_down = hibernated + stopped
+        if len(shut_down) != args.size // args.regions * args.regions or len(set(shut_down)) != len(shut_down):
+            failures += 1
+            print(f"{label}: MISMATCH, instances not shut down exactly once")
+        if set(hibernated) != (expected_hibernated if strategy == 'hibernate' else set()):
+            failures += 1
+            print(f"{label}: MISMATCH between hibernated and hibernation-capable instances")
+        if any(result['status'] != 'success' for result in response['body']['shutdown_results']):
+            failures += 1
+            print(f"{label}: shutdown errors")
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+Compare default botocore client settings with the shared CLIENT_CONFIG, alone and
+with the client-side rate limiter, against a throttling stub
+
+Starts a local HTTP endpoint that answers EC2 DescribeInstances and throttles
+with RequestLimitExceeded above a fixed request rate (a token bucket), then
+drives it from concurrent worker threads sharing one real botocore client.
+Reports throughput, calls that failed after retries, and throttled responses.
+
+Usage: python lambda/bench/bench_throttling.py [--workers 4,16,32] [--calls 40] [--rate 100] [--latency-ms 5]
+"""
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import ec2_shutdown  # noqa: E402
+from rate_limiter import RateLimiter  # noqa: E402
+
+DESCRIBE_RESPONSE = (
+    b'<DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">'
+    b'<requestId>bench</requestId><reservationSet/></DescribeInstancesResponse>'
+)
+THROTTLE_RESPONSE = (
+    b'<Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+    b'<Message>Request limit exceeded.</Message></Error></Errors>'
+    b'<RequestID>bench</RequestID></Response>'
+)
+
+
+class ThrottlingStub:
+    """Token-bucket rate limit shared by every request the stub server handles"""
+
+    def __init__(self, rate: float, latency_ms: float):
+        self.rate = rate
+        # Bursts of up to one second's worth of requests, like the EC2 API buckets
+        self.capacity = max(1.0, rate)
+        self.latency = latency_ms / 1000
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.accepted = 0
+        self.throttled = 0
+
+    def admit(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.accepted += 1
+                return True
+            self.throttled += 1
+            return False
+
+    def reset(self) -> None:
+        with self.lock:
+            self.tokens = self.capacity
+            self.updated = time.monotonic()
+            self.accepted = 0
+            self.throttled = 0
+
+
+def start_server(stub: ThrottlingStub) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(stub.latency)
+            if stub.admit():
+                status, body = 200, DESCRIBE_RESPONSE
+            else:
+                status, body = 503, THROTTLE_RESPONSE
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/xml')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run(endpoint, config, limiter, stub, workers, calls):
+    """Issue workers * calls DescribeInstances through one shared client"""
+    client = boto3.session.Session().client(
+        'ec2', region_name='us-east-1', endpoint_url=endpoint, config=config,
+        aws_access_key_id='bench', aws_secret_access_key='bench'
+    )
+    if limiter:
+        limiter.attach(client, 'bench')
+    failed = 0
+    failed_lock = threading.Lock()
+
+    def worker():
+        nonlocal failed
+        for _ in range(calls):
+            try:
+                client.describe_instances()
+            except ClientError:
+                with failed_lock:
+                    failed += 1
+
+    stub.reset()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(worker) for _ in range(workers)]:
+            future.result()
+    elapsed = time.perf_counter() - started
+    succeeded = workers * calls - failed
+    return elapsed, succeeded, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', default='4,16,32', help='comma-separated concurrent worker counts')
+    parser.add_argument('--calls', type=int, default=40, help='calls per worker')
+    parser.add_argument('--rate', type=float, default=100, help='requests per second the stub accepts')
+    parser.add_argument('--latency-ms', type=float, default=5, help='stub response latency')
+    args = parser.parse_args()
+
+    # Default pool overflow warnings are part of what is being measured, not noise to print
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('urllib3').setLevel(logging.ERROR)
+
+    stub = ThrottlingStub(args.rate, args.latency_ms)
+    server = start_server(stub)
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}"
+    configs = {
+        'default': (Config(), None),
+        'shared': (ec2_shutdown.CLIENT_CONFIG, None),
+        # Configured slightly above the stub's limit so the bucket has to adapt
+        'limited': (ec2_shutdown.CLIENT_CONFIG, RateLimiter({'DescribeInstances': args.rate * 0.9}))
+    }
+
+    print(f"stub limit {args.rate:.0f} req/s, {args.latency_ms:.0f} ms latency, "
+          f"shared config: {ec2_shutdown.CLIENT_MAX_ATTEMPTS} attempts adaptive, "
+          f"pool {ec2_shutdown.CLIENT_MAX_POOL_CONNECTIONS}")
+    for workers in [int(count) for count in args.workers.split(',')]:
+        for name, (config, limiter) in configs.items():
+            elapsed, succeeded, failed = run(endpoint, config, limiter, stub, workers, args.calls)
+            print(f"{workers:>4} workers  {name:<8} {elapsed:>7.2f}s  {succeeded / elapsed:>7.1f} ok/s  "
+                  f"failed={failed:<5} throttled={stub.throttled}")
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,585 @@
+"""
+In-process stand-ins for the AWS APIs used by the EC2 auto-shutdown Lambda
+Used by the benchmarks so they can run offline without AWS credentials
+"""
+import fnmatch
+import random
+import re
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Any, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+
+# Instance types the fakes report as supporting hibernation
+HIBERNATION_INSTANCE_TYPES = {'m5.large', 'c5.xlarge', 'r5.large', 't3.micro'}
+
+# Types make_fleet cycles through for hibernation-configured instances; the
+# last one does not support hibernation, like a type changed after launch
+HIBERNATION_FLEET_TYPES = ('m5.large', 'c5.xlarge', 'r5.large', 'm4.large')
+
+
+def make_fleet(size: int, busy_ratio: float = 0.0, excluded_ratio: float = 0.0,
+               monitoring_state: str = 'disabled', launched_hours_ago: int = 24,
+               hibernation_ratio: float = 0.0):
+    """
+    Build a synthetic fleet of running instances in describe_instances shape
+    hibernation_ratio of the instances are launched with hibernation configured,
+    on one of HIBERNATION_FLEET_TYPES
+    Returns (instances, cpu_values) where cpu_values maps instance ID to its average CPU
+    """
+    launch_time = datetime.now(timezone.utc) - timedelta(hours=launched_hours_ago)
+    busy_every = int(1 / busy_ratio) if busy_ratio else 0
+    excluded_every = int(1 / excluded_ratio) if excluded_ratio else 0
+    hibernation_every = int(1 / hibernation_ratio) if hibernation_ratio else 0
+
+    instances = []
+    cpu_values = {}
+    for index in range(size):
+        instance_id = f"i-{index:017x}"
+        tags = [{'Key': 'Name', 'Value': f"bench-{index}"}]
+        if excluded_every and index % excluded_every == 0:
+            tags.append({'Key': 'Shutdown', 'Value': 'No'})
+
+        instance = {
+            'InstanceId': instance_id,
+            'InstanceType': 't3.micro',
+            'LaunchTime': launch_time,
+            'State': {'Code': 16, 'Name': 'running'},
+            'Monitoring': {'State': monitoring_state},
+            'Tags': tags
+        }
+        if hibernation_every and index % hibernation_every == 0:
+            instance['InstanceType'] = HIBERNATION_FLEET_TYPES[index // hibernation_every % len(HIBERNATION_FLEET_TYPES)]
+            instance['HibernationOptions'] = {'Configured': True}
+        instances.append(instance)
+        cpu_values[instance_id] = 50.0 if busy_every and index % busy_every == 0 else 0.5
+
+    return instances, cpu_values
+
+
+# Shapes of the holes generate_fleet can put in CPU series
+GAP_PATTERNS = ('sparse', 'burst', 'stale')
+
+
+def generate_fleet(size: int, idle_ratio: float = 0.5, gap_ratio: float = 0.0, gap_pattern: str = 'mixed',
+                   excluded_ratio: float = 0.05, hours: int = 3, seed: int = 7):
+    """
+    Build a random synthetic fleet in describe_instances shape
+    idle_ratio of the instances average below the CPU threshold, the rest above it;
+    gap_ratio of them miss CPU datapoints: 'sparse' drops single datapoints,
+    'burst' a 20-minute run, 'stale' the newest 30 minutes, 'mixed' one of these
+    per instance. hours must match the FakeCloudWatch the series are served from
+    Returns (instances, cpu_values, cpu_datapoints) for FakeEC2 and FakeCloudWatch
+    """
+    rng = random.Random(seed)
+    instances, _ = make_fleet(size, excluded_ratio=excluded_ratio)
+    end = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    count = hours * 12
+    timestamps = [end - timedelta(minutes=5 * (count - i)) for i in range(count)]
+
+    cpu_values = {}
+    cpu_datapoints = {}
+    for instance in instances:
+        instance_id = instance['InstanceId']
+        value = rng.uniform(0.05, 0.95) if rng.random() < idle_ratio else rng.uniform(5.0, 95.0)
+        cpu_values[instance_id] = value
+        if rng.random() >= gap_ratio:
+            continue
+
+        pattern = rng.choice(GAP_PATTERNS) if gap_pattern == 'mixed' else gap_pattern
+        if pattern == 'sparse':
+            missing = set(rng.sample(range(count), rng.randint(1, 4)))
+        elif pattern == 'burst':
+            start = rng.randrange(count - 4)
+            missing = set(range(start, start + 4))
+        elif pattern == 'stale':
+            missing = set(range(count - 6, count))
+        else:
+            raise ValueError(f"Unsupported gap pattern: {gap_pattern}")
+        cpu_datapoints[instance_id] = [
+            (timestamp, value) for index, timestamp in enumerate(timestamps) if index not in missing
+        ]
+
+    return instances, cpu_values, cpu_datapoints
+
+
+def random_cpu_fleet(size: int, rng: random.Random, hours: int = 3):
+    """
+    Random launch times and CPU series covering the edge cases of is_instance_idle:
+    missing and recent launches, short and long series, dropped datapoints,
+    timestamp jitter, and values on, just above and far above a 1% threshold, or NaN
+    Returns (launch_times, cpu_series) where cpu_series maps instance ID to the
+    (Timestamps, Values) lists of its GetMetricData result, oldest first
+    """
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    expected = hours * 12
+    launch_times = {}
+    cpu_series = {}
+
+    for index in range(size):
+        instance_id = f"i-{index:017x}"
+        launch_hours = rng.choice([None, 1, hours + 0.4, hours + 0.6, hours + 2, 24, 24, 24])
+        launch_times[instance_id] = None
+        if launch_hours is not None:
+            launch_times[instance_id] = now - timedelta(hours=launch_hours, seconds=rng.randint(0, 60))
+
+        length = rng.choice([0, rng.randint(1, expected), expected - 4, expected - 3, expected, expected + 2])
+        drop_rate = rng.choice([0.0, 0.0, 0.03, 0.1])
+        busy_rate = rng.choice([0.0, 0.0, 0.0, 0.02, 0.5])
+        jitter = rng.choice([0, 0, 45])
+
+        datapoints = []
+        for step in range(length):
+            if rng.random() < drop_rate:
+                continue
+            timestamp = now - timedelta(seconds=300 * (length - step) + rng.randint(-jitter, jitter))
+            if rng.random() < busy_rate:
+                value = rng.choice([1.0001, 5.0, 80.0, float('nan')])
+            else:
+                value = rng.choice([0.0, 0.3, 0.9, 1.0])
+            datapoints.append((timestamp, value))
+        datapoints.sort(key=lambda datapoint: datapoint[0])
+        cpu_series[instance_id] = ([timestamp for timestamp, _ in datapoints], [value for _, value in datapoints])
+
+    return launch_times, cpu_series
+
+
+def _round_trip(service: Any, operation: str, throttle_code: str) -> None:
+    """
+    Count a call, sleep for the service's latency plus jitter, and throttle a
+    throttle_rate fraction of calls the way the real API answers them
+    """
+    service.calls[operation] += 1
+    latency = service.latency
+    if service.latency_jitter:
+        latency += service.rng.uniform(0, service.latency_jitter)
+    if latency:
+        time.sleep(latency)
+    if service.throttle_rate and service.rng.random() < service.throttle_rate:
+        service.throttled[operation] += 1
+        raise ClientError({'Error': {'Code': throttle_code, 'Message': 'Rate exceeded'}}, operation)
+
+
+def describe_instance_entry(index: int, launch_time: datetime) -> Dict[str, Any]:
+    """
+    A running instance with every field DescribeInstances returns for a typical
+    EBS-backed VPC instance, as botocore parses it: one interface, one volume
+    """
+    instance_id = f"i-{index:017x}"
+    subnet_id = f"subnet-{index % 64:017x}"
+    vpc_id = f"vpc-{index % 8:017x}"
+    private_ip = f"10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}"
+    private_dns = f"ip-{private_ip.replace('.', '-')}.ec2.internal"
+    groups = [{'GroupName': f"bench-sg-{index % 16}", 'GroupId': f"sg-{index % 16:017x}"}]
+    return {
+        'AmiLaunchIndex': 0,
+        'ImageId': f"ami-{index % 32:017x}",
+        'InstanceId': instance_id,
+        'InstanceType': 't3.micro',
+        'KeyName': 'bench',
+        'LaunchTime': launch_time,
+        'Monitoring': {'State': 'disabled'},
+        'Placement': {'AvailabilityZone': 'us-east-1a', 'GroupName': '', 'Tenancy': 'default'},
+        'PrivateDnsName': private_dns,
+        'PrivateIpAddress': private_ip,
+        'ProductCodes': [],
+        'PublicDnsName': '',
+        'State': {'Code': 16, 'Name': 'running'},
+        'StateTransitionReason': '',
+        'SubnetId': subnet_id,
+        'VpcId': vpc_id,
+        'Architecture': 'x86_64',
+        'BlockDeviceMappings': [{
+            'DeviceName': '/dev/xvda',
+            'Ebs': {
+                'AttachTime': launch_time,
+                'DeleteOnTermination': True,
+                'Status': 'attached',
+                'VolumeId': f"vol-{index:017x}"
+            }
+        }],
+        'ClientToken': f"bench-{index:032x}",
+        'EbsOptimized': False,
+        'EnaSupport': True,
+        'Hypervisor': 'xen',
+        'NetworkInterfaces': [{
+            'Attachment': {
+                'AttachTime': launch_time,
+                'AttachmentId': f"eni-attach-{index:017x}",
+                'DeleteOnTermination': True,
+                'DeviceIndex': 0,
+                'Status': 'attached',
+                'NetworkCardIndex': 0
+            },
+            'Description': '',
+            'Groups': groups,
+            'Ipv6Addresses': [],
+            'MacAddress': f"0a:{index % 256:02x}:{index // 256 % 256:02x}:00:00:01",
+            'NetworkInterfaceId': f"eni-{index:017x}",
+            'OwnerId': '123456789012',
+            'PrivateDnsName': private_dns,
+            'PrivateIpAddress': private_ip,
+            'PrivateIpAddresses': [{'Primary': True, 'PrivateDnsName': private_dns, 'PrivateIpAddress': private_ip}],
+            'SourceDestCheck': True,
+            'Status': 'in-use',
+            'SubnetId': subnet_id,
+            'VpcId': vpc_id,
+            'InterfaceType': 'interface'
+        }],
+        'RootDeviceName': '/dev/xvda',
+        'RootDeviceType': 'ebs',
+        'SecurityGroups': [dict(group) for group in groups],
+        'SourceDestCheck': True,
+        'Tags': [
+            {'Key': 'Name', 'Value': f"bench-{index}"},
+            {'Key': 'Environment', 'Value': 'development'},
+            {'Key': 'Team', 'Value': f"team-{index % 20}"}
+        ],
+        'VirtualizationType': 'hvm',
+        'CpuOptions': {'CoreCount': 1, 'ThreadsPerCore': 2},
+        'CapacityReservationSpecification': {'CapacityReservationPreference': 'open'},
+        'HibernationOptions': {'Configured': False},
+        'MetadataOptions': {
+            'State': 'applied',
+            'HttpTokens': 'required',
+            'HttpPutResponseHopLimit': 2,
+            'HttpEndpoint': 'enabled',
+            'HttpProtocolIpv6': 'disabled',
+            'InstanceMetadataTags': 'disabled'
+        },
+        'EnclaveOptions': {'Enabled': False},
+        'PlatformDetails': 'Linux/UNIX',
+        'UsageOperation': 'RunInstances',
+        'UsageOperationUpdateTime': launch_time,
+        'PrivateDnsNameOptions': {
+            'HostnameType': 'ip-name',
+            'EnableResourceNameDnsARecord': False,
+            'EnableResourceNameDnsAAAARecord': False
+        },
+        'MaintenanceOptions': {'AutoRecovery': 'default'},
+        'CurrentInstanceBootMode': 'legacy-bios'
+    }
+
+
+def _matches_filter(instance: Dict[str, Any], instance_filter: Dict[str, Any]) -> bool:
+    name = instance_filter['Name']
+    if name == 'instance-state-name':
+        value = instance['State']['Name']
+    elif name == 'instance-id':
+        value = instance['InstanceId']
+    elif name == 'instance-type':
+        value = instance['InstanceType']
+    elif name.startswith('tag:'):
+        tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+        value = tags.get(name[len('tag:'):])
+    else:
+        raise ValueError(f"Unsupported filter: {name}")
+
+    if value is None:
+        return False
+    if value in instance_filter['Values']:
+        return True
+    return any(fnmatch.fnmatchcase(value, pattern) for pattern in instance_filter['Values'] if '*' in pattern or '?' in pattern)
+
+
+class FakePaginator:
+    """
+    Follows NextToken on a fake operation the way botocore paginators do
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+
+    def paginate(self, PaginationConfig: Optional[Dict[str, Any]] = None, **kwargs):
+        page_size = (PaginationConfig or {}).get('PageSize')
+        if page_size:
+            kwargs['MaxResults'] = page_size
+        starting_token = (PaginationConfig or {}).get('StartingToken')
+        if starting_token:
+            kwargs['NextToken'] = starting_token
+        while True:
+            page = self.operation(**kwargs)
+            yield page
+            if not page.get('NextToken'):
+                return
+            kwargs['NextToken'] = page['NextToken']
+
+
+class FakeEC2:
+    """
+    Serves describe_instances from a synthetic fleet and records monitor and stop calls
+    A throttle_rate fraction of calls fails with RequestLimitExceeded
+    hibernate_errors fail StopInstances calls with Hibernate=True only
+    """
+
+    def __init__(self, instances: List[Dict[str, Any]], latency_ms: float = 0.0, page_size: int = 1000,
+                 stop_errors: Optional[Dict[str, str]] = None, latency_jitter_ms: float = 0.0,
+                 throttle_rate: float = 0.0, seed: int = 0, hibernate_errors: Optional[Dict[str, str]] = None):
+        self.instances = instances
+        self.stop_errors = stop_errors or {}
+        self.hibernate_errors = hibernate_errors or {}
+        self.latency = latency_ms / 1000.0
+        self.latency_jitter = latency_jitter_ms / 1000.0
+        self.throttle_rate = throttle_rate
+        self.rng = random.Random(seed)
+        self.page_size = page_size
+        self.calls = Counter()
+        self.throttled = Counter()
+        self.stopped = []
+        self.hibernated = []
+        self.monitored = []
+
+    def _round_trip(self, operation: str) -> None:
+        _round_trip(self, operation, 'RequestLimitExceeded')
+
+    def get_paginator(self, operation_name: str) -> 'FakePaginator':
+        return FakePaginator(getattr(self, operation_name))
+
+    def describe_instances(self, **kwargs) -> Dict[str, Any]:
+        self._round_trip('DescribeInstances')
+        instances = self.instances
+        if 'InstanceIds' in kwargs:
+            wanted = set(kwargs['InstanceIds'])
+            instances = [instance for instance in instances if instance['InstanceId'] in wanted]
+        for instance_filter in kwargs.get('Filters', []):
+            if instance_filter['Name'] == 'instance-id' and not any('*' in value or '?' in value for value in instance_filter['Values']):
+                # Exact IDs, as re-described candidates and work queue shards use, by set lookup
+                wanted = set(instance_filter['Values'])
+                instances = [instance for instance in instances if instance['InstanceId'] in wanted]
+                continue
+            instances = [instance for instance in instances if _matches_filter(instance, instance_filter)]
+
+        offset = int(kwargs.get('NextToken') or 0)
+        page_size = kwargs.get('MaxResults') or self.page_size
+        page = instances[offset:offset + page_size]
+
+        response = {'Reservations': [{'ReservationId': f"r-{offset:017x}", 'Instances': page}]}
+        if offset + page_size < len(instances):
+            response['NextToken'] = str(offset + page_size)
+        return response
+
+    def monitor_instances(self, InstanceIds: List[str], **kwargs) -> Dict[str, Any]:
+        self._round_trip('MonitorInstances')
+        self.monitored.extend(InstanceIds)
+        return {
+            'InstanceMonitorings': [
+                {'InstanceId': instance_id, 'Monitoring': {'State': 'pending'}}
+                for instance_id in InstanceIds
+            ]
+        }
+
+    def describe_instance_types(self, InstanceTypes: List[str], **kwargs) -> Dict[str, Any]:
+        self._round_trip('DescribeInstanceTypes')
+        return {
+            'InstanceTypes': [
+                {'InstanceType': instance_type, 'HibernationSupported': instance_type in HIBERNATION_INSTANCE_TYPES}
+                for instance_type in InstanceTypes
+            ]
+        }
+
+    def stop_instances(self, InstanceIds: List[str], Hibernate: bool = False, **kwargs) -> Dict[str, Any]:
+        self._round_trip('StopInstances')
+        errors = dict(self.stop_errors, **self.hibernate_errors) if Hibernate else self.stop_errors
+        for instance_id in InstanceIds:
+            if instance_id in errors:
+                error_code = errors[instance_id]
+                raise ClientError(
+                    {'Error': {'Code': error_code, 'Message': f"{error_code} for {instance_id}"}},
+                    'StopInstances'
+                )
+        (self.hibernated if Hibernate else self.stopped).extend(InstanceIds)
+        return {
+            'StoppingInstances': [
+                {
+                    'InstanceId': instance_id,
+                    'CurrentState': {'Code': 64, 'Name': 'stopping'},
+                    'PreviousState': {'Code': 16, 'Name': 'running'}
+                }
+                for instance_id in InstanceIds
+            ]
+        }
+
+
+def _diff_time(timestamps: List[datetime]) -> List[float]:
+    return [(later - earlier).total_seconds() for earlier, later in zip(timestamps, timestamps[1:])]
+
+
+# The metric math forms the Lambda builds, each reducing one series to a scalar
+_EXPRESSIONS = [
+    (re.compile(r'^MAX\((\w+)\)$'), lambda timestamps, values: max(values)),
+    (re.compile(r'^DATAPOINT_COUNT\((\w+)\)$'), lambda timestamps, values: float(len(values))),
+    (re.compile(r'^SUM\(IF\((\w+) <= ([\d.]+), 0, 1\)\)$'),
+     lambda timestamps, values, threshold: float(sum(0 if value <= float(threshold) else 1 for value in values))),
+    (re.compile(r'^SUM\(IF\(DIFF_TIME\((\w+)\) > ([\d.]+), DIFF_TIME\(\1\), 0\)\)$'),
+     lambda timestamps, values, gap: sum(diff for diff in _diff_time(timestamps) if diff > float(gap))),
+    (re.compile(r'^MAX\(IF\((\w+) > ([\d.]+), EPOCH\(\1\), 0\)\)$'),
+     lambda timestamps, values, threshold: max(
+         (timestamp.timestamp() if value > float(threshold) else 0.0) for timestamp, value in zip(timestamps, values)
+     )),
+]
+
+
+_ANCHORED = re.compile(r'^(\w+) \* 0 \+ (.+)$')
+
+
+def _evaluate_expression(expression: str, series: Dict[str, Tuple[List[datetime], List[float]]]) -> Tuple[List[datetime], List[float]]:
+    """
+    Evaluate a scalar metric math expression the way GetMetricData returns it:
+    the scalar repeated at each timestamp of its input, NaN for an empty input;
+    'anchor * 0 + scalar' takes the anchor series' timestamps instead
+    """
+    anchored = _ANCHORED.match(expression)
+    if anchored:
+        anchor_timestamps, _ = series[anchored.group(1)]
+        _, values = _evaluate_expression(anchored.group(2), series)
+        value = values[0] if values else float('nan')
+        return list(anchor_timestamps), [value] * len(anchor_timestamps)
+
+    for pattern, function in _EXPRESSIONS:
+        match = pattern.match(expression)
+        if match:
+            timestamps, values = series[match.group(1)]
+            if not timestamps:
+                return [], []
+            value = function(timestamps, values, *match.groups()[1:])
+            return list(timestamps), [value] * len(timestamps)
+    raise ValueError(f"Unsupported expression: {expression}")
+
+
+class FakeCloudWatch:
+    """
+    Serves five-minute CPUUtilization datapoints for a synthetic set of instances
+    Other metrics are zero unless set per instance in signal_values; cpu_datapoints
+    replaces an instance's CPU series with explicit (timestamp, value) pairs, of
+    which GetMetricData returns those from StartTime up to EndTime as CloudWatch does
+    Evaluates the metric math expressions metric_summary_requests builds
+    Each call sleeps for latency_ms to approximate a network round trip, and a
+    throttle_rate fraction of calls fails with Throttling
+    """
+
+    def __init__(self, instance_ids: List[str], hours: int = 3, cpu_value: float = 0.5,
+                 latency_ms: float = 0.0, max_datapoints_per_page: int = 100800,
+                 cpu_values: Optional[Dict[str, float]] = None,
+                 signal_values: Optional[Dict[str, Dict[str, float]]] = None,
+                 cpu_datapoints: Optional[Dict[str, List[Tuple[datetime, float]]]] = None,
+                 latency_jitter_ms: float = 0.0, throttle_rate: float = 0.0, seed: int = 0):
+        self.latency = latency_ms / 1000.0
+        self.latency_jitter = latency_jitter_ms / 1000.0
+        self.throttle_rate = throttle_rate
+        self.rng = random.Random(seed)
+        self.throttled = Counter()
+        self.max_datapoints_per_page = max_datapoints_per_page
+        self.calls = Counter()
+        self.datapoints_returned = 0
+
+        end = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+        count = hours * 12
+        self.timestamps = [end - timedelta(minutes=5 * (count - i)) for i in range(count)]
+        self.series = {instance_id: cpu_value for instance_id in instance_ids}
+        self.series.update(cpu_values or {})
+        self.signal_values = signal_values or {}
+        self.cpu_datapoints = cpu_datapoints or {}
+
+    def _round_trip(self, operation: str) -> None:
+        _round_trip(self, operation, 'Throttling')
+
+    def get_metric_statistics(self, **kwargs) -> Dict[str, Any]:
+        self._round_trip('GetMetricStatistics')
+        metric_stat = {
+            'Metric': {'MetricName': kwargs['MetricName'], 'Dimensions': kwargs['Dimensions']},
+            'Period': kwargs['Period']
+        }
+        timestamps, values = self._series(metric_stat)
+        statistic = kwargs.get('Statistics', ['Average'])[0]
+        return {
+            'Datapoints': [
+                {'Timestamp': timestamp, statistic: value, 'Unit': 'Percent'}
+                for timestamp, value in zip(timestamps, values)
+            ]
+        }
+
+    def _series(self, metric_stat: Dict[str, Any], start: Optional[datetime] = None,
+                end: Optional[datetime] = None) -> Tuple[List[datetime], List[float]]:
+        metric = metric_stat['Metric']
+        instance_id = metric['Dimensions'][0]['Value']
+        if metric['MetricName'] == 'CPUUtilization' and instance_id in self.cpu_datapoints:
+            datapoints = [
+                (timestamp, value) for timestamp, value in self.cpu_datapoints[instance_id]
+                if (start is None or timestamp >= start) and (end is None or timestamp < end)
+            ]
+            timestamps, values = [timestamp for timestamp, _ in datapoints], [value for _, value in datapoints]
+        else:
+            value = self.series.get(instance_id)
+            if value is None:
+                return [], []
+            if metric['MetricName'] != 'CPUUtilization':
+                value = self.signal_values.get(instance_id, {}).get(metric['MetricName'], 0.0)
+            timestamps, values = self.timestamps, [value] * len(self.timestamps)
+
+        # A period longer than five minutes covers the whole window in one datapoint
+        if metric_stat['Period'] > 300 and timestamps:
+            return [timestamps[0]], [float(len(timestamps))]
+        return timestamps, values
+
+    def get_metric_data(self, **kwargs) -> Dict[str, Any]:
+        self._round_trip('GetMetricData')
+        queries = kwargs['MetricDataQueries']
+        if len(queries) > 500:
+            raise ValueError('The collection MetricDataQueries must not have a size greater than 500.')
+
+        # The Lambda passes naive UTC times
+        start, end = (kwargs[key].replace(tzinfo=timezone.utc) for key in ('StartTime', 'EndTime'))
+        series = {
+            query['Id']: self._series(query['MetricStat'], start, end)
+            for query in queries if 'MetricStat' in query
+        }
+        returned = []
+        for query in queries:
+            if not query.get('ReturnData', True):
+                continue
+            if 'Expression' in query:
+                timestamps, values = _evaluate_expression(query['Expression'], series)
+            else:
+                timestamps, values = series[query['Id']]
+            returned.append((query, timestamps, values))
+
+        # NextToken is the flat datapoint offset across all returned queries in the request
+        offset = int(kwargs.get('NextToken') or 0)
+        budget = self.max_datapoints_per_page
+
+        results = []
+        position = 0
+        next_token = None
+        for query, timestamps, values in returned:
+            count = len(timestamps)
+            query_start = position
+            position += count
+            first = max(0, offset - query_start)
+            # Series returned on an earlier page; empty ones go on the page that reaches them
+            if (count and first >= count) or (not count and query_start < offset):
+                continue
+            if count and budget == 0:
+                next_token = query_start + first
+                break
+
+            last = min(count, first + budget)
+            results.append({
+                'Id': query['Id'],
+                'Label': query['MetricStat']['Metric']['MetricName'] if 'MetricStat' in query else query['Id'],
+                'Timestamps': timestamps[first:last],
+                'Values': values[first:last],
+                'StatusCode': 'Complete' if last == count else 'PartialData'
+            })
+            budget -= last - first
+            self.datapoints_returned += last - first
+            if last < count:
+                next_token = query_start + last
+                break
+
+        response = {'MetricDataResults': results, 'Messages': []}
+        if next_token is not None:
+            response['NextToken'] = str(next_token)
+        return response
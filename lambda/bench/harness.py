@@ -0,0 +1,336 @@
+"""
+Run lambda_handler offline against a synthetic fleet or recorded AWS responses and measure it
+
+Sources:
+  synthetic  fake_aws clients serving a generated fleet (size, idle ratio, CPU
+             gap patterns, DescribeInstances page size, throttling rate, latency)
+  live       the function's real clients, with DRY_RUN forced on; combine with
+             --record to capture the responses of a real account once
+  replay     responses read back from a --record file, with every timestamp
+             shifted by the time elapsed since recording; the configuration
+             must match the recorded run so requests match, so a live
+             recording is replayed with --dry-run
+
+Synthetic runs send StopInstances to the fakes unless --dry-run is given, and
+with --detailed-monitoring (ENABLE_DETAILED_MONITORING) MonitorInstances for the
+--unmonitored-ratio of instances whose detailed monitoring is disabled.
+
+Every client call goes through an instrumented wrapper that retries throttling
+errors with botocore's backoff (up to CLIENT_MAX_ATTEMPTS), as real clients do,
+and times each attempt. Reports, per run, the decisions and decisions per second
+(instances evaluated / handler time) and a digest of the decisions, and per API operation the calls, throttled
+attempts and p50/p90/p99 latency, and the time spent in each phase as
+invocation_metrics counts it (summed over targets). Runs the thread pool execution engine, since
+the asyncio engine creates its own aiobotocore clients.
+
+Usage: python lambda/bench/harness.py [--source synthetic] [--size 5000] [--regions 1] [--idle-ratio 0.5]
+       [--gap-ratio 0.1] [--gap-pattern mixed] [--page-size 1000] [--throttle-rate 0.1] [--latency-ms 5]
+       [--latency-jitter-ms 5] [--runs 1] [--evaluation-engine metric_math] [--dry-run]
+       [--detailed-monitoring] [--unmonitored-ratio 0.1] [--record FILE | --replay FILE]
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import ec2_shutdown  # noqa: E402
+from fake_aws import FakeCloudWatch, FakeEC2, FakePaginator, generate_fleet  # noqa: E402
+
+# Error codes botocore's retry handlers treat as throttling
+THROTTLING_CODES = {'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException'}
+
+# Operations the harness records, replays and reports, as client method names
+OPERATIONS = {
+    'describe_instances': 'DescribeInstances',
+    'describe_instance_types': 'DescribeInstanceTypes',
+    'get_metric_data': 'GetMetricData',
+    'get_metric_statistics': 'GetMetricStatistics',
+    'monitor_instances': 'MonitorInstances',
+    'stop_instances': 'StopInstances'
+}
+
+# Request parameters that move with the clock, left out when matching a replayed request
+TIME_PARAMETERS = {'StartTime', 'EndTime'}
+
+
+def encode(value):
+    """JSON-ready copy of a request or response, with datetimes tagged"""
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, dict):
+        return {key: encode(item) for key, item in value.items() if key != 'ResponseMetadata'}
+    if isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    return value
+
+
+def decode(value, shift):
+    """Inverse of encode, moving every datetime forward by shift"""
+    if isinstance(value, dict):
+        if '__datetime__' in value:
+            return datetime.fromisoformat(value['__datetime__']) + shift
+        return {key: decode(item, shift) for key, item in value.items()}
+    if isinstance(value, list):
+        return [decode(item, shift) for item in value]
+    return value
+
+
+def request_key(target, operation, params):
+    """What identifies a request across a recording and its replay"""
+    stable = {key: value for key, value in params.items() if key not in TIME_PARAMETERS}
+    return json.dumps([target, operation, encode(stable)], sort_keys=True)
+
+
+class Measurements:
+    """Calls, throttled attempts and per-attempt latencies per operation, shared by every client"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.throttled = Counter()
+        self.latencies = defaultdict(list)
+
+    def add(self, operation, seconds, throttled):
+        with self.lock:
+            self.calls[operation] += 1
+            self.throttled[operation] += throttled
+            self.latencies[operation].append(seconds)
+
+    def clear(self):
+        with self.lock:
+            self.calls.clear()
+            self.throttled.clear()
+            self.latencies.clear()
+
+
+class Recorder:
+    """Appends every successful response, keyed by its request, to a JSON lines file"""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = open(path, 'w')
+
+    def add(self, key, response):
+        line = json.dumps({
+            'key': key,
+            'recorded_at': datetime.now(timezone.utc).isoformat(),
+            'response': encode(response)
+        })
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+class ReplayClient:
+    """Serves recorded responses; a request that was not recorded fails with KeyError"""
+
+    def __init__(self, target, responses):
+        self.target = target
+        self.responses = responses
+
+    def __getattr__(self, name):
+        if name not in OPERATIONS:
+            raise AttributeError(name)
+
+        def call(**params):
+            key = request_key(self.target, OPERATIONS[name], params)
+            if key not in self.responses:
+                raise KeyError(f"No recorded response for {OPERATIONS[name]} in {self.target}; "
+                               f"replay with the configuration the recording was made with")
+            return self.responses[key]()
+        return call
+
+    def get_paginator(self, operation_name):
+        return FakePaginator(getattr(self, operation_name))
+
+
+def load_recording(path):
+    """Recorded responses by request key, each decoded on use with the time since recording added"""
+    now = datetime.now(timezone.utc)
+    responses = {}
+    with open(path) as f:
+        for line in f:
+            entry = json.loads(line)
+            shift = now - datetime.fromisoformat(entry['recorded_at'])
+            responses[entry['key']] = lambda response=entry['response'], shift=shift: decode(response, shift)
+    return responses
+
+
+class InstrumentedClient:
+    """
+    Wraps a client: retries throttling errors with botocore's exponential backoff
+    and full jitter, times every attempt, and records successful responses
+    """
+
+    def __init__(self, client, target, measurements, recorder=None, seed=0):
+        self.client = client
+        self.target = target
+        self.measurements = measurements
+        self.recorder = recorder
+        self.rng = random.Random(seed)
+
+    def __getattr__(self, name):
+        if name not in OPERATIONS:
+            return getattr(self.client, name)
+        method = getattr(self.client, name)
+        operation = OPERATIONS[name]
+
+        def call(**params):
+            for attempt in range(ec2_shutdown.CLIENT_MAX_ATTEMPTS):
+                started = time.perf_counter()
+                try:
+                    response = method(**params)
+                except ClientError as e:
+                    throttled = e.response.get('Error', {}).get('Code') in THROTTLING_CODES
+                    self.measurements.add(operation, time.perf_counter() - started, throttled)
+                    if not throttled or attempt == ec2_shutdown.CLIENT_MAX_ATTEMPTS - 1:
+                        raise
+                    time.sleep(self.rng.random() * min(20, 2 ** attempt))
+                    continue
+                self.measurements.add(operation, time.perf_counter() - started, False)
+                if self.recorder:
+                    self.recorder.add(request_key(self.target, operation, params), response)
+                return response
+        return call
+
+    def get_paginator(self, operation_name):
+        return FakePaginator(getattr(self, operation_name))
+
+
+def decisions_digest(body):
+    """Short hash of what a run decided, independent of result order, to compare a replay with its recording"""
+    decisions = (
+        sorted((result['region'], result['instance_id']) for result in body['shutdown_results']),
+        sorted((record['region'], record['instance_id']) for record in body['skipped_instances']),
+        sorted((record['region'], record['instance_id'], record['signal']) for record in body['active_instances'])
+    )
+    return hashlib.sha256(json.dumps(decisions).encode()).hexdigest()[:12]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+def synthetic_clients(args, regions):
+    """Fake EC2 and CloudWatch clients per region, each serving its own generated fleet"""
+    clients = {}
+    for index, region in enumerate(regions):
+        seed = args.seed + index
+        instances, cpu_values, cpu_datapoints = generate_fleet(
+            args.size // len(regions), idle_ratio=args.idle_ratio, gap_ratio=args.gap_ratio,
+            gap_pattern=args.gap_pattern, hours=ec2_shutdown.IDLE_DURATION_HOURS, seed=seed
+        )
+        rng = random.Random(seed)
+        for instance in instances:
+            instance['Monitoring'] = {'State': 'disabled' if rng.random() < args.unmonitored_ratio else 'enabled'}
+        clients[region] = (
+            FakeEC2(instances, latency_ms=args.latency_ms, page_size=args.page_size,
+                    latency_jitter_ms=args.latency_jitter_ms, throttle_rate=args.throttle_rate, seed=seed),
+            FakeCloudWatch([], hours=ec2_shutdown.IDLE_DURATION_HOURS, latency_ms=args.latency_ms,
+                           cpu_values=cpu_values, cpu_datapoints=cpu_datapoints,
+                           latency_jitter_ms=args.latency_jitter_ms, throttle_rate=args.throttle_rate, seed=seed)
+        )
+    return lambda target: clients[target['region']]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--source', choices=['synthetic', 'live', 'replay'], default='synthetic')
+    parser.add_argument('--size', type=int, default=5000, help='instances across all regions')
+    parser.add_argument('--regions', default='1', help='number of fake regions, or comma-separated region names')
+    parser.add_argument('--idle-ratio', type=float, default=0.5, help='fraction of instances below the CPU threshold')
+    parser.add_argument('--gap-ratio', type=float, default=0.1, help='fraction of instances with missing CPU datapoints')
+    parser.add_argument('--gap-pattern', choices=['sparse', 'burst', 'stale', 'mixed'], default='mixed')
+    parser.add_argument('--page-size', type=int, default=1000, help='instances per DescribeInstances page')
+    parser.add_argument('--throttle-rate', type=float, default=0.1, help='fraction of calls the fakes throttle')
+    parser.add_argument('--latency-ms', type=float, default=5.0, help='simulated round-trip latency per API call')
+    parser.add_argument('--latency-jitter-ms', type=float, default=5.0, help='uniform extra latency per API call')
+    parser.add_argument('--runs', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--evaluation-engine', default=ec2_shutdown.EVALUATION_ENGINE, help='EVALUATION_ENGINE value')
+    parser.add_argument('--dry-run', action='store_true', help='set DRY_RUN; always on with --source live')
+    parser.add_argument('--detailed-monitoring', action='store_true', help='set ENABLE_DETAILED_MONITORING')
+    parser.add_argument('--unmonitored-ratio', type=float, default=0.1,
+                        help='fraction of synthetic instances with detailed monitoring disabled')
+    parser.add_argument('--record', help='write every response to this JSON lines file')
+    parser.add_argument('--replay', help='recording to serve with --source replay')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    # Never stop real instances; the fakes and recordings serve StopInstances
+    ec2_shutdown.DRY_RUN = args.source == 'live' or args.dry_run
+    ec2_shutdown.ENABLE_DETAILED_MONITORING = args.detailed_monitoring
+    ec2_shutdown.EXECUTION_ENGINE = 'threads'
+    ec2_shutdown.EVALUATION_ENGINE = args.evaluation_engine
+    # Measure the handler against the harness' throttling, not the client-side limiter
+    ec2_shutdown.rate_limiter = None
+
+    if args.regions.isdigit():
+        regions = [f"fake-region-{index}" for index in range(int(args.regions))]
+    else:
+        regions = args.regions.split(',')
+
+    if args.source == 'synthetic':
+        get_clients = synthetic_clients(args, regions)
+    elif args.source == 'live':
+        get_clients = ec2_shutdown.get_target_clients
+    else:
+        if not args.replay:
+            parser.error('--source replay needs --replay FILE')
+        responses = load_recording(args.replay)
+        get_clients = lambda target: (ReplayClient(ec2_shutdown.target_label(target), responses),) * 2
+
+    measurements = Measurements()
+    recorder = Recorder(args.record) if args.record else None
+
+    def instrumented_clients(target):
+        label = ec2_shutdown.target_label(target)
+        return tuple(
+            InstrumentedClient(client, label, measurements, recorder, seed=args.seed)
+            for client in get_clients(target)
+        )
+    ec2_shutdown.get_target_clients = instrumented_clients
+
+    try:
+        for run in range(1, args.runs + 1):
+            measurements.clear()
+            started = time.perf_counter()
+            response = ec2_shutdown.lambda_handler({'regions': regions}, None)
+            elapsed = time.perf_counter() - started
+            if response['statusCode'] != 200:
+                raise RuntimeError(response['body'])
+            body = response['body']
+
+            print(f"run {run}: {elapsed:.3f}s  {body['total_instances_evaluated'] / elapsed:,.0f} decisions/s  "
+                  f"evaluated={body['total_instances_evaluated']} shutdown={body['instances_shutdown']} "
+                  f"active={body['instances_active']} skipped={body['instances_skipped']} decisions={decisions_digest(body)}")
+            phases = ec2_shutdown.invocation_metrics.snapshot()['phases']
+            print('  phases: ' + ' '.join(f"{phase}={seconds:.3f}s" for phase, seconds in sorted(phases.items())))
+            print(f"  {'operation':<20} {'calls':>7} {'throttled':>10} {'p50_ms':>8} {'p90_ms':>8} {'p99_ms':>8}")
+            for operation in sorted(measurements.calls):
+                latencies = measurements.latencies[operation]
+                print(f"  {operation:<20} {measurements.calls[operation]:>7} {measurements.throttled[operation]:>10} "
+                      f"{percentile(latencies, 0.5) * 1000:>8.1f} {percentile(latencies, 0.9) * 1000:>8.1f} "
+                      f"{percentile(latencies, 0.99) * 1000:>8.1f}")
+    finally:
+        if recorder:
+            recorder.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -24,6 +24,10 @@ pip install -r "$SCRIPT_DIR/requirements.txt" -t "$PACKAGE_DIR/"
 echo "Copying source code..."
 cp "$SCRIPT_DIR/src/"*.py "$PACKAGE_DIR/"
 
+# Copy account configuration used by hub mode
+echo "Copying account configuration..."
+cp "$SCRIPT_DIR/../config/ou-accounts.yaml" "$PACKAGE_DIR/"
+
 # Create ZIP file
 echo "Creating ZIP package..."
 cd "$PACKAGE_DIR"
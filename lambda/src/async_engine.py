@@ -0,0 +1,479 @@
+import asyncio
+import logging
+from contextlib import AsyncExitStack
+from datetime import datetime, timezone
+from typing import List, Dict, Any, AsyncIterator, Optional, Tuple
+
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from botocore.exceptions import ClientError
+
+# Imported by ec2_shutdown on first use, once that module is fully loaded
+import ec2_shutdown
+from instance_record import InstanceRecord
+from report_sink import ReportWriter
+
+logger = logging.getLogger(__name__)
+
+# Instance types being described, with an event set when their lookup ends, so
+# concurrent targets never describe the same type twice; reset by each run, as
+# asyncio events belong to their event loop
+_hibernation_lookups: Dict[str, asyncio.Event] = {}
+
+
+def run_targets(cursors: List[Dict[str, Any]], context: Any = None) -> Dict[str, Any]:
+    """
+    Process targets as coroutines on one event loop, each from its cursor
+    Returns the same dict of target label to result (or exception) as the thread pool engine
+    """
+    return asyncio.run(run_targets_async(cursors, context))
+
+
+async def run_targets_async(cursors: List[Dict[str, Any]], context: Any = None) -> Dict[str, Any]:
+    """
+    Run every target concurrently; GetMetricData and StopInstances calls across
+    all targets are bounded by one ASYNC_MAX_CONCURRENCY semaphore
+    """
+    global _hibernation_lookups
+    semaphore = asyncio.Semaphore(ec2_shutdown.ASYNC_MAX_CONCURRENCY)
+    _hibernation_lookups = {}
+    session = get_session()
+
+    async with AsyncExitStack() as clients:
+        async def run_target(cursor: Dict[str, Any]) -> Any:
+            try:
+                return await process_target(session, clients, cursor['target'], cursor['next_token'], context, semaphore,
+                                            cursor.get('instance_ids'), cursor.get('report_part'))
+            except Exception as e:
+                logger.error("Error processing %s: %s", ec2_shutdown.target_label(cursor['target']), e, exc_info=True)
+                return e
+
+        results = await asyncio.gather(*(run_target(cursor) for cursor in cursors))
+
+    return {ec2_shutdown.target_label(cursor['target']): result for cursor, result in zip(cursors, results)}
+
+
+def client_config() -> AioConfig:
+    """
+    The shared client settings, with a connection pool large enough for every call in flight
+    """
+    options = dict(ec2_shutdown.CLIENT_CONFIG_OPTIONS)
+    options['max_pool_connections'] = max(options['max_pool_connections'], ec2_shutdown.ASYNC_MAX_CONCURRENCY)
+    return AioConfig(**options)
+
+
+async def create_target_clients(session: Any, clients: AsyncExitStack, target: Dict[str, str]) -> Tuple[Any, Any]:
+    """
+    Create EC2 and CloudWatch clients for a target; they are closed when the run ends
+    In hub mode the assumed-role credentials come from the same cache as the thread pool engine
+    """
+    region = target['region']
+    account_id = target.get('account_id')
+
+    credentials = {}
+    if account_id:
+        account_session = await asyncio.to_thread(ec2_shutdown.get_account_session, account_id, target['role_name'])
+        frozen = account_session.get_credentials().get_frozen_credentials()
+        credentials = {
+            'aws_access_key_id': frozen.access_key,
+            'aws_secret_access_key': frozen.secret_key,
+            'aws_session_token': frozen.token
+        }
+
+    config = client_config()
+    target_clients = []
+    for service_name in ('ec2', 'cloudwatch'):
+        client = await clients.enter_async_context(
+            session.create_client(service_name, region_name=region, config=config, **credentials)
+        )
+        ec2_shutdown.invocation_metrics.attach(client)
+        if ec2_shutdown.rate_limiter:
+            ec2_shutdown.rate_limiter.attach(client, account_id or 'self', asynchronous=True)
+        target_clients.append(client)
+
+    return target_clients[0], target_clients[1]
+
+
+async def process_target(session: Any, clients: AsyncExitStack, target: Dict[str, str],
+                         next_token: Optional[str], context: Any,
+                         semaphore: asyncio.Semaphore, instance_ids: Optional[List[str]] = None,
+                         report_part: Optional[Tuple[str, str]] = None) -> Dict[str, Any]:
+    """
+    Process one target: a region, or an account and region in hub mode
+    With instance_ids, only those instances (a work queue shard) are processed
+    With a report sink, records go to report_part as in ec2_shutdown.process_target;
+    report writes and uploads block, so they run in a worker thread
+    """
+    if ec2_shutdown.deadline_reached(context):
+        return ec2_shutdown.not_started_result(next_token)
+
+    ec2, cloudwatch = await create_target_clients(session, clients, target)
+    report_writer = ec2_shutdown.open_report_writer(report_part)
+    try:
+        result = await process_region(target['region'], ec2, cloudwatch, target.get('account_id'),
+                                      next_token, context, semaphore, instance_ids, report_writer)
+    except Exception:
+        await asyncio.to_thread(ec2_shutdown.abort_report_writer, report_writer)
+        raise
+    if report_writer:
+        await asyncio.to_thread(report_writer.close)
+    return result
+
+
+async def process_region(region: str, ec2: Any, cloudwatch: Any, account_id: Optional[str],
+                         starting_token: Optional[str], context: Any,
+                         semaphore: asyncio.Semaphore, instance_ids: Optional[List[str]] = None,
+                         report_writer: Optional[ReportWriter] = None) -> Dict[str, Any]:
+    """
+    Discover, evaluate and shut down idle instances in one region
+    Same decisions and result as ec2_shutdown.process_region, but each chunk of
+    candidates is evaluated as a task while discovery moves on to the next page
+    Inventory reads and writes block, so they run in a worker thread, as do
+    report writes; active records reach the report_writer once the chunks are gathered
+    """
+    observed_at = datetime.now(timezone.utc).timestamp()
+    inventory_instances = None
+    metrics = ec2_shutdown.invocation_metrics
+    if not starting_token and instance_ids is None:
+        with metrics.phase('discovery'):
+            inventory_instances = await asyncio.to_thread(ec2_shutdown.get_inventory_instances, region, account_id)
+
+    instance_index = {}
+    evaluation_candidates = []
+    monitoring_candidates = []
+    evaluations = []
+    skipped_instances = []
+
+    next_token = None
+    scheduled_instances = []
+    pages = get_discovery_pages(ec2, starting_token, inventory_instances, instance_ids)
+    async for page_instances, next_token in timed_pages('discovery', pages):
+        with metrics.phase('evaluation'):
+            schedule = await asyncio.to_thread(ec2_shutdown.load_evaluation_schedule, page_instances)
+        for instance in page_instances:
+            instance_id = instance.instance_id
+            instance_index[instance_id] = instance
+
+            skip_reason = ec2_shutdown.should_skip_instance(instance)
+            if skip_reason:
+                skipped_instances.append(ec2_shutdown.skipped_instance_record(instance, region, account_id, skip_reason))
+                continue
+
+            if ec2_shutdown.needs_detailed_monitoring(instance_id, instance_index):
+                monitoring_candidates.append(instance)
+                continue
+
+            next_check = ec2_shutdown.scheduled_check(instance, schedule)
+            if next_check:
+                scheduled_instances.append(ec2_shutdown.scheduled_instance_record(instance, next_check))
+                continue
+
+            evaluation_candidates.append(instance)
+            if len(evaluation_candidates) >= ec2_shutdown.METRIC_DATA_MAX_QUERIES:
+                evaluations.append(asyncio.ensure_future(
+                    find_idle_instances(cloudwatch, evaluation_candidates, instance_index, semaphore)
+                ))
+                evaluation_candidates = []
+
+        if report_writer:
+            await asyncio.to_thread(ec2_shutdown.write_report_records, report_writer, region, account_id, [
+                ('skipped_instances', skipped_instances),
+                ('active_instances', scheduled_instances)
+            ])
+
+        if next_token and ec2_shutdown.deadline_reached(context):
+            logger.warning("Invocation deadline reached, stopping discovery in %s", region)
+            break
+
+    logger.info("Found %s running instances in %s", len(instance_index), region)
+
+    if (ec2_shutdown.inventory_store and inventory_instances is None and instance_ids is None
+            and not starting_token and not next_token):
+        with metrics.phase('discovery'):
+            await asyncio.to_thread(ec2_shutdown.reconcile_inventory, region, account_id,
+                                    list(instance_index.values()), observed_at)
+
+    with metrics.phase('monitoring'):
+        monitoring_enabled = await enable_detailed_monitoring(ec2, [instance.instance_id for instance in monitoring_candidates])
+        await asyncio.to_thread(ec2_shutdown.update_inventory_monitoring, region, account_id, monitoring_enabled)
+    deferred_ids = set(monitoring_enabled)
+    evaluation_candidates.extend(
+        instance for instance in monitoring_candidates if instance.instance_id not in deferred_ids
+    )
+    evaluations.append(asyncio.ensure_future(
+        find_idle_instances(cloudwatch, evaluation_candidates, instance_index, semaphore)
+    ))
+
+    # Chunks are gathered in discovery order, so result order matches the thread pool engine
+    shutdown_candidates = []
+    active_instances = []
+    for idle_instances, active in await asyncio.gather(*evaluations):
+        shutdown_candidates.extend(idle_instances)
+        active_instances.extend(active)
+    active_instances.extend(scheduled_instances)
+
+    with metrics.phase('shutdown'):
+        if inventory_instances is not None:
+            shutdown_candidates, stale = await verify_shutdown_candidates(ec2, shutdown_candidates, region, account_id)
+            skipped_instances.extend(stale)
+        shutdown_results = await shutdown_instances(ec2, shutdown_candidates, semaphore)
+
+    if report_writer:
+        return await asyncio.to_thread(ec2_shutdown.region_result, region, account_id, instance_index, skipped_instances,
+                                       active_instances, monitoring_enabled, shutdown_results, next_token, report_writer)
+    return ec2_shutdown.region_result(region, account_id, instance_index, skipped_instances, active_instances,
+                                      monitoring_enabled, shutdown_results, next_token)
+
+
+async def get_discovery_pages(ec2: Any, starting_token: Optional[str],
+                              inventory_instances: Optional[List[InstanceRecord]],
+                              instance_ids: Optional[List[str]] = None) -> AsyncIterator[Tuple[List[InstanceRecord], Optional[str]]]:
+    """
+    Yield the inventory's running instances as one page, or DescribeInstances pages without an inventory
+    With instance_ids, only the running instances among them are described
+    """
+    if inventory_instances is not None:
+        yield inventory_instances, None
+        return
+    if instance_ids is not None:
+        for request in ec2_shutdown.describe_instance_ids_requests(instance_ids):
+            paginator = ec2.get_paginator('describe_instances')
+            async for page in paginator.paginate(**request):
+                yield ec2_shutdown.page_instances(page), None
+        return
+    async for page in get_running_instance_pages(ec2, starting_token):
+        yield page
+
+
+async def timed_pages(name: str, pages: AsyncIterator[Any]) -> AsyncIterator[Any]:
+    """
+    Async counterpart of InvocationMetrics.timed_pages: time only the fetch of each page
+    """
+    iterator = pages.__aiter__()
+    while True:
+        with ec2_shutdown.invocation_metrics.phase(name):
+            try:
+                page = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+        yield page
+
+
+async def verify_shutdown_candidates(ec2: Any, candidates: List[InstanceRecord], region: str,
+                                     account_id: Optional[str]) -> Tuple[List[InstanceRecord], List[Dict[str, Any]]]:
+    """
+    Describe inventory shutdown candidates again before stopping them
+    """
+    described = []
+    for request in ec2_shutdown.describe_instance_ids_requests([instance.instance_id for instance in candidates]):
+        paginator = ec2.get_paginator('describe_instances')
+        async for page in paginator.paginate(**request):
+            described.extend(ec2_shutdown.page_instances(page))
+    return ec2_shutdown.verified_shutdown_candidates(candidates, described, region, account_id)
+
+
+async def get_running_instance_pages(ec2: Any, starting_token: Optional[str] = None) -> AsyncIterator[Tuple[List[InstanceRecord], Optional[str]]]:
+    """
+    Yield (instances, next token) for each DescribeInstances page of running instances
+    """
+    try:
+        paginator = ec2.get_paginator('describe_instances')
+        async for page in paginator.paginate(**ec2_shutdown.describe_instances_request(starting_token)):
+            yield ec2_shutdown.page_instances(page), page.get('NextToken')
+
+    except Exception as e:
+        logger.error("Error getting running instances: %s", e)
+        raise
+
+
+async def find_idle_instances(cloudwatch: Any, candidates: List[InstanceRecord],
+                              instance_index: Dict[str, InstanceRecord],
+                              semaphore: asyncio.Semaphore) -> Tuple[List[InstanceRecord], List[Dict[str, Any]]]:
+    """
+    Evaluate a chunk of candidate instances into idle instances and active records
+    State and schedule store reads and writes block, so they run in a worker thread
+    """
+    if not candidates:
+        return [], []
+
+    instance_ids = [instance.instance_id for instance in candidates]
+    metrics = ec2_shutdown.invocation_metrics
+    if ec2_shutdown.EVALUATION_ENGINE == 'metric_math' and not ec2_shutdown.idle_state_store:
+        with metrics.phase('metrics'):
+            summaries, signal_peaks = await get_metric_summaries(cloudwatch, instance_ids, semaphore)
+        with metrics.phase('evaluation'):
+            return await asyncio.to_thread(ec2_shutdown.decide_idle_instances, candidates, {}, instance_index, {},
+                                           signal_peaks, summaries)
+
+    with metrics.phase('evaluation'):
+        states, since = await asyncio.to_thread(ec2_shutdown.load_idle_states, instance_ids)
+    with metrics.phase('metrics'):
+        cpu_metrics, signal_peaks = await get_instance_metrics(cloudwatch, instance_ids, since, semaphore)
+    with metrics.phase('evaluation'):
+        return await asyncio.to_thread(ec2_shutdown.decide_idle_instances, candidates, cpu_metrics,
+                                       instance_index, states, signal_peaks)
+
+
+async def get_instance_metrics(cloudwatch: Any, instance_ids: List[str], since: Optional[Dict[str, Any]],
+                               semaphore: asyncio.Semaphore) -> Tuple[Dict[str, List[Dict[str, Any]]], Dict[str, Dict[str, float]]]:
+    """
+    Fetch CPU datapoints and idle-signal peaks with GetMetricData requests running concurrently
+    """
+    cpu_metrics = ec2_shutdown.new_cpu_metrics(instance_ids)
+    signal_peaks = {instance_id: {} for instance_id in instance_ids}
+
+    async def fetch_batch(query_ids: Dict[str, Tuple[str, str]], request: Dict[str, Any]) -> None:
+        try:
+            async with semaphore:
+                while True:
+                    response = await cloudwatch.get_metric_data(**request)
+                    ec2_shutdown.add_metric_results(cpu_metrics, signal_peaks, query_ids, response, since)
+
+                    next_token = response.get('NextToken')
+                    if not next_token:
+                        break
+                    request['NextToken'] = next_token
+
+        except Exception as e:
+            # Instances without metrics are treated as not idle
+            logger.error("Error fetching metrics for %s queries: %s", len(query_ids), e)
+
+    await asyncio.gather(*(
+        fetch_batch(query_ids, request)
+        for query_ids, request in ec2_shutdown.metric_data_requests(instance_ids, since)
+    ))
+    return cpu_metrics, signal_peaks
+
+
+async def get_metric_summaries(cloudwatch: Any, instance_ids: List[str],
+                               semaphore: asyncio.Semaphore) -> Tuple[Dict[str, Dict[str, float]], Dict[str, Dict[str, float]]]:
+    """
+    Fetch metric math summaries and idle-signal peaks with GetMetricData requests running concurrently
+    """
+    summaries = {instance_id: {} for instance_id in instance_ids}
+    signal_peaks = {instance_id: {} for instance_id in instance_ids}
+
+    async def fetch_batch(query_ids: Dict[str, Tuple[str, str]], request: Dict[str, Any]) -> None:
+        try:
+            async with semaphore:
+                while True:
+                    response = await cloudwatch.get_metric_data(**request)
+                    seen = ec2_shutdown.add_summary_results(summaries, signal_peaks, query_ids, response)
+
+                    next_token = response.get('NextToken')
+                    if not next_token or seen >= query_ids.keys():
+                        break
+                    request['NextToken'] = next_token
+
+        except Exception as e:
+            # Instances without a summary are treated as not idle
+            logger.error("Error fetching metric summaries for %s expressions: %s", len(query_ids), e)
+
+    await asyncio.gather(*(
+        fetch_batch(query_ids, request)
+        for query_ids, request in ec2_shutdown.metric_summary_requests(instance_ids)
+    ))
+    return summaries, signal_peaks
+
+
+async def enable_detailed_monitoring(ec2: Any, instance_ids: List[str]) -> List[str]:
+    """
+    Enable detailed monitoring with a single MonitorInstances call
+    Returns the IDs whose evaluation is deferred to the next run
+    """
+    if not instance_ids:
+        return []
+
+    logger.info("Enabling detailed monitoring for %s instances", len(instance_ids))
+
+    if ec2_shutdown.DRY_RUN:
+        logger.info("DRY_RUN: Would enable detailed monitoring for %s instances", len(instance_ids))
+        return []
+
+    try:
+        return ec2_shutdown.monitored_instance_ids(await ec2.monitor_instances(InstanceIds=instance_ids))
+
+    except Exception as e:
+        logger.error("Error enabling detailed monitoring for %s instances: %s", len(instance_ids), e)
+        return []
+
+
+async def shutdown_instances(ec2: Any, instances: List[InstanceRecord],
+                             semaphore: asyncio.Semaphore) -> List[Dict[str, Any]]:
+    """
+    Shut down instances with StopInstances batches running concurrently
+    Hibernation-capable instances are hibernated in batches of their own, as in the thread pool engine
+    Returns one result per instance, in the same order as the input
+    """
+    await lookup_hibernation_support(ec2, instances)
+    hibernating, stopping = ec2_shutdown.split_hibernation_candidates(instances)
+    if ec2_shutdown.DRY_RUN:
+        return ec2_shutdown.dry_run_shutdown_results(instances, hibernating)
+
+    batch_size = ec2_shutdown.STOP_INSTANCES_BATCH_SIZE
+    batches = await asyncio.gather(*(
+        stop_instance_batch(ec2, group[batch_start:batch_start + batch_size], semaphore, hibernate)
+        for group, hibernate in ((hibernating, True), (stopping, False))
+        for batch_start in range(0, len(group), batch_size)
+    ))
+    results = {result['instance_id']: result for batch in batches for result in batch}
+    return [results[instance.instance_id] for instance in instances]
+
+
+async def lookup_hibernation_support(ec2: Any, instances: List[InstanceRecord]) -> None:
+    """
+    Describe the types of hibernation-configured instances that are not cached
+    yet, into the same cache as ec2_shutdown.lookup_hibernation_support
+    Types another target is describing are waited for instead
+    """
+    done = asyncio.Event()
+    instance_types = ec2_shutdown.hibernation_lookup_types(instances)
+    waiting = {_hibernation_lookups[instance_type] for instance_type in instance_types if instance_type in _hibernation_lookups}
+    instance_types = [instance_type for instance_type in instance_types if instance_type not in _hibernation_lookups]
+    _hibernation_lookups.update(dict.fromkeys(instance_types, done))
+
+    try:
+        batch_size = ec2_shutdown.DESCRIBE_INSTANCE_TYPES_BATCH_SIZE
+        for batch_start in range(0, len(instance_types), batch_size):
+            batch = instance_types[batch_start:batch_start + batch_size]
+            try:
+                paginator = ec2.get_paginator('describe_instance_types')
+                async for page in paginator.paginate(InstanceTypes=batch):
+                    ec2_shutdown.cache_hibernation_support(page)
+            except Exception as e:
+                logger.error("Error describing instance types %s, stopping their instances without hibernation: %s", batch, e)
+    finally:
+        for instance_type in instance_types:
+            del _hibernation_lookups[instance_type]
+        done.set()
+
+    for event in waiting:
+        await event.wait()
+
+
+async def stop_instance_batch(ec2: Any, instances: List[InstanceRecord],
+                              semaphore: asyncio.Semaphore, hibernate: bool = False) -> List[Dict[str, Any]]:
+    """
+    Stop (or hibernate) a batch of instances in one StopInstances call, bisecting
+    on per-instance errors and stopping instances that cannot hibernate
+    """
+    try:
+        async with semaphore:
+            response = await ec2.stop_instances(**ec2_shutdown.stop_instances_request(instances, hibernate))
+
+    except ClientError as e:
+        if ec2_shutdown.stop_batch_bisectable(instances, e):
+            middle = len(instances) // 2
+            first, second = await asyncio.gather(
+                stop_instance_batch(ec2, instances[:middle], semaphore, hibernate),
+                stop_instance_batch(ec2, instances[middle:], semaphore, hibernate)
+            )
+            return first + second
+        if ec2_shutdown.hibernate_fallback(instances, e, hibernate):
+            return await stop_instance_batch(ec2, instances, semaphore)
+        return [ec2_shutdown.shutdown_error_result(instance, e) for instance in instances]
+
+    except Exception as e:
+        return [ec2_shutdown.shutdown_error_result(instance, e) for instance in instances]
+
+    return ec2_shutdown.stop_batch_results(instances, response, hibernate)
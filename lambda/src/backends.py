@@ -0,0 +1,35 @@
+from typing import Any, Callable, Optional, Tuple
+
+# Returns a boto3 client for a service name; the Lambda passes get_client, which caches them
+ClientFactory = Callable[[str], Any]
+
+
+class LazyClientMixin:
+    """
+    Client of an AWS-backed store, queue or sink, requested from client_factory
+    on every use rather than when the backend is created, so backends built
+    while the Lambda module is imported never load a botocore client
+    Subclasses set service_name and assign client_factory in __init__
+    """
+
+    service_name = ''
+    client_factory: ClientFactory
+
+    @property
+    def client(self) -> Any:
+        return self.client_factory(self.service_name)
+
+
+def parse_location(location: str, kind: str, backends: Tuple[str, ...]) -> Optional[Tuple[str, str]]:
+    """
+    Split a '<backend>:<target>' location from the environment into backend and target
+    Returns None for an empty location, which leaves the feature off, and raises
+    ValueError naming kind when the backend is not one of backends
+    """
+    if not location:
+        return None
+
+    backend, _, target = location.partition(':')
+    if backend not in backends:
+        raise ValueError(f"Unsupported {kind} location: {location}")
+    return backend, target
@@ -0,0 +1,139 @@
+import abc
+import json
+import logging
+import os
+from typing import List, Dict, Any, Optional
+
+from backends import ClientFactory, LazyClientMixin, parse_location
+
+logger = logging.getLogger(__name__)
+
+
+class CheckpointStore(abc.ABC):
+    """
+    Run checkpoints that let a continued invocation pick up where the last one stopped
+    A checkpoint holds the pending target cursors and the report accumulated so far
+    """
+
+    @abc.abstractmethod
+    def load(self, run_id: str) -> Optional[Dict[str, Any]]:
+        """
+        The saved checkpoint, or None when there is none
+        """
+
+    @abc.abstractmethod
+    def save(self, run_id: str, checkpoint: Dict[str, Any]) -> None:
+        """
+        Save a checkpoint, replacing any saved under the same ID
+        """
+
+    @abc.abstractmethod
+    def delete(self, run_id: str) -> None:
+        """
+        Delete a checkpoint; deleting one that does not exist is not an error
+        """
+
+    @abc.abstractmethod
+    def list_ids(self, prefix: str) -> List[str]:
+        """
+        IDs of the saved checkpoints that start with prefix
+        """
+
+
+class FileCheckpointStore(CheckpointStore):
+    """
+    Checkpoints as JSON files in a local directory, for local runs and benchmarks
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, run_id: str) -> str:
+        return os.path.join(self.directory, f"{run_id}.json")
+
+    def load(self, run_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(run_id), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, run_id: str, checkpoint: Dict[str, Any]) -> None:
+        # Write then rename so a crash never leaves a truncated checkpoint
+        temp_path = f"{self._path(run_id)}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(temp_path, self._path(run_id))
+
+    def delete(self, run_id: str) -> None:
+        try:
+            os.remove(self._path(run_id))
+        except FileNotFoundError:
+            pass
+
+    def list_ids(self, prefix: str) -> List[str]:
+        return sorted(
+            name[:-len('.json')] for name in os.listdir(self.directory)
+            if name.startswith(prefix) and name.endswith('.json')
+        )
+
+
+class S3CheckpointStore(LazyClientMixin, CheckpointStore):
+    """
+    Checkpoints as JSON objects under a prefix in an S3 bucket
+    """
+
+    service_name = 's3'
+
+    def __init__(self, bucket: str, prefix: str, client_factory: ClientFactory):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.client_factory = client_factory
+
+    def _key(self, run_id: str) -> str:
+        return f"{self.prefix}/{run_id}.json" if self.prefix else f"{run_id}.json"
+
+    def load(self, run_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._key(run_id))
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return json.loads(response['Body'].read())
+
+    def save(self, run_id: str, checkpoint: Dict[str, Any]) -> None:
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self._key(run_id),
+            Body=json.dumps(checkpoint).encode('utf-8'),
+            ContentType='application/json'
+        )
+
+    def delete(self, run_id: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(run_id))
+
+    def list_ids(self, prefix: str) -> List[str]:
+        key_prefix = self._key(prefix)[:-len('.json')]
+        ids = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=key_prefix):
+            for item in page.get('Contents', []):
+                if item['Key'].endswith('.json'):
+                    ids.append(prefix + item['Key'][len(key_prefix):-len('.json')])
+        return sorted(ids)
+
+
+def create_checkpoint_store(location: str, client_factory: ClientFactory) -> Optional[CheckpointStore]:
+    """
+    Checkpoint store for CHECKPOINT_STORE, 's3:<bucket>/<prefix>' or 'file:<directory>'
+    Without one, a run that reaches its deadline lists its pending targets instead
+    """
+    parsed = parse_location(location, 'checkpoint store', ('s3', 'file'))
+    if parsed is None:
+        return None
+
+    backend, target = parsed
+    if backend == 's3':
+        bucket, _, prefix = target.partition('/')
+        return S3CheckpointStore(bucket, prefix, client_factory)
+    return FileCheckpointStore(target)
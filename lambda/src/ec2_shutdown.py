@@ -1,10 +1,26 @@
+import importlib.util
 import json
 import logging
+import math
 import os
-import time
+import threading
+import uuid
 import boto3
-from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Any, Iterator, Optional, Set, Tuple
+
+from checkpoint_store import create_checkpoint_store
+from instance_record import InstanceRecord
+from inventory_store import create_inventory_store
+from invocation_metrics import InvocationMetrics
+from rate_limiter import create_rate_limiter
+from report_sink import REPORT_KINDS, ReportWriter, create_report_sink
+from state_store import SCHEDULE_FIELDS, create_state_store
+from structured_logging import DecisionLog, use_json_format
+from work_queue import create_work_queue
 
 # Configure logging
 log_level = os.environ.get('LOG_LEVEL', 'INFO')
@@ -14,216 +30,1959 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Configure boto3 logging if needed for debugging
-if log_level == 'DEBUG':
-    boto3.set_stream_logger('boto3', logging.DEBUG)
-    boto3.set_stream_logger('botocore', logging.DEBUG)
+# 'json' writes every record as one JSON object with its fields (instance_id,
+# outcome, decision_counts) instead of a line of text
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()
+if LOG_FORMAT == 'json':
+    use_json_format()
+
+# Fraction of instances whose per-instance lines (skip reasons, evaluation
+# details, decisions) are logged; every instance is still counted in the
+# invocation's summary line. Sampling is by instance ID, so a sampled
+# instance's lines are all logged, in every run
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '1' if LOG_FORMAT == 'text' else '0.01'))
+decision_log = DecisionLog(logger, LOG_SAMPLE_RATE)
+
+# Configure boto3 logging if needed for debugging
+if log_level == 'DEBUG':
+    boto3.set_stream_logger('boto3', logging.DEBUG)
+    boto3.set_stream_logger('botocore', logging.DEBUG)
+
+# AWS clients are created on first use by get_client, so services a run never
+# touches (STS, Lambda, S3, DynamoDB) cost nothing at cold start
+DEFAULT_REGION = os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION')
+_client_cache: Dict[Tuple[str, Optional[str]], Any] = {}
+_client_cache_lock = threading.Lock()
+
+# Assumed-role sessions keyed by role ARN, shared across worker threads. The
+# module lock only guards the dicts; each role has its own lock, held while it
+# is assumed, so accounts are assumed concurrently but each role only once
+_session_cache: Dict[str, Tuple[boto3.session.Session, datetime]] = {}
+_session_cache_lock = threading.Lock()
+_role_locks: Dict[str, threading.Lock] = {}
+
+# EC2 and CloudWatch clients of targets other than the Lambda's own region, keyed by
+# (account ID, region), with the session they were created from; a hub target's
+# clients are replaced when its assumed-role session is refreshed
+_target_client_cache: Dict[Tuple[Optional[str], str], Tuple[boto3.session.Session, Any, Any]] = {}
+_target_client_cache_lock = threading.Lock()
+
+# Hibernation support of each instance type from DescribeInstanceTypes; a type's
+# capabilities do not change, so each is looked up once per container. Reentrant,
+# as the lookup holds it while calling hibernation_lookup_types
+_hibernation_support: Dict[str, bool] = {}
+_hibernation_support_lock = threading.RLock()
+# Instance types being described, with an event set when their lookup ends;
+# other targets wait for it instead of describing the same type again
+_hibernation_lookups: Dict[str, threading.Event] = {}
+
+# Configuration
+CPU_THRESHOLD = 1.0  # CPU utilization percentage threshold
+IDLE_DURATION_HOURS = 3  # Hours of idle time before shutdown
+METRIC_GAP_SECONDS = 360  # More than 6 minutes between datapoints counts as a gap
+MAX_TOTAL_GAP_SECONDS = 600  # 10 minutes total gap allowed
+# Signals besides CPU that keep an instance running: 'MetricName=threshold' pairs of
+# AWS/EC2 per-instance metrics, compared with each five-minute total (Sum) in the idle
+# window. They are fetched in the same GetMetricData requests as CPUUtilization, one
+# more query per instance each, so they are opt-in; empty (the default) evaluates CPU only
+IDLE_SIGNAL_THRESHOLDS = {
+    metric_name.strip(): float(threshold)
+    for metric_name, _, threshold in (
+        entry.partition('=')
+        for entry in os.environ.get('IDLE_SIGNAL_THRESHOLDS', '').split(',')
+        if entry.strip()
+    )
+}
+DRY_RUN = os.environ.get('DRY_RUN', 'false').lower() == 'true'
+ENABLE_DETAILED_MONITORING = os.environ.get('ENABLE_DETAILED_MONITORING', 'false').lower() == 'true'
+
+# Instance types to exclude (P and G types for GPU/ML workloads)
+EXCLUDED_INSTANCE_TYPES = ['p', 'g']
+
+# CloudWatch GetMetricData accepts at most 500 queries per request
+METRIC_DATA_MAX_QUERIES = 500
+
+# Page size for DescribeInstances (API maximum is 1000)
+DESCRIBE_INSTANCES_PAGE_SIZE = 1000
+
+# Instance IDs per StopInstances request
+STOP_INSTANCES_BATCH_SIZE = 1000
+
+# StopInstances errors caused by individual instances; the batch is bisected
+# to isolate them instead of failing every instance in it
+BISECT_ERROR_CODES = {
+    'IncorrectInstanceState',
+    'InvalidInstanceID.NotFound',
+    'OperationNotPermitted',
+    'UnauthorizedOperation',
+    'UnsupportedHibernationConfiguration',
+    'UnsupportedOperation'
+}
+
+# Shutdown strategy: 'stop' (the default) stops every instance. 'hibernate' hibernates
+# instances launched with hibernation configured, on an instance type that supports it,
+# with StopInstances(Hibernate=True) in batches of their own, so their memory survives
+# the stop; other instances are stopped
+SHUTDOWN_STRATEGY = os.environ.get('SHUTDOWN_STRATEGY', 'stop').lower()
+
+# Errors of a hibernating StopInstances call for an instance that cannot hibernate
+# right now (for example before its hibernation agent is ready); once bisected down
+# to that instance, it is stopped without hibernation instead
+HIBERNATE_FALLBACK_ERROR_CODES = {'UnsupportedHibernationConfiguration', 'UnsupportedOperation'}
+
+# Instance types per DescribeInstanceTypes request (API maximum is 100)
+DESCRIBE_INSTANCE_TYPES_BATCH_SIZE = 100
+
+# Regions to process in one invocation (comma-separated); defaults to the Lambda's own region
+TARGET_REGIONS = [region.strip() for region in os.environ.get('TARGET_REGIONS', '').split(',') if region.strip()]
+
+# Maximum number of regions (account/region pairs in hub mode) processed concurrently
+MAX_REGION_WORKERS = int(os.environ.get('MAX_REGION_WORKERS', '4'))
+
+# Shared botocore settings for every client. Adaptive retries back off and rate-limit
+# the client when AWS throttles instead of failing the call, and the connection pool
+# is sized so concurrent workers sharing a client do not queue for a connection
+CLIENT_MAX_ATTEMPTS = int(os.environ.get('CLIENT_MAX_ATTEMPTS', '10'))
+CLIENT_CONNECT_TIMEOUT = float(os.environ.get('CLIENT_CONNECT_TIMEOUT', '5'))
+CLIENT_READ_TIMEOUT = float(os.environ.get('CLIENT_READ_TIMEOUT', '30'))
+CLIENT_MAX_POOL_CONNECTIONS = int(os.environ.get('CLIENT_MAX_POOL_CONNECTIONS', str(max(10, MAX_REGION_WORKERS))))
+CLIENT_CONFIG_OPTIONS = {
+    'retries': {'max_attempts': CLIENT_MAX_ATTEMPTS, 'mode': 'adaptive'},
+    'max_pool_connections': CLIENT_MAX_POOL_CONNECTIONS,
+    'connect_timeout': CLIENT_CONNECT_TIMEOUT,
+    'read_timeout': CLIENT_READ_TIMEOUT,
+    'tcp_keepalive': True
+}
+CLIENT_CONFIG = Config(**CLIENT_CONFIG_OPTIONS)
+
+# Phase durations and API call counters of each lambda_handler invocation,
+# printed as one CloudWatch Embedded Metric Format record when it returns.
+# Every emitted value is a custom metric in METRICS_NAMESPACE. On by default
+# only in Lambda; without it the counters are still kept for invocation_metrics.snapshot()
+EMIT_METRICS = os.environ.get('EMIT_METRICS', 'true' if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') else 'false').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'EC2AutoShutdown')
+invocation_metrics = InvocationMetrics(
+    METRICS_NAMESPACE,
+    {'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'ec2-auto-shutdown')}
+)
+
+# Client-side requests per second per (account, region, API operation), as
+# 'Operation=rate' pairs; each bucket halves its rate when AWS throttles and
+# recovers on successful calls. Empty disables client-side rate limiting
+API_RATE_LIMITS = os.environ.get('API_RATE_LIMITS', 'DescribeInstances=20,GetMetricData=50,MonitorInstances=5,StopInstances=5')
+rate_limiter = create_rate_limiter(
+    API_RATE_LIMITS, lambda operation, seconds: invocation_metrics.add_phase('rate_limit_wait', seconds)
+)
+
+# Hub mode: assume EC2ShutdownRole in every account listed in the accounts config
+HUB_MODE = os.environ.get('HUB_MODE', 'false').lower() == 'true'
+ACCOUNTS_CONFIG_PATH = os.environ.get('ACCOUNTS_CONFIG_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ou-accounts.yaml'))
+
+# Assumed-role credentials are refreshed this many seconds before they expire
+CREDENTIAL_REFRESH_MARGIN_SECONDS = 300
+
+# Idle-streak state store ('dynamodb:<table>' or 'sqlite:<path>'); when set, each run
+# only fetches datapoints newer than the previous evaluation
+idle_state_store = create_state_store(os.environ.get('STATE_STORE', ''), lambda service_name: get_client(service_name))
+
+# Evaluation schedule ('dynamodb:<table>' or 'sqlite:<path>'); when set, each active
+# instance is given the earliest time it could become idle and is not queried until then
+schedule_store = create_state_store(os.environ.get('SCHEDULE_STORE', ''), lambda service_name: get_client(service_name),
+                                    SCHEDULE_FIELDS, 'evaluation_schedule')
+
+# Instance inventory ('dynamodb:<table>' or 'sqlite:<path>') kept current by inventory_handler
+# from EC2 state-change events; when set, scheduled runs evaluate the instances it lists as
+# running instead of describing every running instance of a target
+inventory_store = create_inventory_store(os.environ.get('INVENTORY_STORE', ''), lambda service_name: get_client(service_name))
+
+# A target is discovered with DescribeInstances again, and its inventory reconciled,
+# when its last full reconciliation is older than this
+INVENTORY_RECONCILE_HOURS = float(os.environ.get('INVENTORY_RECONCILE_HOURS', '168'))
+
+# Instance IDs per DescribeInstances call when re-describing inventory shutdown candidates
+DESCRIBE_INSTANCE_IDS_BATCH_SIZE = 200
+
+# Stop starting new work when less than this much invocation time remains
+DEADLINE_SAFETY_MARGIN_MS = int(os.environ.get('DEADLINE_SAFETY_MARGIN_MS', '60000'))
+
+# Checkpoint store ('s3:<bucket>/<prefix>' or 'file:<directory>'); when set, a run
+# that reaches the deadline saves its cursors and re-invokes the function to continue
+checkpoint_store = create_checkpoint_store(os.environ.get('CHECKPOINT_STORE', ''), lambda service_name: get_client(service_name))
+
+# Work queue ('sqs:<queue_url>' or 'memory:'); when set, a scheduled run only lists
+# running instance IDs and queues them in shards, and the function processes each
+# shard when invoked with its SQS messages. Partial reports go to the checkpoint store
+work_queue = create_work_queue(os.environ.get('WORK_QUEUE', ''), lambda service_name: get_client(service_name))
+
+# Instance IDs per work queue shard
+WORK_QUEUE_SHARD_SIZE = int(os.environ.get('WORK_QUEUE_SHARD_SIZE', '1000'))
+
+# Report sink ('s3:<bucket>/<prefix>' or 'file:<directory>'); when set, the records of
+# skipped, active, deferred and shut down instances are written to it in chunks while
+# each target is processed, and the response keeps only their counts and the report location
+REPORT_SINK = os.environ.get('REPORT_SINK', '')
+
+# Report file format: 'ndjson' or 'parquet' (pyarrow must be added to the package
+# or a layer; without it NDJSON is written)
+REPORT_FORMAT = os.environ.get('REPORT_FORMAT', 'ndjson').lower()
+if REPORT_SINK and REPORT_FORMAT == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+    logger.warning("pyarrow is not available, writing the report as NDJSON")
+    REPORT_FORMAT = 'ndjson'
+
+# Records a target buffers before they are written out, as one NDJSON block or Parquet row group
+REPORT_CHUNK_RECORDS = int(os.environ.get('REPORT_CHUNK_RECORDS', '10000'))
+report_sink = create_report_sink(REPORT_SINK, lambda service_name: get_client(service_name),
+                                 REPORT_FORMAT, REPORT_CHUNK_RECORDS)
+
+# Idle evaluation engine: 'python' evaluates instances one by one, 'vectorized'
+# evaluates each chunk with NumPy array operations (NumPy must be packaged),
+# 'metric_math' has CloudWatch reduce each instance's idle window to a few scalars
+EVALUATION_ENGINE = os.environ.get('EVALUATION_ENGINE', 'python').lower()
+idle_matrix = None
+if EVALUATION_ENGINE == 'vectorized':
+    try:
+        import idle_matrix
+    except ImportError:
+        logger.warning("NumPy is not available, falling back to per-instance evaluation")
+elif EVALUATION_ENGINE == 'metric_math' and idle_state_store:
+    logger.warning("Metric math summarizes the whole idle window, using the state store's idle streaks instead")
+
+# Metric math summary of an instance's CPU series, evaluated by CloudWatch;
+# NaN fails '<=' and so counts as a breach, as it does in is_instance_idle
+CPU_SUMMARY_EXPRESSIONS = {
+    'max_cpu': 'MAX({query_id})',
+    'datapoints': 'DATAPOINT_COUNT({query_id})',
+    'breaches': 'SUM(IF({query_id} <= {threshold}, 0, 1))',
+    'gap_seconds': 'SUM(IF(DIFF_TIME({query_id}) > {gap}, DIFF_TIME({query_id}), 0))'
+}
+
+# Added to the summary when an evaluation schedule is kept: epoch seconds of the
+# most recent datapoint above the CPU threshold, 0 when there is none
+SCHEDULE_SUMMARY_EXPRESSIONS = {
+    'last_busy': 'MAX(IF({query_id} > {threshold}, EPOCH({query_id}), 0))'
+}
+
+# Drop excluded instance types in DescribeInstances instead of reporting them as skipped
+SERVER_SIDE_TYPE_FILTER = os.environ.get('SERVER_SIDE_TYPE_FILTER', 'false').lower() == 'true'
+
+# Execution engine: 'threads' processes targets in a thread pool with blocking
+# calls, 'asyncio' runs discovery, metric and stop calls as coroutines through
+# aiobotocore (which must be packaged); async_engine is imported on first use
+EXECUTION_ENGINE = os.environ.get('EXECUTION_ENGINE', 'threads').lower()
+_async_engine = None
+
+# Maximum GetMetricData and StopInstances calls in flight at once in the asyncio engine
+ASYNC_MAX_CONCURRENCY = int(os.environ.get('ASYNC_MAX_CONCURRENCY', '32'))
+
+
+def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    Main Lambda handler for EC2 auto-shutdown, see handle_event
+    Emits the invocation's phase durations and API call counters as an EMF record
+    """
+    invocation_metrics.reset()
+    decision_log.reset()
+    response = handle_event(event, context)
+    decision_log.log_summary()
+    
+    body = response.get('body', {})
+    if 'total_instances_evaluated' in body:
+        invocation_metrics.set_value('instances_evaluated', body['total_instances_evaluated'])
+        invocation_metrics.set_value('instances_shutdown', body['instances_shutdown'])
+    if EMIT_METRICS:
+        try:
+            invocation_metrics.emit({
+                'request_id': getattr(context, 'aws_request_id', None),
+                'status_code': response.get('statusCode'),
+                'run_id': body.get('run_id')
+            })
+        except Exception as e:
+            logger.error("Error emitting invocation metrics: %s", e)
+    return response
+
+
+def handle_event(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    Run EC2 auto-shutdown for one invocation
+    In hub mode every account and region in the accounts config is processed
+    through assumed roles; otherwise regions can be passed as event['regions']
+    or TARGET_REGIONS, defaulting to the Lambda's own region
+    Stops starting new work when the invocation nears its deadline; with a
+    checkpoint store it then re-invokes itself to continue from the saved cursors
+    With a work queue, the run is sharded instead: see coordinate_run,
+    process_shard_messages and aggregate_run
+    """
+    logger.info("Starting EC2 auto-shutdown process")
+    if rate_limiter:
+        logger.info("Rate limiting AWS calls per account and region: %s", rate_limiter.rates)
+    
+    try:
+        if deadline_reached(context):
+            raise RuntimeError("Less invocation time left than DEADLINE_SAFETY_MARGIN_MS before starting")
+        
+        event = event or {}
+        if is_sqs_event(event):
+            return process_shard_messages(event, context)
+        if event.get('aggregate_run_id'):
+            return aggregate_response(event['aggregate_run_id'])
+        
+        run_id = event.get('continuation_run_id')
+        checkpoint = None
+        if run_id and checkpoint_store:
+            checkpoint = checkpoint_store.load(run_id)
+            if checkpoint is None:
+                raise RuntimeError(f"No checkpoint found for run {run_id}")
+        
+        if checkpoint:
+            logger.info("Continuing run %s (invocation %s)", run_id, checkpoint['invocation'] + 1)
+            cursors = checkpoint['cursors']
+            report = checkpoint['report']
+            invocation = checkpoint['invocation'] + 1
+        else:
+            if event.get('hub_mode', HUB_MODE):
+                targets = load_account_targets(ACCOUNTS_CONFIG_PATH)
+            else:
+                regions = event.get('regions') or TARGET_REGIONS or [DEFAULT_REGION]
+                targets = [{'region': region} for region in regions]
+            
+            if work_queue:
+                return coordinate_run(targets)
+            
+            run_id = str(uuid.uuid4())
+            cursors = [{'target': target, 'next_token': None} for target in targets]
+            report = new_report([target_label(target) for target in targets])
+            invocation = 1
+        
+        if report_sink:
+            report['report_location'] = report_sink.location(run_id)
+            for cursor in cursors:
+                cursor['report_part'] = (run_id, f"{invocation:03d}-{target_label(cursor['target']).replace('/', '-')}")
+        
+        target_results = run_targets(cursors, context)
+        
+        # Merge per-target results in the order the targets were listed
+        pending_cursors = []
+        for cursor in cursors:
+            label = target_label(cursor['target'])
+            result = target_results[label]
+            if isinstance(result, Exception):
+                report['failed_targets'][label] = str(result)
+                continue
+            merge_target_result(report, result)
+            if not result['complete']:
+                pending_cursors.append({'target': cursor['target'], 'next_token': result['next_token']})
+        
+        if pending_cursors and checkpoint_store:
+            checkpoint_store.save(run_id, {'cursors': pending_cursors, 'report': report, 'invocation': invocation})
+            continue_run(context, event, run_id)
+            logger.info("Deadline reached with %s targets pending, continuing run %s", len(pending_cursors), run_id)
+            return {
+                'statusCode': 202,
+                'body': {
+                    'message': 'EC2 auto-shutdown continuing in a new invocation',
+                    'run_id': run_id,
+                    'pending_targets': [target_label(cursor['target']) for cursor in pending_cursors]
+                }
+            }
+        
+        if run_id and checkpoint:
+            checkpoint_store.delete(run_id)
+        
+        response = report_response(report)
+        
+        if pending_cursors:
+            # No checkpoint store to continue from, so report what was left unprocessed
+            response['body']['message'] = 'EC2 auto-shutdown stopped at the invocation deadline'
+            response['body']['pending_targets'] = [target_label(cursor['target']) for cursor in pending_cursors]
+        
+        logger.info("Process completed: %s instances shut down, %s skipped",
+                    report_count(report, 'shutdown_results'), report_count(report, 'skipped_instances'))
+        return response
+        
+    except Exception as e:
+        logger.error("Error in EC2 auto-shutdown: %s", e, exc_info=True)
+        return {
+            'statusCode': 500,
+            'body': {
+                'error': str(e),
+                'message': 'EC2 auto-shutdown failed'
+            }
+        }
+
+
+def report_response(report: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Build the handler response for a finished run from its report
+    Raises when every target failed
+    """
+    if len(report['failed_targets']) == len(report['targets']):
+        raise RuntimeError(f"All targets failed: {report['failed_targets']}")
+    
+    # Prepare response
+    response = {
+        'statusCode': 200,
+        'body': {
+            'message': 'EC2 auto-shutdown completed successfully',
+            'targets': report['targets'],
+            'total_instances_evaluated': report['total_instances_evaluated'],
+            'instances_skipped': report_count(report, 'skipped_instances'),
+            'instances_active': report_count(report, 'active_instances'),
+            'instances_shutdown': report_count(report, 'shutdown_results'),
+            'instances_deferred': report_count(report, 'monitoring_enabled'),
+            'dry_run': DRY_RUN
+        }
+    }
+    
+    # With a report sink the records are in the report, not the response
+    if report.get('report_location'):
+        response['body']['report_location'] = report['report_location']
+    else:
+        response['body'].update((kind, report[kind]) for kind in REPORT_KINDS)
+    
+    if report['failed_targets']:
+        response['body']['message'] = f"EC2 auto-shutdown completed with errors in {len(report['failed_targets'])} targets"
+        response['body']['failed_targets'] = report['failed_targets']
+    
+    return response
+
+
+def inventory_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    Lambda handler for EC2 Instance State-change Notification events from EventBridge
+    Upserts the instance's state into the inventory, unless a newer event already
+    did; instances entering running are described so the inventory holds the
+    details evaluation needs. In hub mode, events from member accounts must be
+    forwarded to this account's event bus and the account must be in the accounts config
+    Errors are raised so the asynchronous invocation is retried
+    """
+    if not inventory_store:
+        raise RuntimeError("INVENTORY_STORE is not configured")
+    
+    detail = event['detail']
+    instance_id = detail['instance-id']
+    state = detail['state']
+    # Event times are whole seconds; the change happened before the end of that
+    # second, so a discovery started within it must not override the event
+    updated_at = datetime.strptime(event['time'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).timestamp() + 1
+    
+    target = {'region': event['region']}
+    if HUB_MODE:
+        matches = [
+            account_target for account_target in load_account_targets(ACCOUNTS_CONFIG_PATH)
+            if account_target['account_id'] == event['account'] and account_target['region'] == event['region']
+        ]
+        if not matches:
+            logger.warning("Ignoring %s event for %s: %s/%s is not a configured target", state, instance_id, event['account'], event['region'])
+            return {'statusCode': 200, 'body': {'instance_id': instance_id, 'state': state, 'applied': False}}
+        target = matches[0]
+    
+    record = {'instance_id': instance_id, 'state': state, 'updated_at': updated_at}
+    if state == 'running':
+        ec2, _ = get_target_clients(target)
+        response = ec2.describe_instances(**describe_instance_ids_requests([instance_id])[0])
+        instances = page_instances(response)
+        if not instances:
+            # Stopped again before it could be described; its stop event follows
+            logger.info("Instance %s is no longer running, ignoring its running event", instance_id)
+            return {'statusCode': 200, 'body': {'instance_id': instance_id, 'state': state, 'applied': False}}
+        record = inventory_record(instances[0], updated_at)
+    
+    applied = inventory_store.put(target_label(target), record)
+    logger.info("Inventory %s: %s is %s%s", target_label(target), instance_id, state, "" if applied else " (newer state already recorded)")
+    return {'statusCode': 200, 'body': {'instance_id': instance_id, 'state': state, 'applied': applied}}
+
+
+def new_report(labels: List[str]) -> Dict[str, Any]:
+    """
+    Empty run report that target results are merged into, across invocations
+    """
+    return {
+        'targets': labels,
+        'total_instances_evaluated': 0,
+        'skipped_instances': [],
+        'active_instances': [],
+        'monitoring_enabled': [],
+        'shutdown_results': [],
+        'record_counts': dict.fromkeys(REPORT_KINDS, 0),
+        'failed_targets': {}
+    }
+
+
+def merge_target_result(report: Dict[str, Any], result: Dict[str, Any]) -> None:
+    """
+    Add one target's (possibly partial) result to the run report
+    Records written to the report sink are only counted
+    """
+    report['total_instances_evaluated'] += result['instances_evaluated']
+    record_counts = report.setdefault('record_counts', dict.fromkeys(REPORT_KINDS, 0))
+    for kind in REPORT_KINDS:
+        report[kind].extend(result[kind])
+        record_counts[kind] += result.get('record_counts', {}).get(kind, 0)
+
+
+def report_count(report: Dict[str, Any], kind: str) -> int:
+    """
+    Number of records of a kind in a run report or target result, kept in its
+    list or already written to the report sink
+    """
+    return len(report[kind]) + report.get('record_counts', {}).get(kind, 0)
+
+
+def deadline_reached(context: Any) -> bool:
+    """
+    Check if the invocation is too close to its timeout to start new work
+    """
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return False
+    return context.get_remaining_time_in_millis() < DEADLINE_SAFETY_MARGIN_MS
+
+
+def continue_run(context: Any, event: Dict[str, Any], run_id: str) -> None:
+    """
+    Re-invoke this function asynchronously to continue the run from its checkpoint
+    """
+    lambda_client = get_client('lambda')
+    payload = dict(event)
+    payload['continuation_run_id'] = run_id
+    lambda_client.invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps(payload).encode('utf-8')
+    )
+
+
+def is_sqs_event(event: Dict[str, Any]) -> bool:
+    """
+    Check if the function was invoked by its SQS event source mapping
+    """
+    records = event.get('Records')
+    return bool(records) and records[0].get('eventSource') == 'aws:sqs'
+
+
+def coordinate_run(targets: List[Dict[str, str]]) -> Dict[str, Any]:
+    """
+    Coordinator mode: list the running instance IDs of every target and queue them in shards
+    The run's manifest (shard count, targets, targets that could not be listed) is
+    saved to the checkpoint store before any shard is queued, so that workers can
+    tell when every shard has reported
+    """
+    if not checkpoint_store:
+        raise RuntimeError("WORK_QUEUE requires CHECKPOINT_STORE for the partial reports")
+    
+    run_id = str(uuid.uuid4())
+    labels = [target_label(target) for target in targets]
+    listed = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_REGION_WORKERS, len(targets)))) as executor:
+        futures = {executor.submit(list_target_instance_ids, target): target_label(target) for target in targets}
+        for future in as_completed(futures):
+            label = futures[future]
+            try:
+                listed[label] = future.result()
+            except Exception as e:
+                logger.error("Error listing instances in %s: %s", label, e, exc_info=True)
+                listed[label] = e
+    
+    # Shards are numbered in the order the targets were listed
+    failed_targets = {}
+    messages = []
+    for target in targets:
+        label = target_label(target)
+        instance_ids = listed[label]
+        if isinstance(instance_ids, Exception):
+            failed_targets[label] = str(instance_ids)
+            continue
+        for shard_start in range(0, len(instance_ids), WORK_QUEUE_SHARD_SIZE):
+            messages.append({
+                'run_id': run_id,
+                'shard': len(messages),
+                'target': target,
+                'instance_ids': instance_ids[shard_start:shard_start + WORK_QUEUE_SHARD_SIZE]
+            })
+    
+    if not messages:
+        report = new_report(labels)
+        report['failed_targets'] = failed_targets
+        return report_response(report)
+    
+    checkpoint_store.save(f"{run_id}.manifest", {'shards': len(messages), 'targets': labels, 'failed_targets': failed_targets})
+    work_queue.send_many(messages)
+    logger.info("Queued %s shards of up to %s instances for run %s", len(messages), WORK_QUEUE_SHARD_SIZE, run_id)
+    
+    body = {
+        'message': 'EC2 auto-shutdown queued for workers',
+        'run_id': run_id,
+        'targets': labels,
+        'shards': len(messages)
+    }
+    if failed_targets:
+        body['failed_targets'] = failed_targets
+    return {'statusCode': 202, 'body': body}
+
+
+def list_target_instance_ids(target: Dict[str, str]) -> List[str]:
+    """
+    IDs of a target's running instances, from the inventory when it is current
+    A full discovery reconciles the inventory, as in process_region
+    """
+    region = target['region']
+    account_id = target.get('account_id')
+    with invocation_metrics.phase('discovery'):
+        instances = get_inventory_instances(region, account_id)
+        if instances is None:
+            ec2, _ = get_target_clients(target)
+            observed_at = datetime.now(timezone.utc).timestamp()
+            instances = list(get_running_instances(ec2))
+            if inventory_store:
+                reconcile_inventory(region, account_id, instances, observed_at)
+    return [instance.instance_id for instance in instances]
+
+
+def process_shard_messages(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    Worker mode: process the shards delivered in an SQS event
+    Returns an SQS partial batch response; shards that raised are retried by SQS
+    (the event source mapping needs ReportBatchItemFailures)
+    """
+    failures = []
+    for record in event['Records']:
+        try:
+            process_shard(json.loads(record['body']), context)
+        except Exception as e:
+            logger.error("Error processing shard message %s: %s", record.get('messageId'), e, exc_info=True)
+            failures.append({'itemIdentifier': record['messageId']})
+    return {'batchItemFailures': failures}
+
+
+def process_shard(message: Dict[str, Any], context: Any = None) -> None:
+    """
+    Evaluate and stop one shard of instances, save its partial report, and merge
+    the run's report if this was the last shard to report
+    """
+    if not checkpoint_store:
+        raise RuntimeError("WORK_QUEUE requires CHECKPOINT_STORE for the partial reports")
+    
+    run_id = message['run_id']
+    target = message['target']
+    label = target_label(target)
+    cursor = {'target': target, 'next_token': None, 'instance_ids': message['instance_ids']}
+    if report_sink:
+        # Named after the shard, so a retried shard replaces its part instead of adding one
+        cursor['report_part'] = (run_id, f"shard-{message['shard']:06d}")
+    result = run_targets([cursor], context)[label]
+    if isinstance(result, Exception):
+        raise result
+    if not result['complete']:
+        raise RuntimeError(f"Shard {message['shard']} of run {run_id} was not processed before the deadline")
+    
+    checkpoint_store.save(shard_checkpoint_id(run_id, message['shard']), {'target': label, 'result': result})
+    logger.info("Shard %s of run %s (%s): %s instances shut down", message['shard'], run_id, label, report_count(result, 'shutdown_results'))
+    
+    report = aggregate_run(run_id)
+    if report is not None:
+        logger.info("Run %s complete: %s instances shut down, %s skipped",
+                    run_id, report_count(report, 'shutdown_results'), report_count(report, 'skipped_instances'))
+
+
+def shard_checkpoint_id(run_id: str, shard: int) -> str:
+    """
+    Checkpoint store ID of a shard's partial report
+    """
+    return f"{run_id}.shard-{shard:06d}"
+
+
+def aggregate_run(run_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Merge the partial reports of a sharded run once every shard has saved one
+    The merged report is saved as '<run_id>.report'; workers that finish at the
+    same time may both merge, with the same result
+    Returns None while shards are missing
+    """
+    manifest = checkpoint_store.load(f"{run_id}.manifest")
+    if manifest is None:
+        raise RuntimeError(f"No sharded run {run_id} found")
+    if len(checkpoint_store.list_ids(f"{run_id}.shard-")) < manifest['shards']:
+        return None
+    
+    # Shards are merged in order, so the report lists targets as the coordinator did
+    report = new_report(manifest['targets'])
+    report['failed_targets'].update(manifest['failed_targets'])
+    if report_sink:
+        report['report_location'] = report_sink.location(run_id)
+    for shard in range(manifest['shards']):
+        partial = checkpoint_store.load(shard_checkpoint_id(run_id, shard))
+        if partial is None:
+            return None
+        merge_target_result(report, partial['result'])
+    
+    checkpoint_store.save(f"{run_id}.report", report)
+    return report
+
+
+def aggregate_response(run_id: str) -> Dict[str, Any]:
+    """
+    Handler response for {'aggregate_run_id': ...}: the merged report of a sharded
+    run in the usual response shape, or its progress while shards are missing
+    """
+    if not checkpoint_store:
+        raise RuntimeError("Aggregating a sharded run requires CHECKPOINT_STORE")
+    
+    report = checkpoint_store.load(f"{run_id}.report") or aggregate_run(run_id)
+    if report is None:
+        manifest = checkpoint_store.load(f"{run_id}.manifest")
+        return {
+            'statusCode': 202,
+            'body': {
+                'message': 'EC2 auto-shutdown shards still running',
+                'run_id': run_id,
+                'shards': manifest['shards'],
+                'shards_complete': len(checkpoint_store.list_ids(f"{run_id}.shard-"))
+            }
+        }
+    return report_response(report)
+
+
+def get_async_engine() -> Any:
+    """
+    Import the asyncio engine on first use
+    Returns None, after a warning, when aiobotocore is not available
+    """
+    global _async_engine, EXECUTION_ENGINE
+    if _async_engine is None:
+        try:
+            import async_engine
+            _async_engine = async_engine
+        except ImportError:
+            logger.warning("aiobotocore is not available, falling back to the thread pool engine")
+            EXECUTION_ENGINE = 'threads'
+    return _async_engine
+
+
+def create_client(session: Any, service_name: str, region_name: Optional[str] = None,
+                  account_id: Optional[str] = None) -> Any:
+    """
+    Create a client from a boto3 session (or the boto3 module for the default session)
+    with the shared CLIENT_CONFIG; every client in the function is built here
+    Requests are rate limited per account (the Lambda's own when account_id is None),
+    region and API operation, and counted in invocation_metrics
+    """
+    client = session.client(service_name, region_name=region_name, config=CLIENT_CONFIG)
+    invocation_metrics.attach(client)
+    if rate_limiter:
+        rate_limiter.attach(client, account_id or 'self')
+    return client
+
+
+def get_client(service_name: str, region_name: Optional[str] = None) -> Any:
+    """
+    Get a boto3 client from the default session, creating it on first use
+    Clients are cached per service and region for the lifetime of the container
+    """
+    key = (service_name, region_name)
+    # boto3 client creation on the default session is not thread-safe
+    with _client_cache_lock:
+        client = _client_cache.get(key)
+        if client is None:
+            client = _client_cache[key] = create_client(boto3, service_name, region_name)
+    return client
+
+
+def load_account_targets(config_path: str) -> List[Dict[str, str]]:
+    """
+    Read the (account, region) matrix from the OU accounts config
+    """
+    # Only hub mode reads the config, so PyYAML is imported here rather than at cold start
+    import yaml
+    
+    with open(config_path, 'r') as f:
+        config = yaml.safe_load(f)
+    
+    targets = []
+    for ou in config.get('organizational_units', []):
+        for account in ou.get('accounts', []):
+            for region in account.get('regions', []):
+                targets.append({
+                    'account_id': str(account['account_id']),
+                    'account_name': account.get('account_name', str(account['account_id'])),
+                    'role_name': account.get('role_name', 'EC2ShutdownRole'),
+                    'region': region
+                })
+    
+    logger.info("Loaded %s account/region targets from %s", len(targets), config_path)
+    return targets
+
+
+def target_label(target: Dict[str, str]) -> str:
+    """
+    Identify a target in the response: the region, prefixed by the account in hub mode
+    """
+    if target.get('account_id'):
+        return f"{target['account_id']}/{target['region']}"
+    return target['region']
+
+
+def get_account_session(account_id: str, role_name: str) -> boto3.session.Session:
+    """
+    Get a boto3 session for the shutdown role in an account
+    Assumed-role credentials are cached and reused until shortly before they expire
+    STS is called without the module lock held, so other accounts are not held up
+    """
+    role_arn = f"arn:aws:iam::{account_id}:role/{role_name}"
+    
+    with _session_cache_lock:
+        role_lock = _role_locks.setdefault(role_arn, threading.Lock())
+    
+    with role_lock:
+        # Another thread may have assumed the role while this one waited
+        with _session_cache_lock:
+            cached = _session_cache.get(role_arn)
+        if cached and cached[1] - timedelta(seconds=CREDENTIAL_REFRESH_MARGIN_SECONDS) > datetime.now(timezone.utc):
+            return cached[0]
+        
+        response = get_client('sts').assume_role(
+            RoleArn=role_arn,
+            RoleSessionName='ec2-auto-shutdown',
+            ExternalId=f"ec2-shutdown-{account_id}"
+        )
+        credentials = response['Credentials']
+        session = boto3.session.Session(
+            aws_access_key_id=credentials['AccessKeyId'],
+            aws_secret_access_key=credentials['SecretAccessKey'],
+            aws_session_token=credentials['SessionToken']
+        )
+        with _session_cache_lock:
+            _session_cache[role_arn] = (session, credentials['Expiration'])
+        logger.info("Assumed %s, credentials expire at %s", role_arn, credentials['Expiration'])
+        return session
+
+
+def get_target_clients(target: Dict[str, str]) -> Tuple[Any, Any]:
+    """
+    Get EC2 and CloudWatch clients for a target
+    The cached default clients are reused for the Lambda's own region; clients
+    for other targets are cached for the lifetime of the container too
+    """
+    region = target['region']
+    account_id = target.get('account_id')
+    
+    if not account_id and region == DEFAULT_REGION:
+        return get_client('ec2'), get_client('cloudwatch')
+    
+    session = get_account_session(account_id, target['role_name']) if account_id else None
+    key = (account_id, region)
+    with _target_client_cache_lock:
+        cached = _target_client_cache.get(key)
+    if cached and (session is None or cached[0] is session):
+        return cached[1], cached[2]
+    
+    if session is None:
+        # A separate session per region because the default session is not thread-safe
+        session = boto3.session.Session()
+    ec2 = create_client(session, 'ec2', region, account_id)
+    cloudwatch = create_client(session, 'cloudwatch', region, account_id)
+    with _target_client_cache_lock:
+        _target_client_cache[key] = (session, ec2, cloudwatch)
+    return ec2, cloudwatch
+
+
+def run_targets(cursors: List[Dict[str, Any]], context: Any = None) -> Dict[str, Any]:
+    """
+    Process targets concurrently in a bounded thread pool, each from its cursor
+    (or as coroutines with the asyncio engine)
+    Returns a dict of target label to its result, or to the exception that stopped it
+    """
+    engine = get_async_engine() if EXECUTION_ENGINE == 'asyncio' else None
+    if engine:
+        return engine.run_targets(cursors, context)
+    
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_REGION_WORKERS, len(cursors)))) as executor:
+        futures = {
+            executor.submit(process_target, cursor['target'], cursor['next_token'], context,
+                            cursor.get('instance_ids'), cursor.get('report_part')): target_label(cursor['target'])
+            for cursor in cursors
+        }
+        
+        for future in as_completed(futures):
+            label = futures[future]
+            try:
+                results[label] = future.result()
+            except Exception as e:
+                logger.error("Error processing %s: %s", label, e, exc_info=True)
+                results[label] = e
+    
+    return results
+
+
+def process_target(target: Dict[str, str], next_token: Optional[str] = None, context: Any = None,
+                   instance_ids: Optional[List[str]] = None,
+                   report_part: Optional[Tuple[str, str]] = None) -> Dict[str, Any]:
+    """
+    Process one target: a region, or an account and region in hub mode
+    With instance_ids, only those instances (a work queue shard) are processed
+    With a report sink, its records go to report_part, a (run ID, part name) pair;
+    the part is only published when the target completes without error
+    """
+    if deadline_reached(context):
+        return not_started_result(next_token)
+    
+    ec2, cloudwatch = get_target_clients(target)
+    report_writer = open_report_writer(report_part)
+    try:
+        result = process_region(target['region'], ec2, cloudwatch, target.get('account_id'), next_token, context,
+                                instance_ids, report_writer)
+    except Exception:
+        abort_report_writer(report_writer)
+        raise
+    if report_writer:
+        report_writer.close()
+    return result
+
+
+def open_report_writer(report_part: Optional[Tuple[str, str]]) -> Optional[ReportWriter]:
+    """
+    Start writing a target's part of the run report; None without a report sink
+    """
+    if not report_sink or not report_part:
+        return None
+    run_id, part = report_part
+    return report_sink.open(run_id, part)
+
+
+def abort_report_writer(report_writer: Optional[ReportWriter]) -> None:
+    """
+    Drop the report part of a target that failed, keeping the target's own error
+    """
+    if report_writer is None:
+        return
+    try:
+        report_writer.abort()
+    except Exception as e:
+        logger.error("Error aborting report part: %s", e)
+
+
+def not_started_result(next_token: Optional[str]) -> Dict[str, Any]:
+    """
+    Result for a target the deadline left no time to start
+    The cursor is kept as it is for the next invocation
+    """
+    return {
+        'instances_evaluated': 0,
+        'skipped_instances': [],
+        'active_instances': [],
+        'monitoring_enabled': [],
+        'shutdown_results': [],
+        'complete': False,
+        'next_token': next_token
+    }
+
+
+def process_region(region: str, ec2: Any, cloudwatch: Any, account_id: Optional[str] = None,
+                   starting_token: Optional[str] = None, context: Any = None,
+                   instance_ids: Optional[List[str]] = None,
+                   report_writer: Optional[ReportWriter] = None) -> Dict[str, Any]:
+    """
+    Discover, evaluate and shut down idle instances in one region
+    Result records are tagged with the region, and with the account in hub mode
+    With a report_writer they are written to it page by page instead of being
+    returned, and the result counts them
+    Discovery resumes from starting_token and stops after the page during which
+    the invocation deadline is reached; the result then carries the next token
+    With an inventory, instances come from it instead and shutdown candidates
+    are described again before they are stopped; a full discovery reconciles it
+    With instance_ids, only the running instances among them are described
+    """
+    observed_at = datetime.now(timezone.utc).timestamp()
+    inventory_instances = None
+    if instance_ids is not None:
+        pages = get_instance_id_pages(ec2, instance_ids)
+    else:
+        with invocation_metrics.phase('discovery'):
+            inventory_instances = None if starting_token else get_inventory_instances(region, account_id)
+        if inventory_instances is not None:
+            pages = [(inventory_instances, None)]
+        else:
+            pages = get_running_instance_pages(ec2, starting_token)
+    
+    # Every downstream stage reads instance details from this index
+    # instead of calling describe_instances again per instance
+    instance_index = {}
+    evaluation_candidates = []
+    monitoring_candidates = []
+    shutdown_candidates = []
+    active_instances = []
+    skipped_instances = []
+    
+    # Instances stream in page by page; candidates are evaluated in
+    # metric-batch-sized chunks without waiting for the whole fleet
+    next_token = None
+    scheduled_instances = []
+    for page_instances, next_token in invocation_metrics.timed_pages('discovery', pages):
+        with invocation_metrics.phase('evaluation'):
+            schedule = load_evaluation_schedule(page_instances)
+        for instance in page_instances:
+            instance_id = instance.instance_id
+            instance_index[instance_id] = instance
+            
+            # Check if instance should be evaluated for shutdown
+            skip_reason = should_skip_instance(instance)
+            if skip_reason:
+                skipped_instances.append(skipped_instance_record(instance, region, account_id, skip_reason))
+                continue
+            
+            # Instances that need detailed monitoring are enabled in bulk after discovery
+            if needs_detailed_monitoring(instance_id, instance_index):
+                monitoring_candidates.append(instance)
+                continue
+            
+            # Instances that cannot be idle yet are not queried until their next check
+            next_check = scheduled_check(instance, schedule)
+            if next_check:
+                scheduled_instances.append(scheduled_instance_record(instance, next_check))
+                continue
+            
+            evaluation_candidates.append(instance)
+            if len(evaluation_candidates) >= METRIC_DATA_MAX_QUERIES:
+                idle_instances, active = find_idle_instances(cloudwatch, evaluation_candidates, instance_index)
+                shutdown_candidates.extend(idle_instances)
+                active_instances.extend(active)
+                evaluation_candidates = []
+        
+        write_report_records(report_writer, region, account_id, [
+            ('skipped_instances', skipped_instances),
+            ('active_instances', active_instances),
+            ('active_instances', scheduled_instances)
+        ])
+            
+        if next_token and deadline_reached(context):
+            logger.warning("Invocation deadline reached, stopping discovery in %s", region)
+            break
+    
+    logger.info("Found %s running instances in %s", len(instance_index), region)
+    
+    if inventory_store and inventory_instances is None and instance_ids is None and not starting_token and not next_token:
+        with invocation_metrics.phase('discovery'):
+            reconcile_inventory(region, account_id, list(instance_index.values()), observed_at)
+    
+    # Instances switched to detailed monitoring are evaluated on the next
+    # invocation instead of blocking this one while new metrics arrive
+    with invocation_metrics.phase('monitoring'):
+        monitoring_enabled = enable_detailed_monitoring(ec2, [instance.instance_id for instance in monitoring_candidates])
+        update_inventory_monitoring(region, account_id, monitoring_enabled)
+    deferred_ids = set(monitoring_enabled)
+    evaluation_candidates.extend(
+        instance for instance in monitoring_candidates if instance.instance_id not in deferred_ids
+    )
+    
+    idle_instances, active = find_idle_instances(cloudwatch, evaluation_candidates, instance_index)
+    shutdown_candidates.extend(idle_instances)
+    active_instances.extend(active)
+    active_instances.extend(scheduled_instances)
+    
+    with invocation_metrics.phase('shutdown'):
+        if inventory_instances is not None:
+            shutdown_candidates, stale = verify_shutdown_candidates(ec2, shutdown_candidates, region, account_id)
+            skipped_instances.extend(stale)
+        
+        # Perform shutdowns
+        shutdown_results = shutdown_instances(ec2, shutdown_candidates)
+    
+    return region_result(region, account_id, instance_index, skipped_instances, active_instances,
+                         monitoring_enabled, shutdown_results, next_token, report_writer)
+
+
+def skipped_instance_record(instance: InstanceRecord, region: str, account_id: Optional[str],
+                            skip_reason: str) -> Dict[str, Any]:
+    """
+    Build the report record for an instance that is not evaluated
+    """
+    skipped_record = {
+        'instance_id': instance.instance_id,
+        'instance_type': instance.instance_type,
+        'region': region,
+        'reason': skip_reason
+    }
+    if account_id:
+        skipped_record['account_id'] = account_id
+    decision_log.info(instance.instance_id, "Skipping %s (%s): %s", instance.instance_id, instance.instance_type, skip_reason,
+                      outcome='skipped')
+    return skipped_record
+
+
+def load_evaluation_schedule(instances: List[InstanceRecord]) -> Dict[str, Dict[str, Any]]:
+    """
+    Read the stored next checks of a page of instances
+    Empty without a schedule store, or when it cannot be read, so every instance is due
+    """
+    if not schedule_store or not instances:
+        return {}
+    
+    try:
+        return schedule_store.get_many([instance.instance_id for instance in instances])
+    except Exception as e:
+        logger.error("Error reading the evaluation schedule for %s instances: %s", len(instances), e)
+        return {}
+
+
+def scheduled_check(instance: InstanceRecord, schedule: Dict[str, Dict[str, Any]]) -> Optional[float]:
+    """
+    Time (epoch seconds) of an instance's next check when it is still in the future
+    That is the end of the launch buffer is_instance_idle requires, or the stored
+    next check when later and the instance has not been restarted since
+    Returns None when the instance is due, always without a schedule store
+    """
+    if not schedule_store or not instance.launch_time:
+        return None
+    
+    launch_epoch = instance.launch_time.timestamp()
+    next_check = launch_epoch + (IDLE_DURATION_HOURS + 0.5) * 3600
+    record = schedule.get(instance.instance_id)
+    if record and record.get('launch_time') == launch_epoch and record.get('next_check'):
+        next_check = max(next_check, record['next_check'])
+    
+    return next_check if next_check > datetime.now(timezone.utc).timestamp() else None
+
+
+def next_eligible_check(instance: InstanceRecord, datapoints: List[Dict[str, Any]],
+                        summary: Optional[Dict[str, float]] = None) -> Optional[float]:
+    """
+    Earliest time (epoch seconds) an active instance could be found idle, if in the future
+    Its idle window must be past the launch buffer and no longer hold the most recent
+    CPU datapoint above the threshold, from the datapoints or the summary's last_busy;
+    one more period covers windows aligned to five minutes
+    Activity on other signals has no timestamp, so it does not delay the next check
+    """
+    if not schedule_store or not instance.launch_time:
+        return None
+    
+    next_check = instance.launch_time.timestamp() + (IDLE_DURATION_HOURS + 0.5) * 3600
+    busy = [dp['Timestamp'].timestamp() for dp in datapoints if dp['Average'] > CPU_THRESHOLD]
+    if summary and summary.get('last_busy'):
+        busy.append(summary['last_busy'])
+    if busy:
+        next_check = max(next_check, max(busy) + IDLE_DURATION_HOURS * 3600 + 300)
+    
+    return next_check if next_check > datetime.now(timezone.utc).timestamp() else None
+
+
+def scheduled_instance_record(instance: InstanceRecord, next_check: float) -> Dict[str, Any]:
+    """
+    Build the active record of an instance that is not queried before its next check
+    """
+    next_check = format_epoch(next_check)
+    decision_log.info(instance.instance_id, "Instance %s (%s) cannot be idle before %s, not queried", instance.instance_id,
+                      instance.instance_type, next_check, outcome='scheduled')
+    return {
+        'instance_id': instance.instance_id,
+        'instance_type': instance.instance_type,
+        'signal': 'CPUUtilization',
+        'next_check': next_check
+    }
+
+
+def format_epoch(timestamp: float) -> str:
+    """
+    Format epoch seconds as an ISO 8601 UTC timestamp for the report
+    """
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def region_result(region: str, account_id: Optional[str], instance_index: Dict[str, InstanceRecord],
+                  skipped_instances: List[Dict[str, Any]], active_instances: List[Dict[str, Any]],
+                  monitoring_enabled: List[str], shutdown_results: List[Dict[str, Any]],
+                  next_token: Optional[str], report_writer: Optional[ReportWriter] = None) -> Dict[str, Any]:
+    """
+    Build a target's result, tagging active and shutdown records with the region and account
+    With a report_writer, the remaining records are written to it and the result
+    holds empty lists and the record_counts of the part
+    """
+    for result in active_instances + shutdown_results:
+        result['region'] = region
+        if account_id:
+            result['account_id'] = account_id
+    
+    write_report_records(report_writer, region, account_id, [
+        ('skipped_instances', skipped_instances),
+        ('active_instances', active_instances),
+        ('monitoring_enabled', monitoring_enabled),
+        ('shutdown_results', shutdown_results)
+    ])
+    result = {
+        'instances_evaluated': len(instance_index),
+        'skipped_instances': skipped_instances,
+        'active_instances': active_instances,
+        'monitoring_enabled': monitoring_enabled,
+        'shutdown_results': shutdown_results,
+        'complete': next_token is None,
+        'next_token': next_token
+    }
+    if report_writer:
+        result['record_counts'] = dict(report_writer.counts)
+    return result
+
+
+def write_report_records(report_writer: Optional[ReportWriter], region: str, account_id: Optional[str],
+                         records: List[Tuple[str, List[Any]]]) -> None:
+    """
+    Write (kind, records) lists to a target's report part, tagged with the region
+    and account, and empty them; does nothing without a report_writer
+    Deferred instances are listed by ID in the response and become records here
+    """
+    if report_writer is None:
+        return
+    for kind, kind_records in records:
+        if not kind_records:
+            continue
+        tagged = []
+        for record in kind_records:
+            record = {'instance_id': record} if isinstance(record, str) else record
+            record['region'] = region
+            if account_id:
+                record['account_id'] = account_id
+            tagged.append(record)
+        report_writer.write(kind, tagged)
+        kind_records.clear()
+
+
+def inventory_record(instance: InstanceRecord, updated_at: float) -> Dict[str, Any]:
+    """
+    Inventory record of a running instance, observed at updated_at (epoch seconds)
+    """
+    return {
+        'instance_id': instance.instance_id,
+        'state': 'running',
+        'updated_at': updated_at,
+        'instance_type': instance.instance_type,
+        'launch_time': instance.launch_time.timestamp() if instance.launch_time else None,
+        'monitoring_state': instance.monitoring_state,
+        'tags': instance.tags
+    }
+
+
+def get_inventory_instances(region: str, account_id: Optional[str] = None) -> Optional[List[InstanceRecord]]:
+    """
+    Running instances of a target according to the inventory
+    Returns None when the target should be discovered with DescribeInstances:
+    without an inventory, or when its last full reconciliation is too old
+    """
+    if not inventory_store:
+        return None
+    
+    target = target_label({'region': region, 'account_id': account_id})
+    try:
+        reconciled_at = inventory_store.reconciled_at(target)
+        age_hours = (datetime.now(timezone.utc).timestamp() - reconciled_at) / 3600 if reconciled_at else None
+        if age_hours is None or age_hours > INVENTORY_RECONCILE_HOURS:
+            logger.info("Inventory for %s is due for reconciliation, describing all running instances", target)
+            return None
+        records = inventory_store.running(target)
+    except Exception as e:
+        logger.error("Error reading inventory for %s, describing all running instances: %s", target, e)
+        return None
+    
+    logger.info("Inventory lists %s running instances in %s, reconciled %.1f hours ago", len(records), target, age_hours)
+    return [
+        InstanceRecord(
+            record['instance_id'],
+            record['instance_type'] or '',
+            datetime.fromtimestamp(record['launch_time'], timezone.utc) if record['launch_time'] is not None else None,
+            record['monitoring_state'] or 'disabled',
+            record['tags']
+        )
+        for record in records
+    ]
+
+
+def reconcile_inventory(region: str, account_id: Optional[str], instances: List[InstanceRecord],
+                        observed_at: float) -> None:
+    """
+    Correct a target's inventory from a complete DescribeInstances discovery started at observed_at
+    """
+    target = target_label({'region': region, 'account_id': account_id})
+    try:
+        writes = inventory_store.reconcile(target, [inventory_record(instance, observed_at) for instance in instances], observed_at)
+        logger.info("Reconciled inventory for %s: %s running instances, %s records updated", target, len(instances), writes)
+    except Exception as e:
+        # The target stays due for reconciliation and is discovered in full again next run
+        logger.error("Error reconciling inventory for %s: %s", target, e)
+
+
+def update_inventory_monitoring(region: str, account_id: Optional[str], instance_ids: List[str]) -> None:
+    """
+    Record in the inventory that detailed monitoring was switched on, so the
+    instances are evaluated rather than enabled again on the next run
+    """
+    if not inventory_store or not instance_ids:
+        return
+    
+    target = target_label({'region': region, 'account_id': account_id})
+    try:
+        inventory_store.set_monitoring_state(target, instance_ids, 'pending')
+    except Exception as e:
+        logger.error("Error updating monitoring state of %s instances in the inventory: %s", len(instance_ids), e)
+
+
+def describe_instance_ids_requests(instance_ids: List[str]) -> List[Dict[str, Any]]:
+    """
+    DescribeInstances arguments for the running instances among instance_ids
+    A filter rather than InstanceIds, so IDs that no longer exist are not an error
+    """
+    return [
+        {
+            'Filters': [
+                {'Name': 'instance-id', 'Values': instance_ids[batch_start:batch_start + DESCRIBE_INSTANCE_IDS_BATCH_SIZE]},
+                {'Name': 'instance-state-name', 'Values': ['running']}
+            ]
+        }
+        for batch_start in range(0, len(instance_ids), DESCRIBE_INSTANCE_IDS_BATCH_SIZE)
+    ]
+
+
+def verify_shutdown_candidates(ec2: Any, candidates: List[InstanceRecord], region: str,
+                               account_id: Optional[str]) -> Tuple[List[InstanceRecord], List[Dict[str, Any]]]:
+    """
+    Describe inventory shutdown candidates again before stopping them
+    Returns the candidates that are still running and not excluded (with fresh
+    details), and skip records for the rest
+    """
+    described = []
+    for request in describe_instance_ids_requests([instance.instance_id for instance in candidates]):
+        paginator = ec2.get_paginator('describe_instances')
+        for page in paginator.paginate(**request):
+            described.extend(page_instances(page))
+    return verified_shutdown_candidates(candidates, described, region, account_id)
+
+
+def verified_shutdown_candidates(candidates: List[InstanceRecord], described: List[InstanceRecord], region: str,
+                                 account_id: Optional[str]) -> Tuple[List[InstanceRecord], List[Dict[str, Any]]]:
+    """
+    Split inventory shutdown candidates by what DescribeInstances reports for them now
+    Tags can change without a state-change event, so exclusions are checked again
+    """
+    current = {instance.instance_id: instance for instance in described}
+    verified = []
+    skipped = []
+    for candidate in candidates:
+        instance = current.get(candidate.instance_id)
+        if instance is None:
+            skipped.append(skipped_instance_record(candidate, region, account_id, 'Instance is no longer running'))
+            continue
+        skip_reason = should_skip_instance(instance)
+        if skip_reason:
+            skipped.append(skipped_instance_record(instance, region, account_id, skip_reason))
+            continue
+        verified.append(instance)
+    return verified, skipped
+
+
+def get_running_instances(ec2: Any, starting_token: Optional[str] = None) -> Iterator[InstanceRecord]:
+    """
+    Yield running EC2 instances page by page as DescribeInstances returns them
+    """
+    for page_instances, _ in get_running_instance_pages(ec2, starting_token):
+        yield from page_instances
+
+
+def get_instance_id_pages(ec2: Any, instance_ids: List[str]) -> Iterator[Tuple[List[InstanceRecord], Optional[str]]]:
+    """
+    Yield the running instances among instance_ids, a page per DescribeInstances response
+    """
+    for request in describe_instance_ids_requests(instance_ids):
+        paginator = ec2.get_paginator('describe_instances')
+        for page in paginator.paginate(**request):
+            yield page_instances(page), None
+
+
+def get_running_instance_pages(ec2: Any, starting_token: Optional[str] = None) -> Iterator[Tuple[List[InstanceRecord], Optional[str]]]:
+    """
+    Yield (instances, next token) for each DescribeInstances page of running instances
+    The next token resumes discovery after that page; it is None on the last page
+    """
+    try:
+        paginator = ec2.get_paginator('describe_instances')
+        pages = paginator.paginate(**describe_instances_request(starting_token))
+        
+        for page in pages:
+            yield page_instances(page), page.get('NextToken')
+        
+    except Exception as e:
+        logger.error("Error getting running instances: %s", e)
+        raise
+
+
+def describe_instances_request(starting_token: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Paginate arguments for DescribeInstances of running instances
+    The Shutdown=No exclusion cannot be expressed as a DescribeInstances filter
+    (filters only match, never negate), so it stays in should_skip_instance
+    """
+    filters = [
+        {
+            'Name': 'instance-state-name',
+            'Values': ['running']
+        }
+    ]
+    
+    if SERVER_SIDE_TYPE_FILTER:
+        # Match every instance type that does not start with an excluded prefix;
+        # multi-letter prefixes are still caught by should_skip_instance
+        filters.append({
+            'Name': 'instance-type',
+            'Values': [
+                f"{letter}*" for letter in 'abcdefghijklmnopqrstuvwxyz'
+                if letter not in EXCLUDED_INSTANCE_TYPES
+            ]
+        })
+    
+    pagination_config = {'PageSize': DESCRIBE_INSTANCES_PAGE_SIZE}
+    if starting_token:
+        pagination_config['StartingToken'] = starting_token
+    return {'Filters': filters, 'PaginationConfig': pagination_config}
+
+
+def page_instances(page: Dict[str, Any]) -> List[InstanceRecord]:
+    """
+    Flatten the reservations of a DescribeInstances page into compact instance records
+    """
+    return [
+        InstanceRecord.from_describe(instance)
+        for reservation in page['Reservations']
+        for instance in reservation['Instances']
+    ]
+
+
+def should_skip_instance(instance: InstanceRecord) -> Optional[str]:
+    """
+    Check if an instance should be skipped for shutdown
+    Returns skip reason or None if instance should be evaluated
+    """
+    instance_type = instance.instance_type
+    instance_id = instance.instance_id
+    
+    # Check if instance type is excluded (P or G types)
+    for excluded_type in EXCLUDED_INSTANCE_TYPES:
+        if instance_type.lower().startswith(excluded_type):
+            return f"Instance type {instance_type} is excluded (P/G type)"
+    
+    # Check shutdown tag
+    shutdown_tag = instance.tags.get('Shutdown', '').lower()
+    
+    if shutdown_tag == 'no':
+        return "Instance has 'Shutdown=No' tag"
+    
+    return None
+
+
+def find_idle_instances(cloudwatch: Any, candidates: List[InstanceRecord],
+                        instance_index: Dict[str, InstanceRecord]) -> Tuple[List[InstanceRecord], List[Dict[str, Any]]]:
+    """
+    Evaluate a chunk of candidate instances
+    Returns the idle instances, and a record per active instance naming the signal that kept it running
+    CPU and idle-signal metrics for the whole chunk are fetched in batched GetMetricData calls
+    With a state store, only datapoints since the last evaluation are fetched
+    and each instance's idle streak is updated incrementally; otherwise the
+    metric_math engine fetches one summary per instance instead of its datapoints
+    """
+    if not candidates:
+        return [], []
+    
+    instance_ids = [instance.instance_id for instance in candidates]
+    if EVALUATION_ENGINE == 'metric_math' and not idle_state_store:
+        with invocation_metrics.phase('metrics'):
+            summaries, signal_peaks = get_metric_summaries(cloudwatch, instance_ids)
+        with invocation_metrics.phase('evaluation'):
+            return decide_idle_instances(candidates, {}, instance_index, {}, signal_peaks, summaries)
+    
+    with invocation_metrics.phase('evaluation'):
+        states, since = load_idle_states(instance_ids)
+    with invocation_metrics.phase('metrics'):
+        cpu_metrics, signal_peaks = get_instance_metrics(cloudwatch, instance_ids, since)
+    with invocation_metrics.phase('evaluation'):
+        return decide_idle_instances(candidates, cpu_metrics, instance_index, states, signal_peaks)
+
+
+def load_idle_states(instance_ids: List[str]) -> Tuple[Dict[str, Dict[str, Any]], Optional[Dict[str, datetime]]]:
+    """
+    Read stored idle streaks for a chunk of instances
+    Returns the states and, per instance, the time (naive UTC) to fetch datapoints after;
+    without a state store both are empty and the whole idle window is fetched
+    """
+    if not idle_state_store:
+        return {}, None
+    
+    states = {}
+    try:
+        states = idle_state_store.get_many(instance_ids)
+    except Exception as e:
+        logger.error("Error reading idle state for %s instances: %s", len(instance_ids), e)
+    since = {
+        instance_id: datetime.fromtimestamp(state['last_timestamp'], timezone.utc).replace(tzinfo=None)
+        for instance_id, state in states.items()
+        if state.get('last_timestamp') is not None
+    }
+    return states, since
+
+
+def decide_idle_instances(candidates: List[InstanceRecord], cpu_metrics: Dict[str, Any],
+                          instance_index: Dict[str, InstanceRecord], states: Dict[str, Dict[str, Any]],
+                          signal_peaks: Dict[str, Dict[str, float]],
+                          summaries: Optional[Dict[str, Dict[str, float]]] = None) -> Tuple[List[InstanceRecord], List[Dict[str, Any]]]:
+    """
+    Decide which candidates are idle from their fetched CPU datapoints and signal peaks,
+    or from their metric math summaries when given
+    An instance is idle only if its CPU is idle and no other signal is above its threshold
+    Saves the updated idle streaks when a state store is configured, and the
+    next check of each active instance when a schedule store is
+    """
+    instance_ids = [instance.instance_id for instance in candidates]
+    matrix_outcomes = {}
+    if idle_matrix and not idle_state_store:
+        matrix_outcomes = idle_matrix.evaluate_outcome_matrix(
+            instance_ids, cpu_metrics, instance_index, CPU_THRESHOLD,
+            IDLE_DURATION_HOURS, METRIC_GAP_SECONDS, MAX_TOTAL_GAP_SECONDS
+        )
+    
+    idle_instances = []
+    active_instances = []
+    updated_states = []
+    schedule_records = []
+    for instance in candidates:
+        instance_id = instance.instance_id
+        instance_type = instance.instance_type
+        signal = active_signal(signal_peaks.get(instance_id, {}))
+        
+        # Check CPU utilization; is_instance_idle and its variants record why CPU
+        # keeps an instance running, the vectorized engine returns the reason instead
+        cpu_outcome = None
+        if idle_state_store:
+            idle, state = is_streak_idle(instance_id, cpu_metrics.get(instance_id, []), instance_index,
+                                         states.get(instance_id), active_signal=signal is not None)
+            if state:
+                updated_states.append(state)
+        elif signal:
+            idle = False
+        elif summaries is not None:
+            idle = is_summary_idle(instance_id, summaries.get(instance_id, {}), instance_index)
+        elif instance_id in matrix_outcomes:
+            idle = matrix_outcomes[instance_id] == 'idle'
+            cpu_outcome = matrix_outcomes[instance_id]
+        else:
+            idle = is_instance_idle(instance_id, cpu_metrics.get(instance_id, []), instance_index)
+        
+        if idle and not signal:
+            idle_instances.append(instance)
+            decision_log.info(instance_id, "Instance %s (%s) is idle and will be shut down", instance_id, instance_type,
+                              outcome='idle')
+            continue
+        
+        if signal:
+            metric_name, peak = signal
+            decision_log.info(instance_id, "Instance %s (%s) is active on %s (%g > %g per 5 minutes), keeping running",
+                              instance_id, instance_type, metric_name, peak, IDLE_SIGNAL_THRESHOLDS[metric_name],
+                              outcome='active_signal')
+        else:
+            metric_name = 'CPUUtilization'
+            if cpu_outcome:
+                decision_log.info(instance_id, "Instance %s (%s) is not idle (%s), keeping running", instance_id, instance_type,
+                                  cpu_outcome, outcome=cpu_outcome)
+            else:
+                decision_log.info(instance_id, "Instance %s (%s) is not idle, keeping running", instance_id, instance_type)
+        active_record = {
+            'instance_id': instance_id,
+            'instance_type': instance_type,
+            'signal': metric_name
+        }
+        
+        next_check = next_eligible_check(instance, cpu_metrics.get(instance_id, []), (summaries or {}).get(instance_id))
+        if next_check:
+            active_record['next_check'] = format_epoch(next_check)
+            schedule_records.append({
+                'instance_id': instance_id,
+                'launch_time': instance.launch_time.timestamp(),
+                'next_check': next_check
+            })
+        active_instances.append(active_record)
+    
+    if updated_states:
+        try:
+            idle_state_store.put_many(updated_states)
+        except Exception as e:
+            logger.error("Error saving idle state for %s instances: %s", len(updated_states), e)
+    
+    if schedule_records:
+        try:
+            schedule_store.put_many(schedule_records)
+        except Exception as e:
+            logger.error("Error saving the evaluation schedule for %s instances: %s", len(schedule_records), e)
+    
+    return idle_instances, active_instances
+
+
+def needs_detailed_monitoring(instance_id: str, instance_index: Dict[str, InstanceRecord]) -> bool:
+    """
+    Check if detailed monitoring should be enabled for an instance
+    Reads the current monitoring state from the run's instance index
+    Returns True only if configured and monitoring is currently disabled
+    """
+    if not ENABLE_DETAILED_MONITORING:
+        return False
+    
+    instance = instance_index.get(instance_id)
+    if instance is None:
+        logger.warning("Instance %s not found in instance index", instance_id)
+        return False
+    
+    # Check current monitoring status
+    monitoring_state = instance.monitoring_state
+    
+    if monitoring_state == 'disabled':
+        return True
+    elif monitoring_state == 'enabled':
+        decision_log.debug(instance_id, "Instance %s already has detailed monitoring enabled", instance_id)
+    elif monitoring_state == 'pending':
+        decision_log.info(instance_id, "Instance %s monitoring state is pending", instance_id)
+    
+    return False
+
 
-# Initialize AWS clients
-ec2_client = boto3.client('ec2')
-cloudwatch_client = boto3.client('cloudwatch')
+def enable_detailed_monitoring(ec2: Any, instance_ids: List[str]) -> List[str]:
+    """
+    Enable detailed monitoring for many instances with a single MonitorInstances call
+    Returns the IDs whose monitoring was switched on; their evaluation is deferred
+    to the next run, when the instance index reports the new monitoring state
+    """
+    if not instance_ids:
+        return []
+    
+    logger.info("Enabling detailed monitoring for %s instances", len(instance_ids))
+    
+    if DRY_RUN:
+        # Nothing changes in dry run, so these instances are evaluated now
+        logger.info("DRY_RUN: Would enable detailed monitoring for %s instances", len(instance_ids))
+        return []
+    
+    try:
+        return monitored_instance_ids(ec2.monitor_instances(InstanceIds=instance_ids))
+        
+    except Exception as e:
+        # Instances whose monitoring could not be enabled are evaluated on basic metrics
+        logger.error("Error enabling detailed monitoring for %s instances: %s", len(instance_ids), e)
+        return []
 
-# Configuration
-CPU_THRESHOLD = 1.0  # CPU utilization percentage threshold
-IDLE_DURATION_HOURS = 3  # Hours of idle time before shutdown
-DRY_RUN = os.environ.get('DRY_RUN', 'false').lower() == 'true'
-ENABLE_DETAILED_MONITORING = os.environ.get('ENABLE_DETAILED_MONITORING', 'false').lower() == 'true'
 
-# Instance types to exclude (P and G types for GPU/ML workloads)
-EXCLUDED_INSTANCE_TYPES = ['p', 'g']
+def monitored_instance_ids(monitor_response: Dict[str, Any]) -> List[str]:
+    """
+    Log and return the instances a MonitorInstances response switched on
+    """
+    enabled = []
+    for monitor_info in monitor_response.get('InstanceMonitorings', []):
+        instance_id = monitor_info['InstanceId']
+        new_state = monitor_info.get('Monitoring', {}).get('State', 'unknown')
+        decision_log.info(instance_id, "Instance %s monitoring state changed to: %s", instance_id, new_state,
+                          outcome='monitoring_enabled')
+        enabled.append(instance_id)
+    return enabled
 
 
-def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+def get_instance_metrics(cloudwatch: Any, instance_ids: List[str],
+                         since: Optional[Dict[str, datetime]] = None,
+                         signals: Optional[Dict[str, float]] = None) -> Tuple[Dict[str, List[Dict[str, Any]]], Dict[str, Dict[str, float]]]:
     """
-    Main Lambda handler for EC2 auto-shutdown
+    Fetch CPUUtilization datapoints and the idle signals for many instances with
+    batched GetMetricData calls; every metric of an instance is in the same request
+    Returns a dict of instance ID to CPU datapoints shaped like GetMetricStatistics
+    output, and a dict of instance ID to the peak five-minute value of each signal
+    Instances listed in since (naive UTC) only get datapoints after that time,
+    never reaching further back than the idle window
     """
-    logger.info("Starting EC2 auto-shutdown process")
+    cpu_metrics = new_cpu_metrics(instance_ids)
+    signal_peaks = {instance_id: {} for instance_id in instance_ids}
     
-    try:
-        # Get all running EC2 instances
-        instances = get_running_instances()
-        logger.info(f"Found {len(instances)} running instances")
-        
-        shutdown_candidates = []
-        skipped_instances = []
-        
-        for instance in instances:
-            instance_id = instance['InstanceId']
-            instance_type = instance['InstanceType']
-            
-            # Check if instance should be evaluated for shutdown
-            skip_reason = should_skip_instance(instance)
-            if skip_reason:
-                skipped_instances.append({
-                    'instance_id': instance_id,
-                    'instance_type': instance_type,
-                    'reason': skip_reason
-                })
-                logger.info(f"Skipping {instance_id} ({instance_type}): {skip_reason}")
-                continue
-            
-            # Enable detailed monitoring if needed and configured
-            monitoring_enabled = enable_detailed_monitoring_if_needed(instance_id)
-            if monitoring_enabled:
-                logger.info(f"Enabled detailed monitoring for {instance_id}, waiting 60 seconds for metrics")
-                time.sleep(60)  # Wait for new metrics to be available
-            
-            # Check CPU utilization
-            if is_instance_idle(instance_id):
-                shutdown_candidates.append(instance)
-                logger.info(f"Instance {instance_id} ({instance_type}) is idle and will be shut down")
-            else:
-                logger.info(f"Instance {instance_id} ({instance_type}) is active, keeping running")
+    for query_ids, request in metric_data_requests(instance_ids, since, signals):
+        try:
+            while True:
+                response = cloudwatch.get_metric_data(**request)
+                add_metric_results(cpu_metrics, signal_peaks, query_ids, response, since)
+                
+                next_token = response.get('NextToken')
+                if not next_token:
+                    break
+                request['NextToken'] = next_token
+                
+        except Exception as e:
+            # Instances without metrics are treated as not idle by is_instance_idle
+            logger.error("Error fetching metrics for %s queries: %s", len(query_ids), e)
+    
+    return cpu_metrics, signal_peaks
+
+
+def new_cpu_metrics(instance_ids: List[str]) -> Dict[str, Any]:
+    """
+    An empty CPU series per instance for add_metric_results: a CPUSeries when
+    the vectorized engine evaluates the chunk, which reads the result lists as
+    arrays, and a list of datapoints otherwise
+    """
+    if idle_matrix and not idle_state_store:
+        return {instance_id: idle_matrix.CPUSeries() for instance_id in instance_ids}
+    return {instance_id: [] for instance_id in instance_ids}
+
+
+def metric_data_requests(instance_ids: List[str], since: Optional[Dict[str, datetime]] = None,
+                         signals: Optional[Dict[str, float]] = None) -> List[Tuple[Dict[str, Tuple[str, str]], Dict[str, Any]]]:
+    """
+    Build the GetMetricData requests for CPUUtilization and the idle signals of many instances
+    Returns (query ID to (instance ID, metric name), request arguments) per request,
+    each with at most METRIC_DATA_MAX_QUERIES queries and all metrics of an instance
+    """
+    if not instance_ids:
+        return []
+    
+    signals = IDLE_SIGNAL_THRESHOLDS if signals is None else signals
+    metric_names = ['CPUUtilization'] + list(signals)
+    instances_per_request = max(1, METRIC_DATA_MAX_QUERIES // len(metric_names))
+    
+    window_start, end_time = idle_window()
+    
+    # Instances with similar start times share a request
+    start_times = {
+        instance_id: max(window_start, (since or {}).get(instance_id, window_start))
+        for instance_id in instance_ids
+    }
+    instance_ids = sorted(instance_ids, key=lambda instance_id: start_times[instance_id])
+    
+    requests = []
+    for batch_start in range(0, len(instance_ids), instances_per_request):
+        batch = instance_ids[batch_start:batch_start + instances_per_request]
+        start_time = start_times[batch[0]]
         
-        # Perform shutdowns
-        shutdown_results = []
-        if shutdown_candidates:
-            for instance in shutdown_candidates:
-                result = shutdown_instance(instance)
-                shutdown_results.append(result)
-        
-        # Prepare response
-        response = {
-            'statusCode': 200,
-            'body': {
-                'message': 'EC2 auto-shutdown completed successfully',
-                'total_instances_evaluated': len(instances),
-                'instances_skipped': len(skipped_instances),
-                'instances_shutdown': len(shutdown_results),
-                'dry_run': DRY_RUN,
-                'skipped_instances': skipped_instances,
-                'shutdown_results': shutdown_results
-            }
+        # Query IDs must start with a lowercase letter, so map them back by position
+        query_ids = {
+            f"m{index}_{metric_index}": (instance_id, metric_name)
+            for index, instance_id in enumerate(batch)
+            for metric_index, metric_name in enumerate(metric_names)
         }
+        queries = [
+            metric_stat_query(query_id, instance_id, metric_name)
+            for query_id, (instance_id, metric_name) in query_ids.items()
+        ]
         
-        logger.info(f"Process completed: {len(shutdown_results)} instances shut down, {len(skipped_instances)} skipped")
-        return response
-        
-    except Exception as e:
-        logger.error(f"Error in EC2 auto-shutdown: {str(e)}", exc_info=True)
-        return {
-            'statusCode': 500,
-            'body': {
-                'error': str(e),
-                'message': 'EC2 auto-shutdown failed'
-            }
-        }
+        requests.append((query_ids, {
+            'MetricDataQueries': queries,
+            'StartTime': start_time,
+            'EndTime': end_time,
+            'ScanBy': 'TimestampAscending'
+        }))
+    
+    return requests
 
 
-def get_running_instances() -> List[Dict[str, Any]]:
+def idle_window() -> Tuple[datetime, datetime]:
     """
-    Get all running EC2 instances
+    Start and end (naive UTC) of the idle window both evaluation engines query
+    Whole 5-minute periods up to the last period boundary, so the datapoints and
+    the metric math summaries cover the same periods and no partial one at either end
     """
-    try:
-        response = ec2_client.describe_instances(
-            Filters=[
-                {
-                    'Name': 'instance-state-name',
-                    'Values': ['running']
-                }
-            ]
-        )
-        
-        instances = []
-        for reservation in response['Reservations']:
-            for instance in reservation['Instances']:
-                instances.append(instance)
-        
-        return instances
+    end_time = datetime.utcnow().replace(second=0, microsecond=0)
+    end_time -= timedelta(minutes=end_time.minute % 5)
+    return end_time - timedelta(hours=IDLE_DURATION_HOURS), end_time
+
+
+def metric_stat_query(query_id: str, instance_id: str, metric_name: str, period: int = 300,
+                      stat: Optional[str] = None, return_data: bool = True) -> Dict[str, Any]:
+    """
+    Build the GetMetricData query for one AWS/EC2 metric of an instance, in 5-minute periods by default
+    """
+    return {
+        'Id': query_id,
+        'MetricStat': {
+            'Metric': {
+                'Namespace': 'AWS/EC2',
+                'MetricName': metric_name,
+                'Dimensions': [
+                    {
+                        'Name': 'InstanceId',
+                        'Value': instance_id
+                    }
+                ]
+            },
+            'Period': period,
+            # CPU is a percentage; the signals are counters totalled per period
+            'Stat': stat or ('Average' if metric_name == 'CPUUtilization' else 'Sum')
+        },
+        'ReturnData': return_data
+    }
+
+
+def add_metric_results(cpu_metrics: Dict[str, List[Dict[str, Any]]], signal_peaks: Dict[str, Dict[str, float]],
+                       query_ids: Dict[str, Tuple[str, str]], response: Dict[str, Any],
+                       since: Optional[Dict[str, datetime]] = None) -> None:
+    """
+    Add the datapoints of one GetMetricData response: CPU datapoints are appended
+    to each instance's series, other signals only raise the instance's peak value
+    A CPUSeries takes the result's lists as they are (since is never set with it)
+    """
+    for result in response.get('MetricDataResults', []):
+        query = query_ids.get(result['Id'])
+        if query is None:
+            continue
+        instance_id, metric_name = query
         
-    except Exception as e:
-        logger.error(f"Error getting running instances: {str(e)}")
-        raise
+        if metric_name == 'CPUUtilization' and not isinstance(cpu_metrics[instance_id], list):
+            cpu_metrics[instance_id].extend(result.get('Timestamps', []), result.get('Values', []))
+            continue
+        after = since.get(instance_id) if since else None
+        for timestamp, value in zip(result.get('Timestamps', []), result.get('Values', [])):
+            if after is not None and timestamp.replace(tzinfo=None) <= after:
+                continue
+            if metric_name == 'CPUUtilization':
+                cpu_metrics[instance_id].append({'Timestamp': timestamp, 'Average': value})
+            elif value > signal_peaks[instance_id].get(metric_name, float('-inf')):
+                signal_peaks[instance_id][metric_name] = value
 
 
-def should_skip_instance(instance: Dict[str, Any]) -> Optional[str]:
+def get_metric_summaries(cloudwatch: Any, instance_ids: List[str],
+                         signals: Optional[Dict[str, float]] = None) -> Tuple[Dict[str, Dict[str, float]], Dict[str, Dict[str, float]]]:
     """
-    Check if an instance should be skipped for shutdown
-    Returns skip reason or None if instance should be evaluated
+    Fetch a metric math summary of each instance's idle window with batched GetMetricData calls
+    Returns a dict of instance ID to CPU summary (see summary_expressions),
+    and a dict of instance ID to the peak five-minute value of each signal
     """
-    instance_type = instance['InstanceType']
-    instance_id = instance['InstanceId']
-    
-    # Check if instance type is excluded (P or G types)
-    for excluded_type in EXCLUDED_INSTANCE_TYPES:
-        if instance_type.lower().startswith(excluded_type):
-            return f"Instance type {instance_type} is excluded (P/G type)"
-    
-    # Check shutdown tag
-    tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
-    shutdown_tag = tags.get('Shutdown', '').lower()
+    summaries = {instance_id: {} for instance_id in instance_ids}
+    signal_peaks = {instance_id: {} for instance_id in instance_ids}
     
-    if shutdown_tag == 'no':
-        return "Instance has 'Shutdown=No' tag"
+    for query_ids, request in metric_summary_requests(instance_ids, signals):
+        try:
+            while True:
+                response = cloudwatch.get_metric_data(**request)
+                seen = add_summary_results(summaries, signal_peaks, query_ids, response)
+                
+                # Later pages only repeat the scalars already read
+                next_token = response.get('NextToken')
+                if not next_token or seen >= query_ids.keys():
+                    break
+                request['NextToken'] = next_token
+                
+        except Exception as e:
+            # Instances without a summary are treated as not idle by is_summary_idle
+            logger.error("Error fetching metric summaries for %s expressions: %s", len(query_ids), e)
     
-    return None
+    return summaries, signal_peaks
 
 
-def enable_detailed_monitoring_if_needed(instance_id: str) -> bool:
+def metric_summary_requests(instance_ids: List[str],
+                            signals: Optional[Dict[str, float]] = None) -> List[Tuple[Dict[str, Tuple[str, str]], Dict[str, Any]]]:
     """
-    Enable detailed monitoring for an instance if it's not already enabled
-    Returns True if monitoring was enabled, False if already enabled or failed
+    Build GetMetricData requests whose metric math expressions reduce each instance's
+    idle window to the summary_expressions scalars and one peak per signal
+    The raw series are queried with ReturnData False, so only expressions come back
+    CloudWatch returns a scalar at every timestamp of its input; adding it to an
+    anchor series with one datapoint for the whole window returns it only once
+    Returns (expression ID to (instance ID, summary key or metric name), request arguments)
+    per request, each with at most METRIC_DATA_MAX_QUERIES queries
     """
-    if not ENABLE_DETAILED_MONITORING:
-        return False
+    if not instance_ids:
+        return []
     
-    try:
-        # Check current monitoring status
-        response = ec2_client.describe_instances(InstanceIds=[instance_id])
+    signals = IDLE_SIGNAL_THRESHOLDS if signals is None else signals
+    cpu_expressions = summary_expressions()
+    queries_per_instance = 2 + len(cpu_expressions) + 2 * len(signals)
+    instances_per_request = max(1, METRIC_DATA_MAX_QUERIES // queries_per_instance)
+    
+    start_time, end_time = idle_window()
+    
+    requests = []
+    for batch_start in range(0, len(instance_ids), instances_per_request):
+        batch = instance_ids[batch_start:batch_start + instances_per_request]
+        query_ids = {}
+        queries = []
+        for index, instance_id in enumerate(batch):
+            cpu_query_id = f"c{index}"
+            anchor_query_id = f"a{index}"
+            queries.append(metric_stat_query(cpu_query_id, instance_id, 'CPUUtilization', return_data=False))
+            queries.append(metric_stat_query(anchor_query_id, instance_id, 'CPUUtilization',
+                                             period=IDLE_DURATION_HOURS * 3600, stat='SampleCount', return_data=False))
+            expressions = [
+                (key, expression.format(query_id=cpu_query_id, threshold=CPU_THRESHOLD, gap=METRIC_GAP_SECONDS))
+                for key, expression in cpu_expressions.items()
+            ]
+            for metric_index, metric_name in enumerate(signals):
+                signal_query_id = f"s{index}_{metric_index}"
+                queries.append(metric_stat_query(signal_query_id, instance_id, metric_name, return_data=False))
+                expressions.append((metric_name, f"MAX({signal_query_id})"))
+            
+            for expression_index, (key, expression) in enumerate(expressions):
+                expression_id = f"e{index}_{expression_index}"
+                query_ids[expression_id] = (instance_id, key)
+                queries.append({'Id': expression_id, 'Expression': f"{anchor_query_id} * 0 + {expression}", 'ReturnData': True})
         
-        for reservation in response['Reservations']:
-            for instance in reservation['Instances']:
-                monitoring_state = instance.get('Monitoring', {}).get('State', 'disabled')
-                
-                if monitoring_state == 'disabled':
-                    logger.info(f"Enabling detailed monitoring for instance {instance_id}")
-                    
-                    if not DRY_RUN:
-                        # Enable detailed monitoring
-                        monitor_response = ec2_client.monitor_instances(InstanceIds=[instance_id])
-                        
-                        # Log the result
-                        for monitor_info in monitor_response.get('InstanceMonitorings', []):
-                            new_state = monitor_info.get('Monitoring', {}).get('State', 'unknown')
-                            logger.info(f"Instance {instance_id} monitoring state changed to: {new_state}")
-                        
-                        return True
-                    else:
-                        logger.info(f"DRY_RUN: Would enable detailed monitoring for {instance_id}")
-                        return True
-                        
-                elif monitoring_state == 'enabled':
-                    logger.debug(f"Instance {instance_id} already has detailed monitoring enabled")
-                    return False
-                    
-                elif monitoring_state == 'pending':
-                    logger.info(f"Instance {instance_id} monitoring state is pending")
-                    return False
-                    
-    except Exception as e:
-        logger.error(f"Error enabling detailed monitoring for instance {instance_id}: {str(e)}")
-        return False
+        requests.append((query_ids, {
+            'MetricDataQueries': queries,
+            'StartTime': start_time,
+            'EndTime': end_time,
+            'ScanBy': 'TimestampAscending'
+        }))
     
-    return False
+    return requests
+
+
+def summary_expressions() -> Dict[str, str]:
+    """
+    The CPU summary expressions of a run; last_busy is only fetched to schedule next checks
+    """
+    if schedule_store:
+        return {**CPU_SUMMARY_EXPRESSIONS, **SCHEDULE_SUMMARY_EXPRESSIONS}
+    return CPU_SUMMARY_EXPRESSIONS
+
+
+def add_summary_results(summaries: Dict[str, Dict[str, float]], signal_peaks: Dict[str, Dict[str, float]],
+                        query_ids: Dict[str, Tuple[str, str]], response: Dict[str, Any]) -> Set[str]:
+    """
+    Add the scalars of one metric math GetMetricData response
+    Only the first value of each expression is read; instances without CPU
+    datapoints return none, signals an instance does not report return NaN
+    Returns the IDs of the expressions that had a value
+    """
+    seen = set()
+    for result in response.get('MetricDataResults', []):
+        query = query_ids.get(result['Id'])
+        values = result.get('Values')
+        if query is None or not values or math.isnan(values[0]):
+            continue
+        instance_id, key = query
+        seen.add(result['Id'])
+        if key in CPU_SUMMARY_EXPRESSIONS or key in SCHEDULE_SUMMARY_EXPRESSIONS:
+            summaries[instance_id][key] = values[0]
+        else:
+            signal_peaks[instance_id][key] = values[0]
+    return seen
+
+
+def active_signal(instance_peaks: Dict[str, float]) -> Optional[Tuple[str, float]]:
+    """
+    Return the first idle signal whose peak is above its threshold, with that peak
+    Signals an instance does not report (instance store disks, EBS metrics on
+    non-Nitro types) have no datapoints and never keep it running
+    """
+    for metric_name, threshold in IDLE_SIGNAL_THRESHOLDS.items():
+        peak = instance_peaks.get(metric_name)
+        if peak is not None and peak > threshold:
+            return metric_name, peak
+    return None
 
 
-def is_instance_idle(instance_id: str) -> bool:
+def is_instance_idle(instance_id: str, datapoints: List[Dict[str, Any]],
+                     instance_index: Dict[str, InstanceRecord]) -> bool:
     """
     Check if an instance has been idle (low CPU) for the specified duration
     Takes into account instance launch time to ensure we have sufficient data
+    Expects the CPU datapoints fetched for the instance by get_instance_metrics
     """
     try:
-        # Get instance launch time
-        instance_response = ec2_client.describe_instances(InstanceIds=[instance_id])
-        launch_time = None
-        
-        for reservation in instance_response['Reservations']:
-            for instance in reservation['Instances']:
-                launch_time = instance.get('LaunchTime')
-                break
+        # Get instance launch time from the run's instance index
+        instance = instance_index.get(instance_id)
+        launch_time = instance.launch_time if instance else None
         
         if not launch_time:
-            logger.warning(f"Could not get launch time for instance {instance_id}")
+            decision_log.warning(instance_id, "Could not get launch time for instance %s", instance_id, outcome='no_launch_time')
             return False
         
         # Calculate time since launch
@@ -233,7 +1992,8 @@ def is_instance_idle(instance_id: str) -> bool:
         # Check if instance has been running long enough for reliable metrics
         required_runtime_hours = IDLE_DURATION_HOURS + 0.5  # Add 30 minutes buffer
         if time_since_launch < timedelta(hours=required_runtime_hours):
-            logger.info(f"Instance {instance_id} launched {time_since_launch} ago, need at least {required_runtime_hours} hours for evaluation")
+            decision_log.info(instance_id, "Instance %s launched %s ago, need at least %s hours for evaluation",
+                              instance_id, time_since_launch, required_runtime_hours, outcome='too_new')
             return False
         
         # Calculate metric collection period
@@ -243,31 +2003,17 @@ def is_instance_idle(instance_id: str) -> bool:
         # Only consider launch time if instance was launched within the last 3 hours
         launch_time_utc = launch_time.replace(tzinfo=None)
         if launch_time_utc > standard_start_time:
-            # Instance launched within last 3 hours - use launch time as start
-            metrics_start_time = launch_time_utc
+            # Instance launched within last 3 hours - ignore datapoints before launch
+            datapoints = [
+                dp for dp in datapoints
+                if dp['Timestamp'].replace(tzinfo=None) >= launch_time_utc
+            ]
         else:
             # Instance launched more than 3 hours ago - use standard 3-hour lookback
-            metrics_start_time = standard_start_time
-        
-        response = cloudwatch_client.get_metric_statistics(
-            Namespace='AWS/EC2',
-            MetricName='CPUUtilization',
-            Dimensions=[
-                {
-                    'Name': 'InstanceId',
-                    'Value': instance_id
-                }
-            ],
-            StartTime=metrics_start_time,
-            EndTime=end_time,
-            Period=300,  # 5-minute periods
-            Statistics=['Average']
-        )
-        
-        datapoints = response.get('Datapoints', [])
+            datapoints = list(datapoints)
         
         if not datapoints:
-            logger.warning(f"No CPU metrics found for instance {instance_id}")
+            decision_log.warning(instance_id, "No CPU metrics found for instance %s", instance_id, outcome='no_metrics')
             return False
         
         # Sort datapoints by timestamp
@@ -279,21 +2025,22 @@ def is_instance_idle(instance_id: str) -> bool:
         # Check if we have sufficient datapoints (at least 90% of expected)
         min_required_datapoints = int(expected_datapoints * 0.9)
         if len(datapoints) < min_required_datapoints:
-            logger.info(f"Insufficient metrics for instance {instance_id}: {len(datapoints)} datapoints, need at least {min_required_datapoints}")
+            decision_log.info(instance_id, "Insufficient metrics for instance %s: %s datapoints, need at least %s",
+                              instance_id, len(datapoints), min_required_datapoints, outcome='insufficient_metrics')
             return False
         
         # Check for gaps in 5-minute intervals - ensure continuous monitoring
         time_gaps = []
         for i in range(1, len(datapoints)):
             time_diff = (datapoints[i]['Timestamp'] - datapoints[i-1]['Timestamp']).total_seconds()
-            if time_diff > 360:  # More than 6 minutes gap (allowing for slight CloudWatch delays)
+            if time_diff > METRIC_GAP_SECONDS:  # Allowing for slight CloudWatch delays
                 time_gaps.append(time_diff)
         
         if time_gaps:
             total_gap_time = sum(time_gaps)
-            max_allowed_gap = 600  # 10 minutes total gap allowed
-            if total_gap_time > max_allowed_gap:
-                logger.info(f"Instance {instance_id} has significant gaps in metrics ({total_gap_time}s total), skipping evaluation")
+            if total_gap_time > MAX_TOTAL_GAP_SECONDS:
+                decision_log.info(instance_id, "Instance %s has significant gaps in metrics (%ss total), skipping evaluation",
+                                  instance_id, total_gap_time, outcome='metric_gaps')
                 return False
         
         # Use the most recent datapoints for idle evaluation
@@ -302,60 +2049,409 @@ def is_instance_idle(instance_id: str) -> bool:
         idle_count = sum(1 for dp in recent_datapoints if dp['Average'] <= CPU_THRESHOLD)
         idle_percentage = (idle_count / len(recent_datapoints)) * 100
         
-        logger.info(f"Instance {instance_id}: {idle_percentage:.1f}% of {len(recent_datapoints)} datapoints below {CPU_THRESHOLD}% CPU (launched {time_since_launch} ago)")
-        
         # Consider idle only if ALL datapoints are below threshold (100%)
-        return idle_percentage == 100
+        idle = idle_percentage == 100
+        decision_log.info(instance_id, "Instance %s: %.1f%% of %s datapoints below %s%% CPU (launched %s ago)",
+                          instance_id, idle_percentage, len(recent_datapoints), CPU_THRESHOLD, time_since_launch,
+                          outcome=None if idle else 'active_cpu')
+        return idle
         
     except Exception as e:
-        logger.error(f"Error checking CPU metrics for instance {instance_id}: {str(e)}")
+        logger.error("Error checking CPU metrics for instance %s: %s", instance_id, e)
+        decision_log.count('evaluation_error')
         return False
 
 
-def shutdown_instance(instance: Dict[str, Any]) -> Dict[str, Any]:
+def is_summary_idle(instance_id: str, summary: Dict[str, float],
+                    instance_index: Dict[str, InstanceRecord]) -> bool:
     """
-    Shutdown an EC2 instance
+    Variant of is_instance_idle on the metric math summary of the idle window
+    Applies the same runtime, datapoint count, gap and threshold checks to the
+    scalars CloudWatch computed instead of to the datapoints
     """
-    instance_id = instance['InstanceId']
-    instance_type = instance['InstanceType']
-    
     try:
-        if DRY_RUN:
-            logger.info(f"DRY RUN: Would shutdown instance {instance_id} ({instance_type})")
-            return {
+        instance = instance_index.get(instance_id)
+        launch_time = instance.launch_time if instance else None
+        
+        if not launch_time:
+            decision_log.warning(instance_id, "Could not get launch time for instance %s", instance_id, outcome='no_launch_time')
+            return False
+        
+        # Check if instance has been running long enough for reliable metrics; the
+        # window then starts after launch, so no datapoints need to be filtered out
+        time_since_launch = datetime.utcnow().replace(tzinfo=launch_time.tzinfo) - launch_time
+        required_runtime_hours = IDLE_DURATION_HOURS + 0.5  # Add 30 minutes buffer
+        if time_since_launch < timedelta(hours=required_runtime_hours):
+            decision_log.info(instance_id, "Instance %s launched %s ago, need at least %s hours for evaluation",
+                              instance_id, time_since_launch, required_runtime_hours, outcome='too_new')
+            return False
+        
+        datapoints = int(summary.get('datapoints', 0))
+        if not datapoints:
+            decision_log.warning(instance_id, "No CPU metrics found for instance %s", instance_id, outcome='no_metrics')
+            return False
+        
+        expected_datapoints = int(IDLE_DURATION_HOURS * 12)  # 12 datapoints per hour
+        min_required_datapoints = int(expected_datapoints * 0.9)
+        if datapoints < min_required_datapoints:
+            decision_log.info(instance_id, "Insufficient metrics for instance %s: %s datapoints, need at least %s",
+                              instance_id, datapoints, min_required_datapoints, outcome='insufficient_metrics')
+            return False
+        
+        total_gap_time = summary.get('gap_seconds', 0.0)
+        if total_gap_time > MAX_TOTAL_GAP_SECONDS:
+            decision_log.info(instance_id, "Instance %s has significant gaps in metrics (%ss total), skipping evaluation",
+                              instance_id, total_gap_time, outcome='metric_gaps')
+            return False
+        
+        # A summary missing its breach count cannot prove the instance idle
+        breaches = summary.get('breaches', float(datapoints))
+        idle_percentage = ((datapoints - breaches) / datapoints) * 100
+        
+        idle = breaches == 0
+        decision_log.info(instance_id, "Instance %s: %.1f%% of %s datapoints below %s%% CPU (max %.2f%%, launched %s ago)",
+                          instance_id, idle_percentage, datapoints, CPU_THRESHOLD, summary.get('max_cpu', float('nan')), time_since_launch,
+                          outcome=None if idle else 'active_cpu')
+        return idle
+        
+    except Exception as e:
+        logger.error("Error checking CPU metrics for instance %s: %s", instance_id, e)
+        decision_log.count('evaluation_error')
+        return False
+
+
+def is_streak_idle(instance_id: str, datapoints: List[Dict[str, Any]],
+                   instance_index: Dict[str, InstanceRecord],
+                   state: Optional[Dict[str, Any]], active_signal: bool = False) -> Tuple[bool, Optional[Dict[str, Any]]]:
+    """
+    Incremental variant of is_instance_idle driven by the stored idle streak
+    Only datapoints newer than the state's last_timestamp are expected
+    With active_signal, the datapoints are still folded into the state but the
+    streak ends and no CPU outcome is recorded; the caller records the signal
+    Returns the decision and the updated state to save
+    """
+    try:
+        instance = instance_index.get(instance_id)
+        launch_time = instance.launch_time if instance else None
+        
+        if not launch_time:
+            if not active_signal:
+                decision_log.warning(instance_id, "Could not get launch time for instance %s", instance_id, outcome='no_launch_time')
+            return False, None
+        
+        # A restarted instance starts a fresh streak
+        launch_epoch = launch_time.timestamp()
+        if not state or state.get('launch_time') != launch_epoch:
+            state = {
                 'instance_id': instance_id,
-                'instance_type': instance_type,
-                'action': 'dry_run',
-                'status': 'success',
-                'message': 'Would be shut down (dry run mode)'
+                'launch_time': launch_epoch,
+                'last_timestamp': None,
+                'streak_start': None,
+                'streak_datapoints': 0,
+                'gap_seconds': 0.0
             }
         else:
-            # Get instance name for better logging
-            tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
-            instance_name = tags.get('Name', 'Unnamed')
-            
-            # Stop the instance
-            response = ec2_client.stop_instances(InstanceIds=[instance_id])
-            
-            logger.info(f"Successfully initiated shutdown for instance {instance_id} ({instance_name}, {instance_type})")
-            
-            return {
-                'instance_id': instance_id,
-                'instance_type': instance_type,
-                'instance_name': instance_name,
-                'action': 'shutdown',
-                'status': 'success',
-                'message': 'Shutdown initiated successfully'
-            }
-            
+            state = dict(state)
+        
+        state = update_idle_streak(state, datapoints)
+        if active_signal:
+            # Activity on another signal ends the idle streak as a busy CPU datapoint would
+            state.update(streak_start=None, streak_datapoints=0, gap_seconds=0.0)
+            return False, state
+        
+        # Check if instance has been running long enough for reliable metrics
+        time_since_launch = datetime.utcnow().replace(tzinfo=launch_time.tzinfo) - launch_time
+        required_runtime_hours = IDLE_DURATION_HOURS + 0.5  # Add 30 minutes buffer
+        if time_since_launch < timedelta(hours=required_runtime_hours):
+            decision_log.info(instance_id, "Instance %s launched %s ago, need at least %s hours for evaluation",
+                              instance_id, time_since_launch, required_runtime_hours, outcome='too_new')
+            return False, state
+        
+        # Idle once the streak covers the whole idle window with enough datapoints,
+        # the same bar is_instance_idle applies to a freshly fetched window
+        min_required_datapoints = int(IDLE_DURATION_HOURS * 12 * 0.9)
+        streak_seconds = 0.0
+        if state['streak_start'] is not None:
+            streak_seconds = state['last_timestamp'] - state['streak_start'] + 300
+        
+        idle = (
+            streak_seconds >= IDLE_DURATION_HOURS * 3600
+            and state['streak_datapoints'] >= min_required_datapoints
+        )
+        decision_log.info(instance_id, "Instance %s: idle streak of %s datapoints over %.0fs below %s%% CPU (launched %s ago)",
+                          instance_id, state['streak_datapoints'], streak_seconds, CPU_THRESHOLD, time_since_launch,
+                          outcome=None if idle else 'active_cpu')
+        return idle, state
+        
     except Exception as e:
-        error_msg = f"Failed to shutdown instance {instance_id}: {str(e)}"
-        logger.error(error_msg)
+        logger.error("Error checking CPU metrics for instance %s: %s", instance_id, e)
+        if not active_signal:
+            decision_log.count('evaluation_error')
+        return False, None
+
+
+def update_idle_streak(state: Dict[str, Any], datapoints: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Fold new CPU datapoints into an idle-streak state
+    A busy datapoint ends the streak; so does exceeding the gap budget, in which
+    case the streak restarts at the datapoint after the gap
+    """
+    for dp in sorted(datapoints, key=lambda x: x['Timestamp']):
+        timestamp = dp['Timestamp'].timestamp()
+        if state['last_timestamp'] is not None and timestamp <= state['last_timestamp']:
+            continue
         
-        return {
+        if state['streak_start'] is not None:
+            time_diff = timestamp - state['last_timestamp']
+            if time_diff > METRIC_GAP_SECONDS:
+                state['gap_seconds'] += time_diff
+            if state['gap_seconds'] > MAX_TOTAL_GAP_SECONDS:
+                state['streak_start'] = None
+        
+        if dp['Average'] > CPU_THRESHOLD:
+            state['streak_start'] = None
+        elif state['streak_start'] is None:
+            state['streak_start'] = timestamp
+            state['streak_datapoints'] = 1
+            state['gap_seconds'] = 0.0
+        else:
+            state['streak_datapoints'] += 1
+        
+        if state['streak_start'] is None:
+            state['streak_datapoints'] = 0
+            state['gap_seconds'] = 0.0
+        state['last_timestamp'] = timestamp
+    
+    return state
+
+
+def shutdown_instances(ec2: Any, instances: List[InstanceRecord]) -> List[Dict[str, Any]]:
+    """
+    Shutdown EC2 instances with batched StopInstances calls
+    Hibernation-capable instances are hibernated in batches of their own, see split_hibernation_candidates
+    Returns one result per instance, in the same order as the input
+    """
+    lookup_hibernation_support(ec2, instances)
+    hibernating, stopping = split_hibernation_candidates(instances)
+    if DRY_RUN:
+        return dry_run_shutdown_results(instances, hibernating)
+    
+    results = {}
+    for group, hibernate in ((hibernating, True), (stopping, False)):
+        for batch_start in range(0, len(group), STOP_INSTANCES_BATCH_SIZE):
+            for result in stop_instance_batch(ec2, group[batch_start:batch_start + STOP_INSTANCES_BATCH_SIZE], hibernate):
+                results[result['instance_id']] = result
+    
+    return [results[instance.instance_id] for instance in instances]
+
+
+def hibernation_lookup_types(instances: List[InstanceRecord]) -> List[str]:
+    """
+    Types of hibernation-configured instances whose support is not cached yet
+    None with the stop strategy, so it never calls DescribeInstanceTypes
+    """
+    if SHUTDOWN_STRATEGY != 'hibernate':
+        return []
+    with _hibernation_support_lock:
+        return sorted({
+            instance.instance_type for instance in instances
+            if instance.hibernation_configured and instance.instance_type not in _hibernation_support
+        })
+
+
+def cache_hibernation_support(page: Dict[str, Any]) -> None:
+    """
+    Cache the hibernation support of the types in a DescribeInstanceTypes page
+    """
+    with _hibernation_support_lock:
+        for instance_type in page.get('InstanceTypes', []):
+            _hibernation_support[instance_type['InstanceType']] = instance_type.get('HibernationSupported', False)
+
+
+def lookup_hibernation_support(ec2: Any, instances: List[InstanceRecord]) -> None:
+    """
+    Describe the types of hibernation-configured instances that are not cached yet
+    The lock is only held to claim the types and to cache each page, not through
+    the calls; types another target is describing are waited for instead of being
+    described twice. A type that cannot be described is not cached: its instances
+    are stopped without hibernation and it is described again next run
+    """
+    done = threading.Event()
+    with _hibernation_support_lock:
+        instance_types = hibernation_lookup_types(instances)
+        waiting = {_hibernation_lookups[instance_type] for instance_type in instance_types if instance_type in _hibernation_lookups}
+        instance_types = [instance_type for instance_type in instance_types if instance_type not in _hibernation_lookups]
+        _hibernation_lookups.update(dict.fromkeys(instance_types, done))
+    
+    try:
+        for batch_start in range(0, len(instance_types), DESCRIBE_INSTANCE_TYPES_BATCH_SIZE):
+            batch = instance_types[batch_start:batch_start + DESCRIBE_INSTANCE_TYPES_BATCH_SIZE]
+            try:
+                paginator = ec2.get_paginator('describe_instance_types')
+                for page in paginator.paginate(InstanceTypes=batch):
+                    cache_hibernation_support(page)
+            except Exception as e:
+                logger.error("Error describing instance types %s, stopping their instances without hibernation: %s", batch, e)
+    finally:
+        with _hibernation_support_lock:
+            for instance_type in instance_types:
+                del _hibernation_lookups[instance_type]
+        done.set()
+    
+    for event in waiting:
+        event.wait()
+
+
+def split_hibernation_candidates(instances: List[InstanceRecord]) -> Tuple[List[InstanceRecord], List[InstanceRecord]]:
+    """
+    Split instances into those to hibernate and those to stop
+    An instance is hibernated with the hibernate strategy when it was launched
+    with hibernation configured and its type's cached support says it can be
+    """
+    if SHUTDOWN_STRATEGY != 'hibernate':
+        return [], list(instances)
+    
+    hibernating = []
+    stopping = []
+    with _hibernation_support_lock:
+        for instance in instances:
+            if instance.hibernation_configured and _hibernation_support.get(instance.instance_type, False):
+                hibernating.append(instance)
+            else:
+                stopping.append(instance)
+    return hibernating, stopping
+
+
+def stop_instances_request(instances: List[InstanceRecord], hibernate: bool) -> Dict[str, Any]:
+    """
+    StopInstances arguments for a batch; Hibernate is only sent for hibernating batches
+    """
+    request = {'InstanceIds': [instance.instance_id for instance in instances]}
+    if hibernate:
+        request['Hibernate'] = True
+    return request
+
+
+def stop_instance_batch(ec2: Any, instances: List[InstanceRecord], hibernate: bool = False) -> List[Dict[str, Any]]:
+    """
+    Stop (or hibernate) a batch of instances in one StopInstances call
+    If the call fails because of an individual instance, the batch is split in
+    half and retried so the failure is isolated to that instance; an instance
+    that cannot hibernate is then stopped without hibernation
+    """
+    try:
+        response = ec2.stop_instances(**stop_instances_request(instances, hibernate))
+        
+    except ClientError as e:
+        if stop_batch_bisectable(instances, e):
+            middle = len(instances) // 2
+            return stop_instance_batch(ec2, instances[:middle], hibernate) + stop_instance_batch(ec2, instances[middle:], hibernate)
+        if hibernate_fallback(instances, e, hibernate):
+            return stop_instance_batch(ec2, instances)
+        return [shutdown_error_result(instance, e) for instance in instances]
+        
+    except Exception as e:
+        return [shutdown_error_result(instance, e) for instance in instances]
+    
+    return stop_batch_results(instances, response, hibernate)
+
+
+def stop_batch_bisectable(instances: List[InstanceRecord], error: ClientError) -> bool:
+    """
+    Check if a failed StopInstances batch should be split to isolate the failing instance
+    """
+    error_code = error.response.get('Error', {}).get('Code', '')
+    if len(instances) > 1 and error_code in BISECT_ERROR_CODES:
+        logger.warning("StopInstances failed for batch of %s with %s, splitting batch", len(instances), error_code)
+        return True
+    return False
+
+
+def hibernate_fallback(instances: List[InstanceRecord], error: ClientError, hibernate: bool) -> bool:
+    """
+    Check if a hibernating StopInstances call failed because its instance cannot hibernate now
+    """
+    error_code = error.response.get('Error', {}).get('Code', '')
+    if hibernate and error_code in HIBERNATE_FALLBACK_ERROR_CODES:
+        for instance in instances:
+            decision_log.warning(instance.instance_id, "Instance %s cannot hibernate (%s), stopping it instead",
+                                 instance.instance_id, error_code, outcome='hibernate_fallback')
+        return True
+    return False
+
+
+def dry_run_shutdown_results(instances: List[InstanceRecord],
+                             hibernating: Optional[List[InstanceRecord]] = None) -> List[Dict[str, Any]]:
+    """
+    Build the results for instances that would be shut down in dry run mode
+    """
+    hibernating_ids = {instance.instance_id for instance in hibernating or []}
+    results = []
+    for instance in instances:
+        hibernate = instance.instance_id in hibernating_ids
+        decision_log.info(instance.instance_id, "DRY RUN: Would %s instance %s (%s)", 'hibernate' if hibernate else 'shutdown',
+                          instance.instance_id, instance.instance_type)
+        results.append({
+            'instance_id': instance.instance_id,
+            'instance_type': instance.instance_type,
+            'action': 'dry_run',
+            'status': 'success',
+            'message': 'Would be hibernated (dry run mode)' if hibernate else 'Would be shut down (dry run mode)'
+        })
+    return results
+
+
+def stop_batch_results(instances: List[InstanceRecord], response: Dict[str, Any],
+                       hibernate: bool = False) -> List[Dict[str, Any]]:
+    """
+    Map a StopInstances response back to one result per instance in the batch
+    Hibernated instances get the 'hibernate' action
+    """
+    stopping = {
+        state_change['InstanceId']: state_change
+        for state_change in response.get('StoppingInstances', [])
+    }
+    
+    results = []
+    for instance in instances:
+        instance_id = instance.instance_id
+        instance_type = instance.instance_type
+        
+        if instance_id not in stopping:
+            results.append(shutdown_error_result(instance, 'instance missing from StoppingInstances response'))
+            continue
+        
+        instance_name = instance.name
+        
+        current_state = stopping[instance_id].get('CurrentState', {}).get('Name', 'unknown')
+        decision_log.info(instance_id, "Successfully initiated %s for instance %s (%s, %s), state: %s",
+                          'hibernation' if hibernate else 'shutdown', instance_id, instance_name, instance_type, current_state,
+                          outcome='hibernated' if hibernate else 'stopped')
+        
+        results.append({
             'instance_id': instance_id,
             'instance_type': instance_type,
-            'action': 'shutdown',
-            'status': 'error',
-            'message': error_msg
-        }
\ No newline at end of file
+            'instance_name': instance_name,
+            'action': 'hibernate' if hibernate else 'shutdown',
+            'status': 'success',
+            'message': 'Hibernation initiated successfully' if hibernate else 'Shutdown initiated successfully'
+        })
+    
+    return results
+
+
+def shutdown_error_result(instance: InstanceRecord, error: Any) -> Dict[str, Any]:
+    """
+    Build the shutdown result for an instance that could not be stopped
+    """
+    instance_id = instance.instance_id
+    error_msg = f"Failed to shutdown instance {instance_id}: {str(error)}"
+    logger.error(error_msg)
+    
+    return {
+        'instance_id': instance_id,
+        'instance_type': instance.instance_type,
+        'action': 'shutdown',
+        'status': 'error',
+        'message': error_msg
+    }
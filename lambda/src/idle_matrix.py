@@ -0,0 +1,206 @@
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Any, Iterator, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Padding for empty slots; sorts after every real timestamp
+PAD_TIMESTAMP = np.iinfo(np.int64).max
+
+
+class CPUSeries:
+    """
+    CPU datapoints of one instance, kept as the parallel Timestamps and Values
+    lists of its GetMetricData results so no dict is built per datapoint
+    Iterating yields datapoints shaped like GetMetricStatistics output, for the
+    per-instance checks that still need them (next_eligible_check)
+    """
+
+    __slots__ = ('timestamps', 'values')
+
+    def __init__(self):
+        self.timestamps: List[datetime] = []
+        self.values: List[float] = []
+
+    def extend(self, timestamps: List[datetime], values: List[float]) -> None:
+        self.timestamps.extend(timestamps)
+        self.values.extend(values)
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return ({'Timestamp': timestamp, 'Average': value} for timestamp, value in zip(self.timestamps, self.values))
+
+
+def series_lists(series: Any) -> Tuple[List[datetime], List[float]]:
+    """
+    Timestamps and values of a CPUSeries, or of a list of datapoint dicts
+    """
+    if isinstance(series, CPUSeries):
+        return series.timestamps, series.values
+    return [dp['Timestamp'] for dp in series], [dp['Average'] for dp in series]
+
+
+class EpochConverter:
+    """
+    Converts timestamp lists to epoch microseconds
+    Instances queried in the same request mostly share one list of five-minute
+    timestamps; comparing a list with the few most recently converted ones is
+    far cheaper than converting each datetime again. Other lists, mostly that
+    list with datapoints missing, convert each timestamp once
+    """
+
+    RECENT = 8
+
+    def __init__(self):
+        self.recent: List[Tuple[List[datetime], np.ndarray]] = []
+        self.micros: Dict[datetime, int] = {}
+
+    def convert(self, timestamps: List[datetime]) -> np.ndarray:
+        for converted_timestamps, micros in self.recent:
+            if converted_timestamps == timestamps:
+                return micros
+        micros = np.fromiter(map(self._micros, timestamps), dtype=np.int64, count=len(timestamps))
+        self.recent.insert(0, (timestamps, micros))
+        del self.recent[self.RECENT:]
+        return micros
+
+    def _micros(self, timestamp: datetime) -> int:
+        micros = self.micros.get(timestamp)
+        if micros is None:
+            micros = self.micros[timestamp] = round(timestamp.timestamp() * 1_000_000)
+        return micros
+
+
+def build_metrics_matrix(instance_ids: List[str], cpu_metrics: Dict[str, Any], not_before: Dict[str, datetime]):
+    """
+    Pack each instance's datapoints into one row of an instances x timesteps matrix
+    cpu_metrics holds a CPUSeries (or a list of datapoint dicts) per instance
+    Rows are sorted by timestamp and left-aligned; the mask marks real datapoints
+    Datapoints earlier than an instance's not_before time (naive UTC) are dropped
+    Returns (timestamps in epoch microseconds, values, mask, datapoint counts)
+    """
+    converter = EpochConverter()
+    rows = []
+    for row, instance_id in enumerate(instance_ids):
+        timestamps, values = series_lists(cpu_metrics.get(instance_id, []))
+        if not timestamps:
+            continue
+        row_timestamps = converter.convert(timestamps)
+        row_values = np.asarray(values, dtype=np.float64)
+        cutoff = not_before.get(instance_id)
+        if cutoff is not None and len(row_timestamps):
+            keep = row_timestamps >= round(cutoff.replace(tzinfo=timezone.utc).timestamp() * 1_000_000)
+            row_timestamps = row_timestamps[keep]
+            row_values = row_values[keep]
+        rows.append((row, row_timestamps, row_values))
+
+    width = max((len(row_timestamps) for _, row_timestamps, _ in rows), default=0)
+    timestamps = np.full((len(instance_ids), max(width, 1)), PAD_TIMESTAMP, dtype=np.int64)
+    values = np.full((len(instance_ids), max(width, 1)), np.nan, dtype=np.float64)
+    for row, row_timestamps, row_values in rows:
+        timestamps[row, :len(row_timestamps)] = row_timestamps
+        values[row, :len(row_values)] = row_values
+
+    # Stable sort keeps the input order of equal timestamps, like list.sort
+    order = np.argsort(timestamps, axis=1, kind='stable')
+    timestamps = np.take_along_axis(timestamps, order, axis=1)
+    values = np.take_along_axis(values, order, axis=1)
+    mask = timestamps != PAD_TIMESTAMP
+    counts = mask.sum(axis=1)
+
+    return timestamps, values, mask, counts
+
+
+def evaluate_idle_matrix(instance_ids: List[str], cpu_metrics: Dict[str, Any],
+                         instance_index: Dict[str, Any], cpu_threshold: float,
+                         idle_duration_hours: float, gap_seconds: float,
+                         max_total_gap_seconds: float) -> Dict[str, bool]:
+    """
+    Fleet-wide equivalent of is_instance_idle using array operations
+    Applies the same launch-time, coverage, gap and threshold rules and
+    returns a dict of instance ID to idle decision
+    """
+    outcomes = evaluate_outcome_matrix(instance_ids, cpu_metrics, instance_index, cpu_threshold,
+                                       idle_duration_hours, gap_seconds, max_total_gap_seconds)
+    return {instance_id: outcome == 'idle' for instance_id, outcome in outcomes.items()}
+
+
+def evaluate_outcome_matrix(instance_ids: List[str], cpu_metrics: Dict[str, Any],
+                            instance_index: Dict[str, Any], cpu_threshold: float,
+                            idle_duration_hours: float, gap_seconds: float,
+                            max_total_gap_seconds: float) -> Dict[str, str]:
+    """
+    evaluate_idle_matrix with the reason behind each decision
+    Returns a dict of instance ID to the outcome is_instance_idle records:
+    idle, active_cpu, or the first rule that keeps the instance from being idle
+    (no_launch_time, too_new, no_metrics, insufficient_metrics, metric_gaps)
+    """
+    if not instance_ids:
+        return {}
+
+    now = datetime.utcnow()
+    window_start = now - timedelta(hours=idle_duration_hours)
+    required_runtime = timedelta(hours=idle_duration_hours + 0.5)  # Add 30 minutes buffer
+
+    expected_datapoints = int(idle_duration_hours * 12)  # 12 datapoints per hour
+    min_required_datapoints = int(expected_datapoints * 0.9)
+
+    # Launch-time rules stay per instance; they are cheap attribute lookups.
+    # Only series that can still be idle are packed into the matrix: an instance
+    # that is too new, or has too few datapoints even before the launch-time
+    # cutoff, gets its outcome here
+    outcomes = {}
+    not_before = {}
+    packed = {}
+    for instance_id in instance_ids:
+        instance = instance_index.get(instance_id)
+        launch_time = instance.launch_time if instance else None
+        if not launch_time:
+            outcomes[instance_id] = 'no_launch_time'
+            continue
+        if now.replace(tzinfo=launch_time.tzinfo) - launch_time < required_runtime:
+            outcomes[instance_id] = 'too_new'
+            continue
+        series = cpu_metrics.get(instance_id, [])
+        launch_time_utc = launch_time.replace(tzinfo=None)
+        cutoff = launch_time_utc if launch_time_utc > window_start else None
+        if len(series) < max(min_required_datapoints, 1):
+            timestamps, _ = series_lists(series)
+            if cutoff is not None:
+                timestamps = [timestamp for timestamp in timestamps if timestamp.replace(tzinfo=None) >= cutoff]
+            outcomes[instance_id] = 'insufficient_metrics' if timestamps else 'no_metrics'
+            continue
+        packed[instance_id] = series
+        if cutoff is not None:
+            not_before[instance_id] = cutoff
+
+    packed_ids = list(packed)
+    timestamps, values, mask, counts = build_metrics_matrix(packed_ids, packed, not_before)
+
+    # Total of the gaps between consecutive datapoints
+    diffs = timestamps[:, 1:] - timestamps[:, :-1]
+    gap_mask = mask[:, 1:] & mask[:, :-1] & (diffs > gap_seconds * 1_000_000)
+    gap_totals = np.where(gap_mask, diffs, 0).sum(axis=1)
+
+    # Only the most recent expected_datapoints of each row are thresholded;
+    # NaN values are never idle, matching the <= comparison in is_instance_idle
+    columns = np.arange(timestamps.shape[1])
+    recent = mask & (columns >= (counts - expected_datapoints)[:, None])
+    busy = (recent & ~(values <= cpu_threshold)).any(axis=1)
+
+    # The rules in is_instance_idle's order; the first that applies is the outcome
+    row_outcomes = np.select(
+        [counts == 0, counts < min_required_datapoints, gap_totals > max_total_gap_seconds * 1_000_000, busy],
+        ['no_metrics', 'insufficient_metrics', 'metric_gaps', 'active_cpu'], 'idle'
+    )
+    outcomes.update(zip(packed_ids, row_outcomes.tolist()))
+
+    logger.info("Evaluated %s instances: %s idle, %s with insufficient metrics",
+                len(instance_ids), sum(outcome == 'idle' for outcome in outcomes.values()),
+                sum(outcome == 'insufficient_metrics' for outcome in outcomes.values()))
+
+    return {instance_id: outcomes[instance_id] for instance_id in instance_ids}
@@ -0,0 +1,52 @@
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+
+class InstanceRecord:
+    """
+    The fields of a running instance the shutdown pipeline uses, built once per
+    instance during discovery from its DescribeInstances entry
+    Immutable; the rest of the DescribeInstances entry (block device mappings,
+    network interfaces, security groups) is dropped with the page
+    """
+
+    __slots__ = ('instance_id', 'instance_type', 'launch_time', 'monitoring_state', 'tags', 'name',
+                 'hibernation_configured')
+
+    def __init__(self, instance_id: str, instance_type: str, launch_time: Optional[datetime],
+                 monitoring_state: str = 'disabled', tags: Optional[Dict[str, str]] = None,
+                 hibernation_configured: bool = False):
+        tags = tags or {}
+        for field, value in (
+            ('instance_id', instance_id),
+            ('instance_type', instance_type),
+            ('launch_time', launch_time),
+            ('monitoring_state', monitoring_state),
+            ('tags', tags),
+            ('name', tags.get('Name', 'Unnamed')),
+            ('hibernation_configured', hibernation_configured)
+        ):
+            object.__setattr__(self, field, value)
+
+    @classmethod
+    def from_describe(cls, instance: Dict[str, Any]) -> 'InstanceRecord':
+        """
+        Build the record for one instance of a DescribeInstances response
+        """
+        return cls(
+            instance['InstanceId'],
+            instance['InstanceType'],
+            instance.get('LaunchTime'),
+            instance.get('Monitoring', {}).get('State', 'disabled'),
+            {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])},
+            instance.get('HibernationOptions', {}).get('Configured', False)
+        )
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"InstanceRecord is immutable, cannot set {name}")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"InstanceRecord is immutable, cannot delete {name}")
+
+    def __repr__(self) -> str:
+        return f"InstanceRecord({self.instance_id!r}, {self.instance_type!r}, {self.name!r})"
@@ -0,0 +1,319 @@
+import abc
+import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Callable, Optional
+
+from backends import ClientFactory, LazyClientMixin, parse_location
+
+logger = logging.getLogger(__name__)
+
+# Instance details kept for running instances, as InstanceRecord fields; instance_id,
+# state and updated_at (epoch seconds of the event or observation) are always set
+DETAIL_FIELDS = ['instance_type', 'launch_time', 'monitoring_state', 'tags']
+
+# Instances that are not running expire after this many days (DynamoDB TTL)
+INVENTORY_TTL_DAYS = 7
+
+
+class InventoryStore(abc.ABC):
+    """
+    Last known state of each instance, per target (target_label), fed by EC2
+    state-change events and corrected by periodic full reconciliations
+    Records are dicts with instance_id, state and updated_at plus the
+    DETAIL_FIELDS when known; a record only replaces an older one
+    """
+
+    @abc.abstractmethod
+    def put(self, target: str, record: Dict[str, Any]) -> bool:
+        """
+        Upsert a record unless the stored one is newer; details missing from
+        the record are kept. Returns whether the record was applied
+        """
+
+    def put_many(self, target: str, records: List[Dict[str, Any]]) -> int:
+        """
+        put for many records; returns how many were applied
+        """
+        return sum(self.put(target, record) for record in records)
+
+    @abc.abstractmethod
+    def running(self, target: str) -> List[Dict[str, Any]]:
+        """
+        Records of the target's instances whose last known state is running
+        """
+
+    @abc.abstractmethod
+    def set_monitoring_state(self, target: str, instance_ids: List[str], monitoring_state: str) -> None:
+        """
+        Set the monitoring state of instances the inventory lists as running
+        """
+
+    @abc.abstractmethod
+    def reconciled_at(self, target: str) -> Optional[float]:
+        """
+        Time of the target's last full reconciliation, None before the first
+        """
+
+    @abc.abstractmethod
+    def mark_reconciled(self, target: str, reconciled_at: float) -> None:
+        """
+        Record the time of a full reconciliation of the target
+        """
+
+    def reconcile(self, target: str, records: List[Dict[str, Any]], observed_at: float) -> int:
+        """
+        Replace the running set of a target with a full discovery made at observed_at
+        Only new or changed records are written, and instances missing from the
+        discovery are marked 'absent'; events newer than the discovery still win
+        Returns the number of records written
+        """
+        stored = {record['instance_id']: record for record in self.running(target)}
+        discovered = {record['instance_id'] for record in records}
+        changed = [
+            record for record in records
+            if record['instance_id'] not in stored
+            or any(stored[record['instance_id']].get(field) != record.get(field) for field in DETAIL_FIELDS)
+        ]
+        changed.extend(
+            {'instance_id': instance_id, 'state': 'absent', 'updated_at': observed_at}
+            for instance_id in stored.keys() - discovered
+        )
+        writes = self.put_many(target, changed)
+        self.mark_reconciled(target, observed_at)
+        return writes
+
+
+class SQLiteInventoryStore(InventoryStore):
+    """
+    SQLite-backed inventory for local runs and benchmarks
+    """
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS inventory (target TEXT, instance_id TEXT, state TEXT, updated_at REAL, "
+                "instance_type TEXT, launch_time REAL, monitoring_state TEXT, tags TEXT, "
+                "PRIMARY KEY (target, instance_id))"
+            )
+            self.connection.execute("CREATE TABLE IF NOT EXISTS reconciliation (target TEXT PRIMARY KEY, reconciled_at REAL)")
+
+    def put(self, target: str, record: Dict[str, Any]) -> bool:
+        return self.put_many(target, [record]) > 0
+
+    def put_many(self, target: str, records: List[Dict[str, Any]]) -> int:
+        with self.lock, self.connection:
+            cursor = self.connection.executemany(
+                "INSERT INTO inventory (target, instance_id, state, updated_at, instance_type, launch_time, monitoring_state, tags) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (target, instance_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at, "
+                "instance_type = COALESCE(excluded.instance_type, instance_type), "
+                "launch_time = COALESCE(excluded.launch_time, launch_time), "
+                "monitoring_state = COALESCE(excluded.monitoring_state, monitoring_state), "
+                "tags = COALESCE(excluded.tags, tags) "
+                "WHERE excluded.updated_at > inventory.updated_at",
+                [
+                    [target, record['instance_id'], record['state'], record['updated_at'],
+                     record.get('instance_type'), record.get('launch_time'), record.get('monitoring_state'),
+                     json.dumps(record['tags'], sort_keys=True) if record.get('tags') is not None else None]
+                    for record in records
+                ]
+            )
+            return cursor.rowcount
+
+    def running(self, target: str) -> List[Dict[str, Any]]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT instance_id, state, updated_at, instance_type, launch_time, monitoring_state, tags "
+                "FROM inventory WHERE target = ? AND state = 'running'",
+                [target]
+            ).fetchall()
+        return [
+            {
+                'instance_id': row[0],
+                'state': row[1],
+                'updated_at': row[2],
+                'instance_type': row[3],
+                'launch_time': row[4],
+                'monitoring_state': row[5],
+                'tags': json.loads(row[6]) if row[6] is not None else None
+            }
+            for row in rows
+        ]
+
+    def set_monitoring_state(self, target: str, instance_ids: List[str], monitoring_state: str) -> None:
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE inventory SET monitoring_state = ? WHERE target = ? AND instance_id = ? AND state = 'running'",
+                [[monitoring_state, target, instance_id] for instance_id in instance_ids]
+            )
+
+    def reconciled_at(self, target: str) -> Optional[float]:
+        with self.lock:
+            row = self.connection.execute("SELECT reconciled_at FROM reconciliation WHERE target = ?", [target]).fetchone()
+        return row[0] if row else None
+
+    def mark_reconciled(self, target: str, reconciled_at: float) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO reconciliation (target, reconciled_at) VALUES (?, ?)",
+                                    [target, reconciled_at])
+
+
+class DynamoDBInventoryStore(LazyClientMixin, InventoryStore):
+    """
+    DynamoDB-backed inventory; the table needs a string partition key named target
+    and a string sort key named instance_id, and can enable TTL on the expires_at
+    attribute to drop instances that stopped running
+    Conditional updates cannot be batched, so put_many and set_monitoring_state
+    send up to UPDATE_WORKERS UpdateItem calls at once
+    """
+
+    service_name = 'dynamodb'
+
+    # Sort key of the item holding a target's last reconciliation time
+    RECONCILED_KEY = '#reconciled'
+
+    # Concurrent UpdateItem calls, within the client's default connection pool
+    UPDATE_WORKERS = 8
+
+    def __init__(self, table_name: str, client_factory: ClientFactory):
+        self.table_name = table_name
+        self.client_factory = client_factory
+
+    def put_many(self, target: str, records: List[Dict[str, Any]]) -> int:
+        return sum(self._map(lambda record: self.put(target, record), records))
+
+    def put(self, target: str, record: Dict[str, Any]) -> bool:
+        names = {'#state': 'state'}
+        values = {
+            ':state': {'S': record['state']},
+            ':updated_at': {'N': repr(float(record['updated_at']))}
+        }
+        assignments = ['#state = :state', 'updated_at = :updated_at']
+        for field in DETAIL_FIELDS:
+            if record.get(field) is not None:
+                values[f":{field}"] = self._to_value(field, record[field])
+                assignments.append(f"{field} = :{field}")
+
+        expression = f"SET {', '.join(assignments)}"
+        if record['state'] == 'running':
+            expression += ' REMOVE expires_at'
+        else:
+            values[':expires_at'] = {'N': str(int(time.time()) + INVENTORY_TTL_DAYS * 86400)}
+            expression = expression.replace('SET ', 'SET expires_at = :expires_at, ', 1)
+
+        try:
+            self.client.update_item(
+                TableName=self.table_name,
+                Key={'target': {'S': target}, 'instance_id': {'S': record['instance_id']}},
+                UpdateExpression=expression,
+                ConditionExpression='attribute_not_exists(updated_at) OR updated_at < :updated_at',
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def running(self, target: str) -> List[Dict[str, Any]]:
+        records = []
+        request = {
+            'TableName': self.table_name,
+            'KeyConditionExpression': '#target = :target',
+            'FilterExpression': '#state = :running',
+            'ExpressionAttributeNames': {'#target': 'target', '#state': 'state'},
+            'ExpressionAttributeValues': {':target': {'S': target}, ':running': {'S': 'running'}}
+        }
+        while True:
+            response = self.client.query(**request)
+            records.extend(self._from_item(item) for item in response.get('Items', []))
+            if not response.get('LastEvaluatedKey'):
+                return records
+            request['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def set_monitoring_state(self, target: str, instance_ids: List[str], monitoring_state: str) -> None:
+        client = self.client
+
+        def update(instance_id: str) -> None:
+            try:
+                client.update_item(
+                    TableName=self.table_name,
+                    Key={'target': {'S': target}, 'instance_id': {'S': instance_id}},
+                    UpdateExpression='SET monitoring_state = :monitoring_state',
+                    ConditionExpression='#state = :running',
+                    ExpressionAttributeNames={'#state': 'state'},
+                    ExpressionAttributeValues={':monitoring_state': {'S': monitoring_state}, ':running': {'S': 'running'}}
+                )
+            except client.exceptions.ConditionalCheckFailedException:
+                pass
+
+        self._map(update, instance_ids)
+
+    def reconciled_at(self, target: str) -> Optional[float]:
+        response = self.client.get_item(
+            TableName=self.table_name,
+            Key={'target': {'S': target}, 'instance_id': {'S': self.RECONCILED_KEY}},
+            ConsistentRead=True
+        )
+        item = response.get('Item')
+        return float(item['reconciled_at']['N']) if item else None
+
+    def mark_reconciled(self, target: str, reconciled_at: float) -> None:
+        self.client.put_item(
+            TableName=self.table_name,
+            Item={
+                'target': {'S': target},
+                'instance_id': {'S': self.RECONCILED_KEY},
+                'reconciled_at': {'N': repr(float(reconciled_at))}
+            }
+        )
+
+    def _map(self, function: Callable[[Any], Any], items: List[Any]) -> List[Any]:
+        """
+        Results of function for each item, called from up to UPDATE_WORKERS threads;
+        the first exception is raised once every call has finished
+        """
+        if len(items) <= 1:
+            return [function(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(self.UPDATE_WORKERS, len(items))) as executor:
+            return list(executor.map(function, items))
+
+    @staticmethod
+    def _to_value(field: str, value: Any) -> Dict[str, Any]:
+        if field == 'launch_time':
+            return {'N': repr(float(value))}
+        if field == 'tags':
+            return {'M': {key: {'S': tag_value} for key, tag_value in value.items()}}
+        return {'S': value}
+
+    @staticmethod
+    def _from_item(item: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'instance_id': item['instance_id']['S'],
+            'state': item['state']['S'],
+            'updated_at': float(item['updated_at']['N']),
+            'instance_type': item['instance_type']['S'] if 'instance_type' in item else None,
+            'launch_time': float(item['launch_time']['N']) if 'launch_time' in item else None,
+            'monitoring_state': item['monitoring_state']['S'] if 'monitoring_state' in item else None,
+            'tags': {key: value['S'] for key, value in item['tags']['M'].items()} if 'tags' in item else None
+        }
+
+
+def create_inventory_store(location: str, client_factory: ClientFactory) -> Optional[InventoryStore]:
+    """
+    Inventory store for INVENTORY_STORE, 'dynamodb:<table>' or 'sqlite:<path>'
+    Without one, every run lists its targets' instances with DescribeInstances
+    """
+    parsed = parse_location(location, 'inventory store', ('dynamodb', 'sqlite'))
+    if parsed is None:
+        return None
+
+    backend, target = parsed
+    if backend == 'dynamodb':
+        return DynamoDBInventoryStore(target, client_factory)
+    return SQLiteInventoryStore(target)
@@ -0,0 +1,205 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Any, Iterable, Iterator, Optional, TypeVar
+
+from rate_limiter import THROTTLE_ERROR_CODES
+
+T = TypeVar('T')
+
+# Counters kept per AWS API operation, with the EMF metric name suffix and unit of each
+OPERATION_METRICS = {
+    'calls': ('Calls', 'Count'),
+    'retries': ('Retries', 'Count'),
+    'throttles': ('Throttles', 'Count'),
+    'errors': ('Errors', 'Count'),
+    'seconds': ('Time', 'Seconds'),
+    'bytes_received': ('BytesReceived', 'Bytes')
+}
+
+# Metrics per CloudWatchMetrics directive allowed in an EMF record
+EMF_MAX_METRICS = 100
+
+
+def metric_name(name: str) -> str:
+    """
+    CloudWatch-style metric name for a snake_case phase or value name
+    """
+    return ''.join(part.capitalize() for part in name.split('_'))
+
+
+class InvocationMetrics:
+    """
+    Phase durations and AWS API call counters for one invocation
+    Phases of targets processed concurrently add up, so a phase can take longer
+    in total than the invocation itself. API counters come from botocore events
+    on the clients passed to attach: a call is one client method call (one page
+    for paginators), its time includes retries and backoff, and every HTTP
+    attempt after the first counts as a retry
+    """
+
+    def __init__(self, namespace: str, dimensions: Dict[str, str]):
+        self.namespace = namespace
+        self.dimensions = dimensions
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Start counting a new invocation
+        """
+        with self.lock:
+            self.started = time.perf_counter()
+            self.phases: Dict[str, float] = defaultdict(float)
+            self.operations: Dict[str, Dict[str, float]] = defaultdict(lambda: dict.fromkeys(OPERATION_METRICS, 0))
+            self.values: Dict[str, float] = {}
+
+    def add_phase(self, name: str, seconds: float) -> None:
+        with self.lock:
+            self.phases[name] += seconds
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        Time the enclosed block as part of a phase
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - started)
+
+    def timed_pages(self, name: str, pages: Iterable[T]) -> Iterator[T]:
+        """
+        Yield from pages, timing only the fetch of each page as part of a phase
+        and not the work the caller does between pages
+        """
+        iterator = iter(pages)
+        while True:
+            with self.phase(name):
+                try:
+                    page = next(iterator)
+                except StopIteration:
+                    return
+            yield page
+
+    def set_value(self, name: str, value: float) -> None:
+        """
+        Record a count for the invocation, such as the number of instances evaluated
+        """
+        with self.lock:
+            self.values[name] = value
+
+    def record_attempt(self, operation: str, attempt: int, throttled: bool, bytes_received: int) -> None:
+        """
+        Count one HTTP attempt of an API call
+        """
+        with self.lock:
+            counters = self.operations[operation]
+            counters['retries'] += attempt > 1
+            counters['throttles'] += throttled
+            counters['bytes_received'] += bytes_received
+
+    def record_call(self, operation: str, seconds: float, failed: bool) -> None:
+        """
+        Count one API call once its last attempt has returned
+        """
+        with self.lock:
+            counters = self.operations[operation]
+            counters['calls'] += 1
+            counters['errors'] += failed
+            counters['seconds'] += seconds
+
+    def attach(self, client: Any) -> Any:
+        """
+        Count every call the client makes through botocore events
+        Works for synchronous and aiobotocore clients; returns the client
+        """
+        service_id = client.meta.service_model.service_id.hyphenize()
+
+        def before_call(event_name: str, context: Dict[str, Any], **kwargs) -> None:
+            context['metrics_started'] = time.perf_counter()
+            context['metrics_attempts'] = 0
+
+        def response_received(event_name: str, context: Dict[str, Any], response_dict: Optional[Dict[str, Any]] = None,
+                              parsed_response: Optional[Dict[str, Any]] = None, **kwargs) -> None:
+            context['metrics_attempts'] = context.get('metrics_attempts', 0) + 1
+            error_code = (parsed_response or {}).get('Error', {}).get('Code', '')
+            body = (response_dict or {}).get('body')
+            self.record_attempt(
+                event_name.rsplit('.', 1)[-1],
+                context['metrics_attempts'],
+                error_code in THROTTLE_ERROR_CODES,
+                len(body) if isinstance(body, (bytes, bytearray)) else 0
+            )
+
+        def after_call(event_name: str, context: Dict[str, Any], http_response: Any = None, **kwargs) -> None:
+            started = context.get('metrics_started')
+            if started is None:
+                return
+            failed = http_response is None or http_response.status_code >= 300
+            self.record_call(event_name.rsplit('.', 1)[-1], time.perf_counter() - started, failed)
+
+        client.meta.events.register(f"before-call.{service_id}", before_call)
+        client.meta.events.register(f"response-received.{service_id}", response_received)
+        client.meta.events.register(f"after-call.{service_id}", after_call)
+        client.meta.events.register(f"after-call-error.{service_id}", after_call)
+        return client
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Copy of the counters so far:
+        {'duration': seconds, 'phases': {phase: seconds},
+         'operations': {operation: {counter: value}}, 'values': {name: value}}
+        """
+        with self.lock:
+            return {
+                'duration': time.perf_counter() - self.started,
+                'phases': dict(self.phases),
+                'operations': {operation: dict(counters) for operation, counters in self.operations.items()},
+                'values': dict(self.values)
+            }
+
+    def emf_record(self, properties: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        The counters as one CloudWatch Embedded Metric Format record
+        properties are logged with the record without becoming metrics
+        """
+        snapshot = self.snapshot()
+        metrics = {'InvocationTime': (snapshot['duration'], 'Seconds')}
+        for name, seconds in snapshot['phases'].items():
+            metrics[f"{metric_name(name)}Time"] = (seconds, 'Seconds')
+        for operation, counters in snapshot['operations'].items():
+            for counter, (suffix, unit) in OPERATION_METRICS.items():
+                metrics[f"{operation}{suffix}"] = (counters[counter], unit)
+        for name, value in snapshot['values'].items():
+            metrics[metric_name(name)] = (value, 'Count')
+
+        definitions = [{'Name': name, 'Unit': unit} for name, (_, unit) in metrics.items()]
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [
+                    {
+                        'Namespace': self.namespace,
+                        'Dimensions': [list(self.dimensions)],
+                        'Metrics': definitions[start:start + EMF_MAX_METRICS]
+                    }
+                    for start in range(0, len(definitions), EMF_MAX_METRICS)
+                ]
+            }
+        }
+        record.update(properties or {})
+        record.update(self.dimensions)
+        record.update({name: value for name, (value, _) in metrics.items()})
+        return record
+
+    def emit(self, properties: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Print the EMF record on its own line; Lambda sends stdout to CloudWatch
+        Logs, which extracts the metrics. Printed rather than logged, because a
+        log line prefix would stop CloudWatch from parsing the record
+        """
+        print(json.dumps(self.emf_record(properties), default=str), flush=True)
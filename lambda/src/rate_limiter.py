@@ -0,0 +1,178 @@
+import logging
+import threading
+import time
+from typing import Dict, Any, Callable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Error codes AWS returns when a request exceeds the account's API rate
+THROTTLE_ERROR_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException'
+}
+
+# A throttled call halves the bucket's rate, down to this fraction of its configured rate
+MIN_RATE_FRACTION = 0.05
+
+# Each successful call raises the rate by this fraction of the configured rate
+RECOVERY_FRACTION = 0.05
+
+
+class TokenBucket:
+    """
+    Token bucket with an adaptive refill rate (additive increase, multiplicative decrease)
+    Holds up to one second of tokens at the configured rate
+    """
+
+    def __init__(self, rate: float):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Take a token and return how long to wait before using it, in seconds
+        The token is reserved immediately, so concurrent callers queue behind it
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def acquire(self) -> float:
+        """
+        Take a token, sleeping until one is available
+        Returns the time spent waiting in seconds
+        """
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self) -> float:
+        """
+        Take a token without blocking the event loop while waiting for it
+        """
+        # Imported here so the thread pool engine does not load asyncio at cold start
+        import asyncio
+        wait = self.reserve()
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+    def throttled(self) -> None:
+        with self.lock:
+            self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate / 2)
+
+    def succeeded(self) -> None:
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * RECOVERY_FRACTION)
+
+
+class RateLimiter:
+    """
+    Client-side token buckets per (account, region, API operation)
+    Buckets are shared by every client for the same account and region, so
+    concurrent workers draw from one budget per API; operations without a
+    configured rate are not limited
+    on_wait, when set, is called with the operation and the seconds every
+    request waited for a token
+    """
+
+    def __init__(self, rates: Dict[str, float], on_wait: Optional[Callable[[str, float], None]] = None):
+        self.rates = rates
+        self.on_wait = on_wait
+        self.buckets: Dict[Tuple[str, str, str], TokenBucket] = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, account: str, region: str, operation: str) -> Optional[TokenBucket]:
+        rate = self.rates.get(operation)
+        if not rate:
+            return None
+        key = (account, region, operation)
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(rate)
+        return bucket
+
+    def attach(self, client: Any, account: str, asynchronous: bool = False) -> Any:
+        """
+        Limit every request the client sends, retries included, through botocore events
+        Asynchronous (aiobotocore) clients wait for tokens without blocking the event loop
+        Wait and throttle lines carry operation, account_id and region as fields
+        for LOG_FORMAT=json, and build nothing when their level is disabled
+        Returns the client
+        """
+        region = client.meta.region_name
+        service_id = client.meta.service_model.service_id.hyphenize()
+
+        def log_wait(event_name: str, waited: float) -> None:
+            operation = event_name.rsplit('.', 1)[-1]
+            if waited and self.on_wait:
+                self.on_wait(operation, waited)
+            if waited > 1 and logger.isEnabledFor(logging.INFO):
+                logger.info("Rate limited %s in %s/%s for %.1fs", operation, account, region, waited,
+                            extra={'operation': operation, 'account_id': account, 'region': region,
+                                   'waited_seconds': round(waited, 3)})
+
+        def before_send(event_name: str, **kwargs) -> None:
+            bucket = self.bucket(account, region, event_name.rsplit('.', 1)[-1])
+            if bucket:
+                log_wait(event_name, bucket.acquire())
+
+        async def before_send_async(event_name: str, **kwargs) -> None:
+            bucket = self.bucket(account, region, event_name.rsplit('.', 1)[-1])
+            if bucket:
+                log_wait(event_name, await bucket.acquire_async())
+
+        def needs_retry(event_name: str, response: Any = None, **kwargs) -> None:
+            operation = event_name.rsplit('.', 1)[-1]
+            bucket = self.bucket(account, region, operation)
+            if bucket is None or response is None:
+                return
+            error_code = response[1].get('Error', {}).get('Code', '')
+            if error_code in THROTTLE_ERROR_CODES:
+                bucket.throttled()
+                if logger.isEnabledFor(logging.WARNING):
+                    logger.warning("%s throttled in %s/%s, lowering rate to %.1f/s", operation, account, region, bucket.rate,
+                                   extra={'operation': operation, 'account_id': account, 'region': region,
+                                          'rate_per_second': round(bucket.rate, 3)})
+            elif not error_code:
+                bucket.succeeded()
+
+        client.meta.events.register(f"before-send.{service_id}", before_send_async if asynchronous else before_send)
+        client.meta.events.register(f"needs-retry.{service_id}", needs_retry)
+        return client
+
+
+def parse_rates(spec: str) -> Dict[str, float]:
+    """
+    Parse 'Operation=requests per second' pairs separated by commas
+    """
+    rates = {}
+    for entry in spec.split(','):
+        if not entry.strip():
+            continue
+        operation, _, rate = entry.partition('=')
+        rates[operation.strip()] = float(rate)
+    return rates
+
+
+def create_rate_limiter(spec: str, on_wait: Optional[Callable[[str, float], None]] = None) -> Optional[RateLimiter]:
+    """
+    Build a rate limiter from API_RATE_LIMITS, or None when no rates are set
+    Nothing is logged here, as it runs when the Lambda module is imported; the
+    handler logs the rates once per invocation
+    """
+    rates = parse_rates(spec)
+    if not rates:
+        return None
+    return RateLimiter(rates, on_wait)
@@ -0,0 +1,273 @@
+import abc
+import json
+import os
+from typing import List, Dict, Any, Optional
+
+from backends import ClientFactory, LazyClientMixin, parse_location
+
+# Record lists of a run report; each record written to a sink carries its list's name as record_type
+REPORT_KINDS = ('skipped_instances', 'active_instances', 'monitoring_enabled', 'shutdown_results')
+
+# Parquet columns, all strings; fields a record does not have are null
+PARQUET_COLUMNS = (
+    'record_type', 'region', 'account_id', 'instance_id', 'instance_type', 'instance_name',
+    'reason', 'signal', 'next_check', 'action', 'status', 'message'
+)
+
+REPORT_FORMATS = ('ndjson', 'parquet')
+
+# S3 multipart uploads need every part but the last to be at least 5 MiB
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class FileStream:
+    """
+    Bytes written to a temporary file that is renamed into place when closed,
+    so readers never see a partial report part
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.temp_path = f"{path}.tmp"
+        self.file = open(self.temp_path, 'wb')
+        self.closed = False
+
+    def write(self, data: bytes) -> int:
+        return self.file.write(data)
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+
+    def abort(self) -> None:
+        self.closed = True
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+
+class S3UploadStream:
+    """
+    Bytes uploaded to an S3 object as they are written: a multipart upload part
+    whenever part_size bytes are buffered, or one PutObject for a part file that
+    never reaches part_size. Nothing is visible under the key until close
+    """
+
+    def __init__(self, client: Any, bucket: str, key: str, part_size: int, content_type: str):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, S3_MIN_PART_SIZE)
+        self.content_type = content_type
+        self.buffer = bytearray()
+        self.position = 0
+        self.upload_id = None
+        self.parts: List[Dict[str, Any]] = []
+        self.closed = False
+
+    def write(self, data: bytes) -> int:
+        self.buffer.extend(data)
+        self.position += len(data)
+        if len(self.buffer) >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self) -> None:
+        pass
+
+    def _upload_part(self) -> None:
+        if self.upload_id is None:
+            response = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key, ContentType=self.content_type)
+            self.upload_id = response['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=bytes(self.buffer)
+        )
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+        self.buffer = bytearray()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        if self.upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer), ContentType=self.content_type)
+            return
+        if self.buffer:
+            self._upload_part()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts}
+        )
+
+    def abort(self) -> None:
+        self.closed = True
+        self.buffer = bytearray()
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+class ReportWriter:
+    """
+    One part of a run's report: records are buffered and encoded to the stream
+    every chunk_records records, as an NDJSON block or a Parquet row group,
+    so a target never holds more than one chunk of its records
+    counts holds how many records of each kind were written
+    """
+
+    def __init__(self, stream: Any, report_format: str, chunk_records: int):
+        self.stream = stream
+        self.report_format = report_format
+        self.chunk_records = chunk_records
+        self.rows: List[Dict[str, Any]] = []
+        self.counts = dict.fromkeys(REPORT_KINDS, 0)
+        self.parquet_writer = None
+        self.schema = None
+        if report_format == 'parquet':
+            # Imported on use, so NDJSON reports do not need pyarrow in the package
+            import pyarrow
+            import pyarrow.parquet
+            self.schema = pyarrow.schema([(column, pyarrow.string()) for column in PARQUET_COLUMNS])
+            self.parquet_writer = pyarrow.parquet.ParquetWriter(stream, self.schema, compression='snappy')
+
+    def write(self, kind: str, records: List[Dict[str, Any]]) -> None:
+        self.counts[kind] += len(records)
+        self.rows.extend({'record_type': kind, **record} for record in records)
+        if len(self.rows) >= self.chunk_records:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Encode the buffered records to the stream
+        """
+        if not self.rows:
+            return
+        if self.parquet_writer is not None:
+            import pyarrow
+            self.parquet_writer.write_table(pyarrow.Table.from_pylist(self.rows, schema=self.schema))
+        else:
+            self.stream.write(''.join(json.dumps(row, default=str) + '\n' for row in self.rows).encode('utf-8'))
+        self.rows = []
+
+    def close(self) -> None:
+        """
+        Write the remaining records and publish the part
+        """
+        self.flush()
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+        self.stream.close()
+
+    def abort(self) -> None:
+        """
+        Drop the part; nothing written to it becomes visible
+        """
+        self.rows = []
+        self.stream.abort()
+
+
+class ReportSink(abc.ABC):
+    """
+    Where run reports are written: each run is a directory or prefix named
+    after its run ID holding one part file per target per invocation (or per
+    work queue shard), so concurrent writers never share an object
+    """
+
+    def __init__(self, report_format: str, chunk_records: int):
+        if report_format not in REPORT_FORMATS:
+            raise ValueError(f"Unsupported report format: {report_format}")
+        self.report_format = report_format
+        self.chunk_records = chunk_records
+
+    @abc.abstractmethod
+    def location(self, run_id: str) -> str:
+        """
+        Where the parts of a run are found, for the handler response
+        """
+
+    @abc.abstractmethod
+    def open(self, run_id: str, part: str) -> ReportWriter:
+        """
+        Start writing a part of a run's report; a part written again replaces the previous one
+        """
+
+    def _file_name(self, part: str) -> str:
+        return f"{part}.{self.report_format}"
+
+
+class FileReportSink(ReportSink):
+    """
+    Report parts as files in a local directory, for local runs, tests and benchmarks
+    """
+
+    def __init__(self, directory: str, report_format: str, chunk_records: int):
+        super().__init__(report_format, chunk_records)
+        self.directory = directory
+
+    def location(self, run_id: str) -> str:
+        return os.path.join(self.directory, run_id)
+
+    def open(self, run_id: str, part: str) -> ReportWriter:
+        os.makedirs(self.location(run_id), exist_ok=True)
+        stream = FileStream(os.path.join(self.location(run_id), self._file_name(part)))
+        return ReportWriter(stream, self.report_format, self.chunk_records)
+
+
+class S3ReportSink(LazyClientMixin, ReportSink):
+    """
+    Report parts as objects under a prefix in an S3 bucket, uploaded in parts while records are written
+    """
+
+    service_name = 's3'
+
+    def __init__(self, bucket: str, prefix: str, client_factory: ClientFactory,
+                 report_format: str, chunk_records: int, part_size: int):
+        super().__init__(report_format, chunk_records)
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.client_factory = client_factory
+        self.part_size = part_size
+
+    def _key(self, run_id: str) -> str:
+        return f"{self.prefix}/{run_id}" if self.prefix else run_id
+
+    def location(self, run_id: str) -> str:
+        return f"s3://{self.bucket}/{self._key(run_id)}/"
+
+    def open(self, run_id: str, part: str) -> ReportWriter:
+        content_type = 'application/x-ndjson' if self.report_format == 'ndjson' else 'application/vnd.apache.parquet'
+        stream = S3UploadStream(self.client, self.bucket, f"{self._key(run_id)}/{self._file_name(part)}",
+                                self.part_size, content_type)
+        return ReportWriter(stream, self.report_format, self.chunk_records)
+
+
+def create_report_sink(location: str, client_factory: ClientFactory, report_format: str = 'ndjson',
+                       chunk_records: int = 10000, part_size: int = 8 * 1024 * 1024) -> Optional[ReportSink]:
+    """
+    Report sink for REPORT_SINK, 's3:<bucket>/<prefix>' or 'file:<directory>'
+    Without one, records are kept in the handler response
+    """
+    parsed = parse_location(location, 'report sink', ('s3', 'file'))
+    if parsed is None:
+        return None
+
+    backend, target = parsed
+    if backend == 's3':
+        bucket, _, prefix = target.partition('/')
+        return S3ReportSink(bucket, prefix, client_factory, report_format, chunk_records, part_size)
+    return FileReportSink(target, report_format, chunk_records)
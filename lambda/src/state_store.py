@@ -0,0 +1,164 @@
+import abc
+import logging
+import sqlite3
+import threading
+import time
+from typing import List, Dict, Any, Optional
+
+from backends import ClientFactory, LazyClientMixin, parse_location
+
+logger = logging.getLogger(__name__)
+
+# Numeric fields of an idle-streak state record; instance_id is the key
+STATE_FIELDS = ['launch_time', 'last_timestamp', 'streak_start', 'streak_datapoints', 'gap_seconds']
+
+# Numeric fields of an evaluation schedule record: the earliest time an instance
+# launched at launch_time could be idle
+SCHEDULE_FIELDS = ['launch_time', 'next_check']
+
+# State for instances that are no longer evaluated expires after this many days (DynamoDB TTL)
+STATE_TTL_DAYS = 7
+
+
+class StateStore(abc.ABC):
+    """
+    Per-instance state kept between runs, idle streaks by default
+    Records are dicts with instance_id plus the store's fields, timestamps in epoch seconds
+    """
+
+    fields = STATE_FIELDS
+
+    @abc.abstractmethod
+    def get_many(self, instance_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Stored records of the instances that have one, by instance ID
+        """
+
+    @abc.abstractmethod
+    def put_many(self, records: List[Dict[str, Any]]) -> None:
+        """
+        Insert or replace records
+        """
+
+
+class SQLiteStateStore(StateStore):
+    """
+    SQLite-backed state store for local runs and benchmarks
+    """
+
+    def __init__(self, path: str, fields: List[str] = STATE_FIELDS, table: str = 'idle_state'):
+        self.fields = fields
+        self.table = table
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        columns = ', '.join(f"{field} REAL" for field in fields)
+        with self.lock, self.connection:
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS {table} (instance_id TEXT PRIMARY KEY, {columns})")
+
+    def get_many(self, instance_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        records = {}
+        # Stay well below SQLite's bound-parameter limit
+        for batch_start in range(0, len(instance_ids), 500):
+            batch = instance_ids[batch_start:batch_start + 500]
+            placeholders = ', '.join('?' for _ in batch)
+            with self.lock:
+                rows = self.connection.execute(
+                    f"SELECT instance_id, {', '.join(self.fields)} FROM {self.table} WHERE instance_id IN ({placeholders})",
+                    batch
+                ).fetchall()
+            for row in rows:
+                records[row[0]] = {'instance_id': row[0], **dict(zip(self.fields, row[1:]))}
+        return records
+
+    def put_many(self, records: List[Dict[str, Any]]) -> None:
+        if not records:
+            return
+        columns = ['instance_id'] + self.fields
+        with self.lock, self.connection:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO {self.table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                [[record.get(column) for column in columns] for record in records]
+            )
+
+
+class DynamoDBStateStore(LazyClientMixin, StateStore):
+    """
+    DynamoDB-backed state store; the table needs a string partition key named instance_id
+    and can enable TTL on the expires_at attribute to drop state for terminated instances
+    """
+
+    # BatchGetItem and BatchWriteItem request size limits
+    GET_BATCH_SIZE = 100
+    WRITE_BATCH_SIZE = 25
+
+    service_name = 'dynamodb'
+
+    def __init__(self, table_name: str, client_factory: ClientFactory, fields: List[str] = STATE_FIELDS):
+        self.table_name = table_name
+        self.client_factory = client_factory
+        self.fields = fields
+
+    def get_many(self, instance_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        records = {}
+        for batch_start in range(0, len(instance_ids), self.GET_BATCH_SIZE):
+            request = {
+                self.table_name: {
+                    'Keys': [
+                        {'instance_id': {'S': instance_id}}
+                        for instance_id in instance_ids[batch_start:batch_start + self.GET_BATCH_SIZE]
+                    ]
+                }
+            }
+            while request:
+                response = self.client.batch_get_item(RequestItems=request)
+                for item in response.get('Responses', {}).get(self.table_name, []):
+                    record = self._from_item(item)
+                    records[record['instance_id']] = record
+                request = response.get('UnprocessedKeys') or None
+        return records
+
+    def put_many(self, records: List[Dict[str, Any]]) -> None:
+        expires_at = int(time.time()) + STATE_TTL_DAYS * 86400
+        for batch_start in range(0, len(records), self.WRITE_BATCH_SIZE):
+            request = {
+                self.table_name: [
+                    {'PutRequest': {'Item': self._to_item(record, expires_at)}}
+                    for record in records[batch_start:batch_start + self.WRITE_BATCH_SIZE]
+                ]
+            }
+            while request:
+                response = self.client.batch_write_item(RequestItems=request)
+                request = response.get('UnprocessedItems') or None
+
+    def _to_item(self, record: Dict[str, Any], expires_at: int) -> Dict[str, Any]:
+        item = {
+            'instance_id': {'S': record['instance_id']},
+            'expires_at': {'N': str(expires_at)}
+        }
+        for field in self.fields:
+            if record.get(field) is not None:
+                item[field] = {'N': repr(float(record[field]))}
+        return item
+
+    def _from_item(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        record = {'instance_id': item['instance_id']['S']}
+        for field in self.fields:
+            record[field] = float(item[field]['N']) if field in item else None
+        return record
+
+
+def create_state_store(location: str, client_factory: ClientFactory,
+                       fields: List[str] = STATE_FIELDS, sqlite_table: str = 'idle_state') -> Optional[StateStore]:
+    """
+    State store for STATE_STORE or SCHEDULE_STORE, 'dynamodb:<table>' or 'sqlite:<path>'
+    fields and sqlite_table select the kind of record, idle streaks by default
+    or SCHEDULE_FIELDS; without a store that state is not kept between runs
+    """
+    parsed = parse_location(location, 'state store', ('dynamodb', 'sqlite'))
+    if parsed is None:
+        return None
+
+    backend, target = parsed
+    if backend == 'dynamodb':
+        return DynamoDBStateStore(target, client_factory, fields)
+    return SQLiteStateStore(target, fields, sqlite_table)
@@ -0,0 +1,102 @@
+import json
+import logging
+import threading
+import zlib
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional
+
+# LogRecord attributes that are not fields passed in extra
+RECORD_ATTRIBUTES = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record: time, level, logger and message, every field
+    passed in extra (such as instance_id or decision_counts), and the traceback
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'timestamp': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        entry.update((key, value) for key, value in record.__dict__.items() if key not in RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def use_json_format(logger: Optional[logging.Logger] = None) -> None:
+    """
+    Format every record of the handlers on logger (the root logger by default) as JSON
+    In Lambda these are the runtime's handlers, so records still carry the request ID
+    """
+    for handler in (logger or logging.getLogger()).handlers:
+        handler.setFormatter(JsonFormatter())
+
+
+class DecisionLog:
+    """
+    Per-instance log lines: counted by outcome, written only for a sample of instances
+    Whether an instance is sampled depends only on its ID, so every line about
+    a sampled instance is written, in every run. Counts cover one invocation:
+    reset starts the next and log_summary writes them as one line
+    """
+
+    def __init__(self, logger: logging.Logger, sample_rate: float):
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counts = Counter()
+
+    def sampled(self, instance_id: str) -> bool:
+        return zlib.crc32(instance_id.encode()) < self.sample_rate * 0x100000000
+
+    def log(self, level: int, instance_id: str, msg: str, *args: Any, outcome: Optional[str] = None) -> None:
+        """
+        Count outcome, if given, and log the %-style message when the instance is sampled
+        The message is only formatted when it is written
+        """
+        if outcome:
+            self.count(outcome)
+        if self.sampled(instance_id) and self.logger.isEnabledFor(level):
+            extra = {'instance_id': instance_id}
+            if outcome:
+                extra['outcome'] = outcome
+            self.logger.log(level, msg, *args, extra=extra)
+
+    def count(self, outcome: str) -> None:
+        """
+        Count an outcome that has no line of its own
+        """
+        with self.lock:
+            self.counts[outcome] += 1
+
+    def debug(self, instance_id: str, msg: str, *args: Any, outcome: Optional[str] = None) -> None:
+        self.log(logging.DEBUG, instance_id, msg, *args, outcome=outcome)
+
+    def info(self, instance_id: str, msg: str, *args: Any, outcome: Optional[str] = None) -> None:
+        self.log(logging.INFO, instance_id, msg, *args, outcome=outcome)
+
+    def warning(self, instance_id: str, msg: str, *args: Any, outcome: Optional[str] = None) -> None:
+        self.log(logging.WARNING, instance_id, msg, *args, outcome=outcome)
+
+    def summary(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.counts)
+
+    def log_summary(self) -> None:
+        """
+        Log the invocation's outcome counts; as the decision_counts field in JSON format
+        """
+        counts = self.summary()
+        if counts:
+            self.logger.info("Instance outcomes: %s", ', '.join(f"{outcome}={count}" for outcome, count in sorted(counts.items())),
+                             extra={'decision_counts': counts, 'sample_rate': self.sample_rate})
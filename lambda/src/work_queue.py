@@ -0,0 +1,108 @@
+import abc
+import json
+import logging
+import threading
+from collections import deque
+from typing import List, Dict, Any, Optional
+
+from backends import ClientFactory, LazyClientMixin, parse_location
+
+logger = logging.getLogger(__name__)
+
+
+class WorkQueue(abc.ABC):
+    """
+    Queue of shard messages from the coordinator to the workers
+    Messages are JSON-serializable dicts; in Lambda, workers receive them as
+    SQS events instead of calling receive
+    """
+
+    @abc.abstractmethod
+    def send_many(self, messages: List[Dict[str, Any]]) -> None:
+        """
+        Queue messages, each delivered to one worker
+        """
+
+    @abc.abstractmethod
+    def receive(self, max_messages: int = 10) -> List[Dict[str, Any]]:
+        """
+        Take up to max_messages messages off the queue, for workers polling outside Lambda
+        """
+
+
+class MemoryWorkQueue(WorkQueue):
+    """
+    In-process queue for local runs and benchmarks
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = deque()
+
+    def send_many(self, messages: List[Dict[str, Any]]) -> None:
+        with self.lock:
+            # Round-trip through JSON so messages look exactly as a worker would receive them
+            self.messages.extend(json.loads(json.dumps(message)) for message in messages)
+
+    def receive(self, max_messages: int = 10) -> List[Dict[str, Any]]:
+        with self.lock:
+            return [self.messages.popleft() for _ in range(min(max_messages, len(self.messages)))]
+
+
+class SQSWorkQueue(LazyClientMixin, WorkQueue):
+    """
+    Amazon SQS queue; the worker function is subscribed to it with an event source mapping
+    """
+
+    # SendMessageBatch and ReceiveMessage request size limits
+    SEND_BATCH_SIZE = 10
+    RECEIVE_BATCH_SIZE = 10
+
+    service_name = 'sqs'
+
+    def __init__(self, queue_url: str, client_factory: ClientFactory):
+        self.queue_url = queue_url
+        self.client_factory = client_factory
+
+    def send_many(self, messages: List[Dict[str, Any]]) -> None:
+        for batch_start in range(0, len(messages), self.SEND_BATCH_SIZE):
+            entries = [
+                {'Id': str(index), 'MessageBody': json.dumps(message)}
+                for index, message in enumerate(messages[batch_start:batch_start + self.SEND_BATCH_SIZE])
+            ]
+            response = self.client.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            failed = response.get('Failed', [])
+            if failed:
+                # One retry for entries SQS could not take; sender faults will fail again
+                retry = [entry for entry in entries if entry['Id'] in {failure['Id'] for failure in failed}]
+                response = self.client.send_message_batch(QueueUrl=self.queue_url, Entries=retry)
+                if response.get('Failed'):
+                    raise RuntimeError(f"Could not queue {len(response['Failed'])} messages: {response['Failed'][0].get('Message')}")
+
+    def receive(self, max_messages: int = 10) -> List[Dict[str, Any]]:
+        response = self.client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(max_messages, self.RECEIVE_BATCH_SIZE)
+        )
+        received = response.get('Messages', [])
+        if received:
+            self.client.delete_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{'Id': str(index), 'ReceiptHandle': message['ReceiptHandle']} for index, message in enumerate(received)]
+            )
+        return [json.loads(message['Body']) for message in received]
+
+
+def create_work_queue(location: str, client_factory: ClientFactory) -> Optional[WorkQueue]:
+    """
+    Work queue for WORK_QUEUE, 'sqs:<queue_url>' or 'memory:'
+    Without one, the coordinator processes the whole fleet in its own run
+    """
+    parsed = parse_location(location, 'work queue', ('sqs', 'memory'))
+    if parsed is None:
+        return None
+
+    backend, target = parsed
+    if backend == 'sqs':
+        return SQSWorkQueue(target, client_factory)
+    return MemoryWorkQueue()
@@ -0,0 +1,67 @@
+"""
+lambda_handler must list each region's instances with one paginated DescribeInstances walk
+
+Runs the handler against fake_aws clients whose EC2 stub records the arguments
+of every describe_instances call, with dry run off so shutdown candidates go
+through the stop path too. Neither evaluation nor shutdown may describe
+instances by ID or fall back to per-instance GetMetricStatistics.
+
+Run with: python -m pytest lambda/tests
+"""
+import math
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import ec2_shutdown  # noqa: E402
+from fake_aws import FakeCloudWatch, FakeEC2, make_fleet  # noqa: E402
+
+
+class RecordingEC2(FakeEC2):
+    """FakeEC2 that keeps the arguments of every describe_instances call"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.describe_requests = []
+
+    def describe_instances(self, **kwargs):
+        self.describe_requests.append(kwargs)
+        return super().describe_instances(**kwargs)
+
+
+@pytest.mark.parametrize('size', [100, 2500])
+def test_one_describe_instances_walk_per_region(size, monkeypatch):
+    regions = ['fake-region-0', 'fake-region-1']
+    fakes = {}
+    for region in regions:
+        instances, cpu_values = make_fleet(size, busy_ratio=0.5, excluded_ratio=0.05)
+        fakes[region] = (
+            RecordingEC2(instances),
+            FakeCloudWatch([], hours=ec2_shutdown.IDLE_DURATION_HOURS, cpu_values=cpu_values)
+        )
+    monkeypatch.setattr(ec2_shutdown, 'get_target_clients', lambda target: fakes[target['region']])
+    monkeypatch.setattr(ec2_shutdown, 'DRY_RUN', False)
+
+    response = ec2_shutdown.lambda_handler({'regions': regions}, None)
+
+    assert response['statusCode'] == 200
+    assert response['body']['instances_shutdown'] > 0
+    pages = math.ceil(size / ec2_shutdown.DESCRIBE_INSTANCES_PAGE_SIZE)
+    for ec2, cloudwatch in fakes.values():
+        requests = ec2.describe_requests
+        assert len(requests) == pages
+        assert not any('InstanceIds' in request for request in requests)
+        assert not any(
+            instance_filter['Name'] == 'instance-id'
+            for request in requests for instance_filter in request.get('Filters', [])
+        )
+        # One walk: the first page starts it and every later page continues it
+        assert 'NextToken' not in requests[0]
+        assert all(request.get('NextToken') for request in requests[1:])
+        assert cloudwatch.calls['GetMetricStatistics'] == 0
+        assert len(ec2.stopped) == response['body']['instances_shutdown'] // len(regions)
@@ -0,0 +1,169 @@
+"""
+The vectorized engine must reach is_instance_idle's decision for every instance
+
+Random fleets from fake_aws.random_cpu_fleet are collected through
+add_metric_results, as get_instance_metrics collects GetMetricData pages:
+into datapoint lists for the python engine and into CPUSeries for the
+vectorized one. Each seed is a separate case, so a failure names the seed
+that reproduces it. A randomized check then generates thousands of series
+aimed at the edges of the rules: launches inside the idle window and around
+the required runtime, exactly min_required_datapoints, duplicate and unsorted
+timestamps, NaN and threshold values, and gaps exactly at METRIC_GAP_SECONDS
+adding up to around MAX_TOTAL_GAP_SECONDS. On these, the vectorized engine
+must also return the one outcome is_instance_idle records.
+
+Run with: python -m pytest lambda/tests
+"""
+import os
+import random
+import sys
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+idle_matrix = pytest.importorskip('idle_matrix')
+
+import ec2_shutdown  # noqa: E402
+from fake_aws import random_cpu_fleet  # noqa: E402
+from instance_record import InstanceRecord  # noqa: E402
+
+
+def metric_data_pages(cpu_series, pages=2):
+    """GetMetricData responses holding every instance's CPU series, each series split across pages"""
+    query_ids = {f"m{index}_0": (instance_id, 'CPUUtilization') for index, instance_id in enumerate(cpu_series)}
+    responses = []
+    for page in range(pages):
+        results = []
+        for query_id, (instance_id, _) in query_ids.items():
+            timestamps, values = cpu_series[instance_id]
+            start, end = len(timestamps) * page // pages, len(timestamps) * (page + 1) // pages
+            results.append({'Id': query_id, 'Timestamps': timestamps[start:end], 'Values': values[start:end]})
+        responses.append({'MetricDataResults': results})
+    return query_ids, responses
+
+
+def collect(cpu_metrics, query_ids, responses):
+    for response in responses:
+        ec2_shutdown.add_metric_results(cpu_metrics, {instance_id: {} for instance_id in cpu_metrics}, query_ids, response)
+    return cpu_metrics
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_vectorized_decisions_match_python(seed):
+    launch_times, cpu_series = random_cpu_fleet(300, random.Random(seed), hours=ec2_shutdown.IDLE_DURATION_HOURS)
+    instance_index = {
+        instance_id: InstanceRecord(instance_id, 't3.micro', launch_time)
+        for instance_id, launch_time in launch_times.items()
+    }
+    instance_ids = list(instance_index)
+    query_ids, responses = metric_data_pages(cpu_series)
+
+    datapoints = collect({instance_id: [] for instance_id in instance_ids}, query_ids, responses)
+    series = collect({instance_id: idle_matrix.CPUSeries() for instance_id in instance_ids}, query_ids, responses)
+
+    expected = {
+        instance_id: ec2_shutdown.is_instance_idle(instance_id, datapoints[instance_id], instance_index)
+        for instance_id in instance_ids
+    }
+    arguments = (instance_index, ec2_shutdown.CPU_THRESHOLD, ec2_shutdown.IDLE_DURATION_HOURS,
+                 ec2_shutdown.METRIC_GAP_SECONDS, ec2_shutdown.MAX_TOTAL_GAP_SECONDS)
+    assert idle_matrix.evaluate_idle_matrix(instance_ids, series, *arguments) == expected
+    # Datapoint lists, as the bench and older callers pass them, in any order
+    shuffled = {instance_id: random.Random(seed).sample(points, len(points)) for instance_id, points in datapoints.items()}
+    assert idle_matrix.evaluate_idle_matrix(instance_ids, shuffled, *arguments) == expected
+    # Both outcomes occur, so the comparison is not vacuous
+    assert any(expected.values()) and not all(expected.values())
+
+
+def edge_case_series(rng, now):
+    """
+    A launch time and CPU datapoints (in arrival order) aimed at the edges of
+    is_instance_idle's rules; timestamps are whole seconds, as CloudWatch returns them
+    """
+    hours = ec2_shutdown.IDLE_DURATION_HOURS
+    expected = int(hours * 12)
+    min_required = int(expected * 0.9)
+    required_seconds = (hours + 0.5) * 3600
+    launch_seconds = rng.choice([
+        None, 3600, hours * 3600 - 600, required_seconds - 30, required_seconds + 30
+    ] + [24 * 3600] * 5)
+    launch_time = None if launch_seconds is None else now - timedelta(seconds=launch_seconds)
+
+    count = rng.choice([0, 1, min_required - 1, min_required, min_required + 1, expected, expected + 3])
+    # Five-minute steps with up to two gaps at or just over the gap and total gap limits
+    gap = ec2_shutdown.METRIC_GAP_SECONDS
+    max_total = ec2_shutdown.MAX_TOTAL_GAP_SECONDS
+    steps = [300] * count
+    for _ in range(rng.choice([0, 0, 1, 1, 2])):
+        if steps:
+            steps[rng.randrange(len(steps))] = rng.choice([gap, gap + 1, max_total, max_total + 1])
+    timestamp = now - timedelta(seconds=rng.randint(0, 240))
+    timestamps = []
+    for step in steps:
+        timestamps.append(timestamp)
+        timestamp -= timedelta(seconds=step)
+    timestamps.reverse()
+
+    threshold = ec2_shutdown.CPU_THRESHOLD
+    busy_rate = rng.choice([0.0, 0.0, 0.05, 0.3])
+    datapoints = [
+        {
+            'Timestamp': timestamp,
+            'Average': rng.choice([threshold + 1e-9, float('nan'), 50.0]) if rng.random() < busy_rate
+            else rng.choice([0.0, threshold / 2, threshold])
+        }
+        for timestamp in timestamps
+    ]
+    for _ in range(rng.choice([0, 0, 1, 3])):
+        if datapoints:
+            duplicate = dict(rng.choice(datapoints))
+            duplicate['Average'] = rng.choice([duplicate['Average'], 0.0, 50.0])
+            datapoints.insert(rng.randrange(len(datapoints) + 1), duplicate)
+    if rng.random() < 0.3:
+        rng.shuffle(datapoints)
+    return launch_time, datapoints
+
+
+def python_outcome(instance_id, datapoints, instance_index):
+    """
+    The one outcome is_instance_idle records for an instance; an idle instance's
+    is recorded by decide_idle_instances
+    """
+    ec2_shutdown.decision_log.reset()
+    idle = ec2_shutdown.is_instance_idle(instance_id, datapoints, instance_index)
+    outcomes = ec2_shutdown.decision_log.summary()
+    assert sum(outcomes.values()) == (0 if idle else 1), outcomes
+    return 'idle' if idle else next(iter(outcomes))
+
+
+@pytest.mark.parametrize('block', range(10))
+def test_vectorized_decisions_match_python_on_edge_cases(block):
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    arguments = (ec2_shutdown.CPU_THRESHOLD, ec2_shutdown.IDLE_DURATION_HOURS,
+                 ec2_shutdown.METRIC_GAP_SECONDS, ec2_shutdown.MAX_TOTAL_GAP_SECONDS)
+    for seed in range(block * 200, (block + 1) * 200):
+        rng = random.Random(seed)
+        instance_index = {}
+        datapoints = {}
+        for index in range(25):
+            instance_id = f"i-{index:017x}"
+            launch_time, datapoints[instance_id] = edge_case_series(rng, now)
+            instance_index[instance_id] = InstanceRecord(instance_id, 't3.micro', launch_time)
+        instance_ids = list(instance_index)
+        series = {instance_id: idle_matrix.CPUSeries() for instance_id in instance_ids}
+        for instance_id, points in datapoints.items():
+            series[instance_id].extend([dp['Timestamp'] for dp in points], [dp['Average'] for dp in points])
+
+        expected = {
+            instance_id: python_outcome(instance_id, list(datapoints[instance_id]), instance_index)
+            for instance_id in instance_ids
+        }
+        actual = idle_matrix.evaluate_outcome_matrix(instance_ids, series, instance_index, *arguments)
+        assert actual == expected, f"seed {seed}: " + ', '.join(
+            f"{instance_id} python={expected[instance_id]} vectorized={actual[instance_id]}"
+            for instance_id in instance_ids if actual[instance_id] != expected[instance_id]
+        )
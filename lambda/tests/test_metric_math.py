@@ -0,0 +1,178 @@
+"""
+Metric math summaries must reach is_instance_idle's decision for every instance
+
+The fake CloudWatch holds random fleets from fake_aws.random_cpu_fleet, untrimmed,
+and evaluates the expressions metric_summary_requests builds. The python engine
+decides on the datapoints get_instance_metrics fetches from the same fake, which
+is what find_idle_instances passes to it. Both queries use one idle window, so
+a period boundary passing between them cannot change either.
+
+Agreement through the fake only shows that the expressions mean what the fake
+makes of them. reference_summary computes each summary scalar from the raw
+datapoints as CloudWatch defines the functions, without the fake, and
+is_summary_idle must reach is_instance_idle's decision from it, including for
+empty series and series covering part of the window. The fake must produce
+the same scalars, one value per expression, from requests that anchor every
+expression to a one-datapoint series spanning the window.
+
+Run with: python -m pytest lambda/tests
+"""
+import math
+import os
+import random
+import sys
+from datetime import timedelta, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import ec2_shutdown  # noqa: E402
+from fake_aws import FakeCloudWatch, random_cpu_fleet  # noqa: E402
+from instance_record import InstanceRecord  # noqa: E402
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_metric_math_decisions_match_python(seed, monkeypatch):
+    window = ec2_shutdown.idle_window()
+    monkeypatch.setattr(ec2_shutdown, 'idle_window', lambda: window)
+    launch_times, cpu_series = random_cpu_fleet(300, random.Random(seed), hours=ec2_shutdown.IDLE_DURATION_HOURS)
+    instance_index = {
+        instance_id: InstanceRecord(instance_id, 't3.micro', launch_time)
+        for instance_id, launch_time in launch_times.items()
+    }
+    instance_ids = list(instance_index)
+    cloudwatch = FakeCloudWatch(instance_ids, cpu_datapoints={
+        instance_id: list(zip(timestamps, values)) for instance_id, (timestamps, values) in cpu_series.items()
+    })
+
+    datapoints, _ = ec2_shutdown.get_instance_metrics(cloudwatch, instance_ids, signals={})
+    summaries, _ = ec2_shutdown.get_metric_summaries(cloudwatch, instance_ids, signals={})
+
+    expected = {
+        instance_id: ec2_shutdown.is_instance_idle(instance_id, list(datapoints[instance_id]), instance_index)
+        for instance_id in instance_ids
+    }
+    assert {
+        instance_id: ec2_shutdown.is_summary_idle(instance_id, summaries[instance_id], instance_index)
+        for instance_id in instance_ids
+    } == expected
+    # Both outcomes occur, so the comparison is not vacuous
+    assert any(expected.values()) and not all(expected.values())
+
+
+def reference_summary(datapoints):
+    """
+    The CPU_SUMMARY_EXPRESSIONS scalars of a series of (timestamp, value) pairs:
+    MAX, DATAPOINT_COUNT, SUM(IF(...)) over the values, and DIFF_TIME as the
+    seconds since the previous datapoint, which the first one does not have.
+    An empty series makes every expression return no values, so no keys
+    """
+    if not datapoints:
+        return {}
+    datapoints = sorted(datapoints)
+    gaps = [
+        (later - earlier).total_seconds()
+        for (earlier, _), (later, _) in zip(datapoints, datapoints[1:])
+    ]
+    return {
+        'max_cpu': max(value for _, value in datapoints),
+        'datapoints': float(len(datapoints)),
+        'breaches': float(sum(value > ec2_shutdown.CPU_THRESHOLD for _, value in datapoints)),
+        'gap_seconds': float(sum(gap for gap in gaps if gap > ec2_shutdown.METRIC_GAP_SECONDS))
+    }
+
+
+def window_series(rng, start, end):
+    """
+    Datapoints at the period timestamps CloudWatch returns inside [start, end):
+    the whole window, part of it (its start or end missing), scattered missing
+    periods, one run of them, or none; values at, below and above the CPU threshold
+    """
+    periods = [start + timedelta(minutes=5 * index) for index in range(int((end - start).total_seconds() // 300))]
+    shape = rng.choice(['full', 'full', 'scattered', 'gap', 'head', 'tail', 'empty'])
+    if shape == 'empty':
+        periods = []
+    elif shape == 'head':
+        periods = periods[:rng.randint(1, len(periods))]
+    elif shape == 'tail':
+        periods = periods[-rng.randint(1, len(periods)):]
+    elif shape == 'scattered':
+        periods = [timestamp for timestamp in periods if rng.random() > rng.choice([0.03, 0.1])]
+    elif shape == 'gap':
+        # One run of missing periods: a gap of 600s is allowed, 900s is not
+        missing = rng.randint(1, 3)
+        first = rng.randint(1, len(periods) - missing - 1)
+        periods = periods[:first] + periods[first + missing:]
+    busy_rate = rng.choice([0.0, 0.0, 0.05])
+    threshold = ec2_shutdown.CPU_THRESHOLD
+    return [
+        (timestamp.replace(tzinfo=timezone.utc),
+         rng.choice([threshold + 0.01, 50.0]) if rng.random() < busy_rate else rng.choice([0.0, threshold / 2, threshold]))
+        for timestamp in periods
+    ]
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_summary_rules_match_python_on_raw_datapoints(seed, monkeypatch):
+    window = ec2_shutdown.idle_window()
+    monkeypatch.setattr(ec2_shutdown, 'idle_window', lambda: window)
+    rng = random.Random(seed)
+    start, end = window
+    now = end.replace(tzinfo=timezone.utc)
+    launch_hours = [None, 1, ec2_shutdown.IDLE_DURATION_HOURS + 0.4, 24, 24, 24]
+
+    instance_index = {}
+    datapoints = {}
+    for index in range(300):
+        instance_id = f"i-{index:017x}"
+        hours = rng.choice(launch_hours)
+        instance_index[instance_id] = InstanceRecord(instance_id, 't3.micro', None if hours is None else now - timedelta(hours=hours))
+        datapoints[instance_id] = window_series(rng, start, end)
+    instance_ids = list(instance_index)
+
+    references = {instance_id: reference_summary(datapoints[instance_id]) for instance_id in instance_ids}
+    expected = {
+        instance_id: ec2_shutdown.is_instance_idle(
+            instance_id, [{'Timestamp': timestamp, 'Average': value} for timestamp, value in datapoints[instance_id]],
+            instance_index
+        )
+        for instance_id in instance_ids
+    }
+    assert {
+        instance_id: ec2_shutdown.is_summary_idle(instance_id, references[instance_id], instance_index)
+        for instance_id in instance_ids
+    } == expected
+    assert any(expected.values()) and not all(expected.values())
+    assert any(not reference for reference in references.values())
+
+    # The Lambda's requests: every expression anchored to a one-datapoint series over the window
+    requests = ec2_shutdown.metric_summary_requests(instance_ids, signals={})
+    for _, request in requests:
+        queries = {query['Id']: query for query in request['MetricDataQueries']}
+        for query in queries.values():
+            if 'Expression' not in query:
+                assert not query['ReturnData']
+                continue
+            anchor = queries[query['Expression'].split(' * 0 + ')[0]]
+            assert anchor['MetricStat']['Stat'] == 'SampleCount'
+            assert anchor['MetricStat']['Period'] == ec2_shutdown.IDLE_DURATION_HOURS * 3600
+
+    # The fake computes the same scalars, one value per expression
+    cloudwatch = FakeCloudWatch(instance_ids, cpu_datapoints=datapoints)
+    values_per_result = []
+    get_metric_data = cloudwatch.get_metric_data
+
+    def counting_get_metric_data(**kwargs):
+        response = get_metric_data(**kwargs)
+        values_per_result.extend(len(result['Values']) for result in response['MetricDataResults'])
+        return response
+    cloudwatch.get_metric_data = counting_get_metric_data
+    summaries, _ = ec2_shutdown.get_metric_summaries(cloudwatch, instance_ids, signals={})
+    assert set(values_per_result) <= {0, 1}
+    for instance_id in instance_ids:
+        assert summaries[instance_id].keys() == references[instance_id].keys(), instance_id
+        for key, value in references[instance_id].items():
+            assert math.isclose(summaries[instance_id][key], value), (instance_id, key)
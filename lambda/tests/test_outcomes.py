@@ -0,0 +1,94 @@
+"""
+lambda_handler must count every instance it evaluates under exactly one decision
+
+Runs the handler with each evaluation engine against a fake fleet holding
+every kind of instance: excluded, unmonitored, too new, busy on CPU or on
+another signal, and with no, too few or gapped CPU datapoints. The decision
+outcomes of the invocation must add up to total_instances_evaluated; the
+shutdown outcomes that follow an idle decision are left out. A schedule store
+adds instances that are not queried before their next check, and a second
+run evaluates the fleet once the idle instances are stopped.
+
+Run with: python -m pytest lambda/tests
+"""
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import ec2_shutdown  # noqa: E402
+from fake_aws import FakeCloudWatch, FakeEC2, make_fleet  # noqa: E402
+from state_store import SCHEDULE_FIELDS, create_state_store  # noqa: E402
+
+SHUTDOWN_OUTCOMES = {'stopped', 'hibernated', 'hibernate_fallback'}
+
+# Reasons the datapoints themselves keep an instance running; the streak engine
+# only tells whether its streak covers the window, so it reports active_cpu
+DATAPOINT_OUTCOMES = {'no_metrics', 'insufficient_metrics', 'metric_gaps'}
+
+
+def fake_clients(size):
+    instances, cpu_values = make_fleet(size, busy_ratio=0.2, excluded_ratio=0.05, monitoring_state='enabled')
+    signal_values = {}
+    for index, instance in enumerate(instances):
+        if index % 9 == 3:
+            instance['LaunchTime'] = datetime.now(timezone.utc) - timedelta(hours=1)
+        if index % 13 == 6:
+            instance['Monitoring'] = {'State': 'disabled'}
+        if index % 11 == 4:
+            signal_values[instance['InstanceId']] = {'NetworkIn': 1e9}
+    cloudwatch = FakeCloudWatch([], hours=ec2_shutdown.IDLE_DURATION_HOURS, cpu_values=cpu_values,
+                                signal_values=signal_values)
+    timestamps = cloudwatch.timestamps
+    for index, instance in enumerate(instances):
+        points = [(timestamp, 0.5) for timestamp in timestamps]
+        if index % 7 == 1:
+            cloudwatch.cpu_datapoints[instance['InstanceId']] = points[-10:]
+        elif index % 7 == 2:
+            cloudwatch.cpu_datapoints[instance['InstanceId']] = points[:10] + points[12:]
+        elif index % 7 == 5:
+            cloudwatch.cpu_datapoints[instance['InstanceId']] = []
+    return FakeEC2(instances), cloudwatch
+
+
+def decision_counts():
+    return {
+        outcome: count for outcome, count in ec2_shutdown.decision_log.summary().items()
+        if outcome not in SHUTDOWN_OUTCOMES
+    }
+
+
+@pytest.mark.parametrize('engine', ['python', 'vectorized', 'metric_math', 'streak'])
+def test_one_decision_outcome_per_instance(engine, tmp_path, monkeypatch):
+    if engine == 'vectorized':
+        monkeypatch.setattr(ec2_shutdown, 'idle_matrix', pytest.importorskip('idle_matrix'))
+    if engine == 'streak':
+        monkeypatch.setattr(ec2_shutdown, 'idle_state_store', create_state_store(f"sqlite:{tmp_path / 'state.db'}", None))
+    monkeypatch.setattr(ec2_shutdown, 'EVALUATION_ENGINE', engine)
+    monkeypatch.setattr(ec2_shutdown, 'IDLE_SIGNAL_THRESHOLDS', {'NetworkIn': 1e6})
+    monkeypatch.setattr(ec2_shutdown, 'ENABLE_DETAILED_MONITORING', True)
+    monkeypatch.setattr(ec2_shutdown, 'DRY_RUN', False)
+    monkeypatch.setattr(ec2_shutdown, 'schedule_store', create_state_store(
+        f"sqlite:{tmp_path / 'schedule.db'}", None, SCHEDULE_FIELDS, 'evaluation_schedule'))
+    ec2, cloudwatch = fake_clients(400)
+    monkeypatch.setattr(ec2_shutdown, 'get_target_clients', lambda target: (ec2, cloudwatch))
+
+    for run in range(2):
+        response = ec2_shutdown.lambda_handler({'regions': ['fake-region-0']}, None)
+        assert response['statusCode'] == 200
+        counts = decision_counts()
+        assert sum(counts.values()) == response['body']['total_instances_evaluated'], counts
+        if run:
+            # Idle instances are stopped by now and busy ones wait for their next check
+            expected = {'skipped', 'scheduled'}
+        else:
+            # Too new instances are scheduled for the end of their launch buffer
+            expected = {'skipped', 'monitoring_enabled', 'scheduled', 'idle', 'active_signal', 'active_cpu'}
+            if engine != 'streak':
+                expected |= DATAPOINT_OUTCOMES
+        assert expected <= counts.keys(), counts